@@ -1,41 +1,164 @@
-from flask import Flask
+import json
+
+import click
+from flask import Flask, Response, jsonify
+from flask.cli import with_appcontext
 from flask_cors import CORS
 from sqlalchemy import event
 import os
-from flask_marshmallow import Marshmallow
 from sqlalchemy.engine import Engine
+from sqlalchemy.orm import configure_mappers
 from application import db
-from application.clients.routes import clients_api
+from application.cache import cache
+from application.metrics import after_cursor_execute, before_cursor_execute, handle_error, metrics
+from application.migrations import migrate, stamp
+from application.storage import init_storage
+from application.clients.routes import clients_api, import_clients
 from application.invoices.routes import invoices_api
-from application.products.routes import products_api
+from application.idempotency import purge_expired_keys
+from application.importing import read_records
+from application.invoices.templating import compile_templates
+from application.products.routes import import_products, products_api
+from application.reports.routes import rebuild_summaries, reports_api
 
-app = Flask(__name__)
 basedir = os.path.abspath(os.path.dirname(__file__))
 db_filename = os.path.join(basedir, 'invoice_system.db')
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + db_filename
-# app.config['SQLALCHEMY_ECHO'] = True
 
-db.init_app(app)
-ma = Marshmallow(app)
-CORS(app)
+ENGINE_LISTENERS = (
+    ('before_cursor_execute', before_cursor_execute),
+    ('after_cursor_execute', after_cursor_execute),
+    ('handle_error', handle_error)
+)
+
+
+def load_config():
+    # Settings read from the environment; create_app's config argument overrides them
+    return {
+        # Only SQLite is supported, DATABASE_URL is left to whatever database add-on a platform attaches
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.environ.get('SQLITE_PATH', db_filename),
+        # 'SQLALCHEMY_ECHO': True,
+        # Nothing listens to the model signals, tracking them costs every session flush
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'PDF_RENDER_WORKERS': int(os.environ.get('PDF_RENDER_WORKERS', 2)),
+        'PDF_RENDER_TIMEOUT': int(os.environ.get('PDF_RENDER_TIMEOUT', 60)),
+        'PDF_RENDERER': os.environ.get('PDF_RENDERER', 'wkhtmltopdf'),
+        # Worker threads of the ASGI entry point, which run every request's Flask and SQLAlchemy code
+        'ASGI_THREADS': int(os.environ.get('ASGI_THREADS', 32)),
+        'CATALOG_CACHE_BACKEND': os.environ.get('CATALOG_CACHE_BACKEND', 'memory'),
+        'CATALOG_CACHE_SIZE': int(os.environ.get('CATALOG_CACHE_SIZE', 10000)),
+        'CATALOG_CACHE_TTL': int(os.environ.get('CATALOG_CACHE_TTL', 300)),
+        'CATALOG_CACHE_REDIS_URL': os.environ.get('REDIS_URL'),
+        'SQLITE_PROFILE': os.environ.get('SQLITE_PROFILE', 'default'),
+        'SQLITE_BUSY_TIMEOUT': int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000)),
+        'SQLITE_POOL_SIZE': int(os.environ.get('SQLITE_POOL_SIZE', 5)),
+        'PROFILE_SLOW_REQUESTS': float(os.environ['PROFILE_SLOW_REQUESTS']) if os.environ.get('PROFILE_SLOW_REQUESTS') else None,
+        'PROFILE_DIR': os.environ.get('PROFILE_DIR', os.path.join(basedir, 'profiles')),
+        'INVOICE_SERIES': os.environ.get('INVOICE_SERIES', 'INV'),
+        'IDEMPOTENCY_KEY_TTL': int(os.environ.get('IDEMPOTENCY_KEY_TTL', 24 * 60 * 60)),
+        # Series listed here may skip numbers, e.g. '{"DRAFT": 100}', every other series is gapless
+        'INVOICE_SEQUENCE_BLOCK_SIZES': json.loads(os.environ.get('INVOICE_SEQUENCE_BLOCK_SIZES', '{}'))
+    }
+
+
+def create_app(config=None):
+    """
+    Builds the app from the environment's settings updated with config.
+
+    Nothing here connects to the database or loads the PDF and template machinery, which happens on
+    first use, so a gunicorn master can build the app with --preload and fork workers that share it.
+    """
+    app = Flask(__name__)
+    app.config.update(load_config())
+    app.config.update(config or {})
+
+    init_storage(app)
+    db.init_app(app)
+    cache.init_app(app)
+    metrics.init_app(app)
+    CORS(app)
+
+    app.register_blueprint(clients_api, url_prefix='/api/clients')
+    app.register_blueprint(products_api, url_prefix='/api/products')
+    app.register_blueprint(invoices_api, url_prefix='/api/invoices')
+    app.register_blueprint(reports_api, url_prefix='/api/reports')
+    app.add_url_rule('/api/cache/stats', view_func=get_cache_stats, methods=['GET'])
+    app.add_url_rule('/metrics', view_func=get_metrics, methods=['GET'])
+
+    for command in (db_create, db_migrate, catalog_import, idempotency_purge, templates_compile, reports_rebuild):
+        app.cli.add_command(command)
+
+    # Engine events are global, an app created again (e.g. per test) must not count statements twice
+    for name, listener in ENGINE_LISTENERS:
+        if not event.contains(Engine, name, listener):
+            event.listen(Engine, name, listener)
+    # Otherwise the first query of every worker configures the mappers, with --preload the master does it once
+    configure_mappers()
+    return app
+
 
-app.register_blueprint(clients_api, url_prefix='/api/clients')
-app.register_blueprint(products_api, url_prefix='/api/products')
-app.register_blueprint(invoices_api, url_prefix='/api/invoices')
+def get_cache_stats():
+    return jsonify(cache.stats()), 200
 
 
-@event.listens_for(Engine, "connect")
-def set_sqlite_pragma(dbapi_connection, connection_record):
-    cursor = dbapi_connection.cursor()
-    cursor.execute("PRAGMA foreign_keys=ON")
-    cursor.close()
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4'), 200
 
 
-@app.cli.command('db_create')
+@click.command('db_create')
+@with_appcontext
 def db_create():
     db.create_all()
+    stamp(db.engine)
     print('Database Created!')
 
 
+@click.command('db_migrate')
+@with_appcontext
+def db_migrate():
+    applied = migrate(db.engine)
+    for migration in applied:
+        print(f'Applied migration {migration.version}: {migration.description}')
+    print('Database is up to date!')
+
+
+@click.command('catalog_import')
+@click.argument('kind', type=click.Choice(['clients', 'products']))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--dryrun', is_flag=True, help='Validate the file and roll back instead of committing.')
+@with_appcontext
+def catalog_import(kind, path, dryrun):
+    import_format = 'csv' if path.lower().endswith('.csv') else 'ndjson'
+    import_catalog = import_clients if kind == 'clients' else import_products
+    with open(path, 'rb') as stream:
+        for event in import_catalog(read_records(stream, import_format), dryrun):
+            if event['event'] == 'row_error':
+                print(f'Line {event["line"]}: {"; ".join(event["errors"])}')
+            elif event['event'] == 'progress':
+                print(f'{event["rows"]} rows read, {event["imported"]} imported, {event["failed"]} failed')
+            else:
+                print(json.dumps(event))
+
+
+@click.command('idempotency_purge')
+@with_appcontext
+def idempotency_purge():
+    print(f'Purged {purge_expired_keys()} expired idempotency keys!')
+
+
+@click.command('templates_compile')
+@with_appcontext
+def templates_compile():
+    for template_name in compile_templates():
+        print(f'Compiled {template_name}')
+    print('Templates compiled!')
+
+
+@click.command('reports_rebuild')
+@with_appcontext
+def reports_rebuild():
+    rebuild_summaries()
+    print('Report summaries rebuilt!')
+
+
 if __name__ == '__main__':
-    app.run()
+    create_app().run()
@@ -1,3 +1,5 @@
 from flask_sqlalchemy import SQLAlchemy
 
-db = SQLAlchemy()
\ No newline at end of file
+db = SQLAlchemy()
+# SQLite refuses statements with more than 999 bound parameters
+SQLITE_MAX_VARIABLE_NUMBER = 999
@@ -0,0 +1,198 @@
+import asyncio
+import io
+import os
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+from application.invoices.models import Invoice
+from application.invoices.rendering import DEFAULT_RENDER_WORKERS, get_cached_pdf_path, get_render_job_id, \
+    run_wkhtmltopdf, start_pool_render, submit_render_job
+from application.invoices.routes import DEFAULT_RENDER_TIMEOUT
+from application.invoices.templating import INVOICE_TEMPLATE, render_invoice_html
+
+DEFAULT_ASGI_THREADS = 32
+MAX_BUFFERED_RESPONSE = 1024 * 1024
+DOWNLOAD_PATH = re.compile(r'^/api/invoices/(?P<invoice_id>[^/]+)/download$')
+
+
+class RequestBody(io.RawIOBase):
+    # wsgi.input for a request running on a worker thread; every read waits on the event loop for the next
+    # chunk of the body, so uploads stream through without being buffered whole
+
+    def __init__(self, loop, receive):
+        self.loop = loop
+        self.receive = receive
+        self.pending = bytearray()
+        self.more_body = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending and self.more_body:
+            message = asyncio.run_coroutine_threadsafe(self.receive(), self.loop).result()
+            if message['type'] == 'http.disconnect':
+                raise IOError('Client disconnected')
+            self.pending += message.get('body', b'')
+            self.more_body = message.get('more_body', False)
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        del self.pending[:size]
+        return size
+
+
+def build_environ(scope, body):
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BufferedReader(body),
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    for name, value in scope['headers']:
+        name, value = name.decode('latin-1').upper().replace('-', '_'), value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f'HTTP_{name}'
+        environ[name] = f'{environ[name]},{value}' if name in environ else value
+    return environ
+
+
+class AsgiApp:
+    """
+    Serves the Flask app to an ASGI server such as uvicorn.
+
+    Flask 1.1 has no async views and SQLAlchemy 1.3 no asyncio driver, so every request runs on a bounded
+    pool of threads and the event loop only waits for it. PDF downloads that need a render are the
+    exception: the render is awaited on the event loop as a wkhtmltopdf subprocess, and only the finished
+    file is served through Flask, so a slow render holds no thread at all.
+    """
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.executor = ThreadPoolExecutor(max_workers=flask_app.config.get('ASGI_THREADS', DEFAULT_ASGI_THREADS),
+                                           thread_name_prefix='asgi')
+        # Renders of different invoices each start a wkhtmltopdf process, as many at a time as the WSGI app's pool
+        self.render_slots = asyncio.Semaphore(flask_app.config.get('PDF_RENDER_WORKERS', DEFAULT_RENDER_WORKERS))
+        self.loop = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError(f'Unsupported ASGI scope type {scope["type"]}')
+        self.loop = asyncio.get_running_loop()
+        match = DOWNLOAD_PATH.match(scope['path'])
+        if match and scope['method'] in ('GET', 'HEAD'):
+            scope = await self.prepare_download(scope, match.group('invoice_id'))
+        await self.run_wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def run_sync(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    def start_render(self, html, filepath, renderer_name):
+        if renderer_name != 'wkhtmltopdf':
+            return start_pool_render(html, filepath, renderer_name)
+        return asyncio.run_coroutine_threadsafe(self.render_wkhtmltopdf(html, filepath), self.loop)
+
+    async def render_wkhtmltopdf(self, html, filepath):
+        async with self.render_slots:
+            return await run_wkhtmltopdf(html, filepath)
+
+    def submit_download_render(self, invoice_id):
+        # Returns the render job's future, or None when there is nothing to render or the invoice does not exist
+        with self.flask_app.app_context():
+            invoice = Invoice.query.filter_by(invoice_id=invoice_id).first()
+            if not invoice:
+                return None
+            job_id = get_render_job_id(invoice_id, INVOICE_TEMPLATE)
+            if os.path.exists(get_cached_pdf_path(job_id)):
+                return None
+            return submit_render_job(job_id, lambda: render_invoice_html(invoice), self.start_render)
+
+    async def prepare_download(self, scope, invoice_id):
+        # Waits for the PDF without holding a thread, then leaves serving it (ETag, Range) to the Flask view.
+        # A render that outlasts the timeout is handed over as ?async=true, which answers 202 with the job.
+        query = dict(parse_qsl(scope['query_string'].decode('latin-1')))
+        if query.get('async', '').lower() in ('true', '1'):
+            return scope
+        future = await self.run_sync(self.submit_download_render, invoice_id)
+        if future is None:
+            return scope
+        timeout = self.flask_app.config.get('PDF_RENDER_TIMEOUT', DEFAULT_RENDER_TIMEOUT)
+        try:
+            await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout)
+        except asyncio.TimeoutError:
+            query_string = scope['query_string'] + (b'&' if scope['query_string'] else b'') + b'async=true'
+            return dict(scope, query_string=query_string)
+        except Exception:
+            # The view reports the failed job
+            pass
+        return scope
+
+    async def run_wsgi(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        environ = build_environ(scope, RequestBody(loop, receive))
+
+        def send_message(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def call_app():
+            response_start = {}
+
+            def start_response(status, headers, exc_info=None):
+                response_start.update(type='http.response.start', status=int(status.split(' ', 1)[0]),
+                                      headers=[(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                               for name, value in headers])
+
+            result = self.flask_app(environ, start_response)
+            try:
+                content_length = next((int(value) for name, value in response_start['headers'] if name == b'content-length'), None)
+                if content_length is not None and content_length <= MAX_BUFFERED_RESPONSE:
+                    # Each hop between a worker thread and the event loop waits for the GIL, which under load
+                    # costs more than the request itself, so known small bodies go back in one piece
+                    return response_start, b''.join(result)
+                started = False
+                for chunk in result:
+                    if not chunk:
+                        continue
+                    if not started:
+                        send_message(response_start)
+                        started = True
+                    send_message({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                if not started:
+                    send_message(response_start)
+                send_message({'type': 'http.response.body', 'body': b''})
+                return None
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+
+        buffered = await loop.run_in_executor(self.executor, call_app)
+        if buffered is not None:
+            response_start, body = buffered
+            await send(response_start)
+            await send({'type': 'http.response.body', 'body': body})
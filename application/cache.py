@@ -0,0 +1,204 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_CACHE_TTL = 300
+
+
+class MemoryCacheStore:
+    # Bounded LRU with a per-entry TTL, local to one worker process
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        # Bumped by every delete of a key, as many as there are entries are remembered
+        self.generations = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                    self.evictions += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def get_generations(self, keys):
+        with self.lock:
+            return [self.generations.get(key, 0) for key in keys]
+
+    def set(self, key, value, generation=None):
+        with self.lock:
+            if generation is not None and self.generations.get(key, 0) != generation:
+                return
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+                self.generations[key] = self.generations.pop(key, 0) + 1
+            while len(self.generations) > self.max_size:
+                self.generations.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generations.clear()
+
+    def stats(self):
+        return {'backend': 'memory', 'size': len(self.entries), 'max_size': self.max_size, 'ttl': self.ttl,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class RedisCacheStore:
+    # Shared by every gunicorn worker, so an invalidation in one worker is seen by all of them
+
+    # Sets the value only while the key's generation is still the one read before loading it
+    SET_IF_GENERATION = '''
+        if (redis.call('GET', KEYS[2]) or '0') == ARGV[2] then
+            redis.call('SETEX', KEYS[1], ARGV[3], ARGV[1])
+        end
+    '''
+
+    def __init__(self, url, ttl=DEFAULT_CACHE_TTL, prefix='sa-invoice:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.set_if_generation = self.client.register_script(self.SET_IF_GENERATION)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(value)
+
+    def get_generations(self, keys):
+        return [int(generation or 0) for generation in self.client.mget([self.prefix + 'generation:' + key for key in keys])]
+
+    def set(self, key, value, generation=None):
+        if generation is None:
+            self.client.setex(self.prefix + key, self.ttl, json.dumps(value))
+        else:
+            self.set_if_generation(keys=[self.prefix + key, self.prefix + 'generation:' + key],
+                                   args=[json.dumps(value), generation, self.ttl])
+
+    def delete(self, *keys):
+        if keys:
+            pipeline = self.client.pipeline()
+            pipeline.delete(*[self.prefix + key for key in keys])
+            for key in keys:
+                # Outlives any value that was read before this delete
+                pipeline.incr(self.prefix + 'generation:' + key)
+                pipeline.expire(self.prefix + 'generation:' + key, self.ttl)
+            pipeline.execute()
+
+    def clear(self):
+        for key in self.client.scan_iter(match=self.prefix + '*'):
+            self.client.delete(key)
+
+    def stats(self):
+        return {'backend': 'redis', 'ttl': self.ttl, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.client.info('stats').get('evicted_keys', 0)}
+
+
+class NullCacheStore:
+
+    def get(self, key):
+        return None
+
+    def get_generations(self, keys):
+        return [0] * len(keys)
+
+    def set(self, key, value, generation=None):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+    def clear(self):
+        pass
+
+    def stats(self):
+        return {'backend': 'null'}
+
+
+class CatalogCache:
+    # Read-through cache for serialized clients and products, configured like the other extensions
+
+    def __init__(self, store=None):
+        self.store = store or MemoryCacheStore()
+
+    def init_app(self, app):
+        backend = app.config.get('CATALOG_CACHE_BACKEND', 'memory')
+        ttl = app.config.get('CATALOG_CACHE_TTL', DEFAULT_CACHE_TTL)
+        if backend == 'redis':
+            self.store = RedisCacheStore(app.config['CATALOG_CACHE_REDIS_URL'], ttl=ttl)
+        elif backend == 'null':
+            self.store = NullCacheStore()
+        else:
+            self.store = MemoryCacheStore(app.config.get('CATALOG_CACHE_SIZE', DEFAULT_CACHE_SIZE), ttl=ttl)
+
+    def get(self, namespace, item_id, load, is_current=None):
+        # is_current tells whether a cached value still matches the database, one that does not is loaded again.
+        # A value loaded while a write deleted the key may predate the write, the generation keeps it out.
+        key = f'{namespace}:{item_id}'
+        value = self.store.get(key)
+        if value is None or (is_current is not None and not is_current(value)):
+            generation, = self.store.get_generations([key])
+            value = load()
+            if value is not None:
+                self.store.set(key, value, generation)
+        return value
+
+    def get_many(self, namespace, item_ids, load_missing, is_current=None):
+        # load_missing receives the ids that missed and returns a dict of the values it found,
+        # is_current(item_id, value) tells whether a cached value still matches the database like for get
+        values = {}
+        missing_ids = []
+        for item_id in item_ids:
+            value = self.store.get(f'{namespace}:{item_id}')
+            if value is None or (is_current is not None and not is_current(item_id, value)):
+                missing_ids.append(item_id)
+            else:
+                values[item_id] = value
+        if missing_ids:
+            keys = [f'{namespace}:{item_id}' for item_id in missing_ids]
+            generations = dict(zip(missing_ids, self.store.get_generations(keys)))
+            loaded = load_missing(missing_ids)
+            for item_id, value in loaded.items():
+                self.store.set(f'{namespace}:{item_id}', value, generations[item_id])
+            values.update(loaded)
+        return values
+
+    def delete(self, namespace, *item_ids):
+        self.store.delete(*[f'{namespace}:{item_id}' for item_id in item_ids])
+
+    def clear(self):
+        self.store.clear()
+
+    def stats(self):
+        return self.store.stats()
+
+
+cache = CatalogCache()
@@ -1,7 +1,8 @@
 from datetime import datetime
-from sqlalchemy import Column, String, Boolean, DateTime
+from sqlalchemy import Column, String, Boolean, DateTime, ForeignKey
 from sqlalchemy.orm import relationship
 from application import db
+from application.versioning import CatalogVersion
 
 
 class Client(db.Model):
@@ -15,3 +16,16 @@ class Client(db.Model):
     created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
     last_updated_at = Column(DateTime, default=datetime.utcnow)
     invoices = relationship('Invoice', backref='client')
+
+
+class ClientVersion(CatalogVersion, db.Model):
+    __tablename__ = 'client_versions'
+    client_id = Column(String, ForeignKey('clients.client_id'), nullable=False)
+    client_name = Column(String, nullable=False)
+    client_tin = Column(String, nullable=False)
+    client_address = Column(String, nullable=False)
+    client_city = Column(String, nullable=False)
+    is_client_taxable = Column(Boolean, nullable=False)
+
+    owner_field = 'client_id'
+    copied_fields = ('client_name', 'client_tin', 'client_address', 'client_city', 'is_client_taxable')
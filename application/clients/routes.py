@@ -1,18 +1,30 @@
-import os
+import json
 from datetime import datetime
 from uuid import uuid4
 
-import jinja2
-from flask import jsonify, request, Blueprint
-from pdfkit import pdfkit
+from flask import jsonify, request, stream_with_context, Blueprint, Response
 
-from definitions import ROOT_DIR
 from .models import Client
-from .schemas import client_schema, clients_schema
-from application import db
+from .schemas import dump_client, dump_clients
+from application import db, SQLITE_MAX_VARIABLE_NUMBER
+from application.cache import cache
+from application.conditional import is_not_modified, not_modified, set_validators, version_etag, with_etag, \
+    without_etag
+from application.importing import IMPORT_CHUNK_SIZE, REQUIRED, get_import_format, import_records, read_records, to_bool, \
+    to_string
+from application.search import search
+from application.serialization import fast_jsonify
 
 clients_api = Blueprint('clients_api', __name__)
 
+CLIENT_IMPORT_FIELDS = (
+    ('client_name', to_string, REQUIRED),
+    ('client_address', to_string, REQUIRED),
+    ('client_city', to_string, REQUIRED),
+    ('client_tin', to_string, REQUIRED),
+    ('is_client_taxable', to_bool, REQUIRED)
+)
+
 
 def insert_client(**args):
     args['client_id'] = uuid4().hex
@@ -21,11 +33,91 @@ def insert_client(**args):
     client = Client(**args)
     db.session.add(client)
     db.session.commit()
+    invalidate_client()
     return client
 
 
-def get_client_by_id(client_id: str):
-    return Client.query.filter_by(client_id=client_id).first()
+def invalidate_client(client_id: str = None):
+    if client_id:
+        cache.delete('client', client_id)
+    cache.delete('client_list', 'all')
+
+
+def load_clients(client_ids):
+    # Resolve every requested client with one IN (...) query per chunk of ids
+    clients = {}
+    for offset in range(0, len(client_ids), SQLITE_MAX_VARIABLE_NUMBER):
+        chunk = client_ids[offset:offset + SQLITE_MAX_VARIABLE_NUMBER]
+        for client in Client.query.filter(Client.client_id.in_(chunk)):
+            clients[client.client_id] = with_etag(dump_client(client), client.last_updated_at)
+    return clients
+
+
+def get_client_by_id(client_id: str, etag):
+    # Returns the serialized client, served from the catalog cache unless the entry is of another version than etag
+    return cache.get('client', client_id, lambda: load_clients([client_id]).get(client_id),
+                     lambda client: client['_etag'] == etag)
+
+
+def load_client_etags(client_ids):
+    # The version of every requested client that exists, one IN (...) query of two columns per chunk of ids
+    etags = {}
+    for offset in range(0, len(client_ids), SQLITE_MAX_VARIABLE_NUMBER):
+        chunk = client_ids[offset:offset + SQLITE_MAX_VARIABLE_NUMBER]
+        query = db.session.query(Client.client_id, Client.last_updated_at).filter(Client.client_id.in_(chunk))
+        for client_id, last_updated_at in query:
+            etags[client_id] = version_etag(last_updated_at) if last_updated_at else None
+    return etags
+
+
+def get_clients_by_ids(client_ids):
+    # Invoices are taxed from these, a cached client of another version than the row's is loaded again
+    unique_ids = list(dict.fromkeys(client_ids))
+    etags = load_client_etags(unique_ids)
+    clients = cache.get_many('client', [client_id for client_id in unique_ids if client_id in etags], load_clients,
+                             lambda client_id, client: client['_etag'] == etags[client_id])
+    missing_ids = [client_id for client_id in unique_ids if client_id not in clients]
+    return clients, missing_ids
+
+
+def validate_client_tins(rows, dryrun_tins=None):
+    # TINs are unique: reject rows repeating a TIN of the same chunk or one already stored, which includes
+    # the chunks imported earlier. A dry run rolls its chunks back, their TINs are collected in dryrun_tins
+    tins = [row['client_tin'] for row in rows]
+    existing = set(dryrun_tins or ())
+    for offset in range(0, len(tins), SQLITE_MAX_VARIABLE_NUMBER):
+        chunk = tins[offset:offset + SQLITE_MAX_VARIABLE_NUMBER]
+        existing.update(tin for tin, in db.session.query(Client.client_tin).filter(Client.client_tin.in_(chunk)))
+    errors, seen = {}, set()
+    for index, tin in enumerate(tins):
+        if tin in existing or tin in seen:
+            errors[index] = [f'client_tin {tin} already exists']
+        seen.add(tin)
+    if dryrun_tins is not None:
+        dryrun_tins.update(seen)
+    return errors
+
+
+def import_clients(records, is_dryrun=False, chunk_size=IMPORT_CHUNK_SIZE):
+    dryrun_tins = set() if is_dryrun else None
+    events = import_records(Client, CLIENT_IMPORT_FIELDS, records, lambda rows: validate_client_tins(rows, dryrun_tins),
+                            is_dryrun, chunk_size)
+    for event in events:
+        if event['event'] == 'done' and event['imported']:
+            invalidate_client()
+        yield event
+
+
+@clients_api.route('import', methods=['POST'])
+def import_clients_file():
+    try:
+        import_format = get_import_format(request)
+        is_dryrun = request.args.get('dryrun').lower() in ('true', '1') if request.args.get('dryrun') else False
+    except Exception as e:
+        return jsonify(status='ERROR', errors=e.args), 400
+    # Progress and row errors are streamed back as NDJSON while the upload is still being read
+    events = import_clients(read_records(request.stream, import_format), is_dryrun)
+    return Response(stream_with_context(json.dumps(event) + '\n' for event in events), mimetype='application/x-ndjson')
 
 
 @clients_api.route('', methods=['POST'])
@@ -33,7 +125,7 @@ def add_client():
     try:
         data = request.get_json()
         client = insert_client(**data)
-        return jsonify(status='SUCCESS', message='Client added successfully!', added_client=client_schema.dump(client)), 201
+        return jsonify(status='SUCCESS', message='Client added successfully!', added_client=dump_client(client)), 201
     except Exception as e:
         db.session.rollback()
         return jsonify(status='ERROR', errors=e.args), 400
@@ -42,9 +134,20 @@ def add_client():
 @clients_api.route('', methods=['GET'])
 def get_clients():
     try:
-        query_result = Client.query.all()
-        clients_list = clients_schema.dump(query_result)
-        return jsonify(clients_list)
+        clients_list = cache.get('client_list', 'all', lambda: dump_clients(Client.query.all()))
+        return fast_jsonify(clients_list)
+    except Exception as e:
+        return jsonify(status='ERROR', errors=e.args), 400
+
+
+@clients_api.route('search', methods=['GET'])
+def search_clients():
+    try:
+        clients, next_offset = search(Client)
+        response = fast_jsonify(dump_clients(clients))
+        if next_offset is not None:
+            response.headers['X-Next-Offset'] = str(next_offset)
+        return response, 200
     except Exception as e:
         return jsonify(status='ERROR', errors=e.args), 400
 
@@ -52,9 +155,16 @@ def get_clients():
 @clients_api.route('<client_id>', methods=['GET'])
 def get_client_details(client_id: str):
     try:
-        row = get_client_by_id(client_id)
-        if row:
-            return jsonify(client_schema.dump(row)), 200
+        # The version is a primary key lookup of one column, a matching ETag is answered without the client
+        version = db.session.query(Client.last_updated_at).filter_by(client_id=client_id).first()
+        etag = version_etag(version.last_updated_at) if version and version.last_updated_at else None
+        if etag and is_not_modified(etag):
+            return not_modified(etag, weak=True)
+        # The cached body is the one the ETag names, or it is loaded again
+        client = get_client_by_id(client_id, etag) if version else None
+        if client:
+            response = fast_jsonify(without_etag(client))
+            return (set_validators(response, etag, weak=True) if etag else response), 200
         else:
             return jsonify(error_code='CLIENT_NOT_FOUND', message='Client not found!'), 404
     except Exception as e:
@@ -64,7 +174,7 @@ def get_client_details(client_id: str):
 @clients_api.route('<client_id>', methods=['PUT'])
 def put_client_details(client_id: str):
     try:
-        row = get_client_by_id(client_id)
+        row = Client.query.filter_by(client_id=client_id).first()
         if row:
             data = request.get_json()
             exclude_columns = ('created_at', 'last_updated_at', 'client_id')
@@ -73,7 +183,8 @@ def put_client_details(client_id: str):
                     setattr(row, column_name, data[column_name])
             setattr(row, 'last_updated_at', datetime.utcnow())
             db.session.commit()
-            return jsonify(status='SUCCESS', message='Client updated successfully!', updated_client=client_schema.dump(row)), 200
+            invalidate_client(client_id)
+            return jsonify(status='SUCCESS', message='Client updated successfully!', updated_client=dump_client(row)), 200
         else:
             return jsonify(status='ERROR', error_code='CLIENT_NOT_FOUND', message='Client not found!'), 404
     except Exception as e:
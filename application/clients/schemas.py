@@ -1,4 +1,6 @@
-from flask_marshmallow import Schema
+from marshmallow import Schema
+
+from application.serialization import make_serializer
 
 
 class ClientSchema(Schema):
@@ -15,3 +17,5 @@ class ClientSchema(Schema):
 
 client_schema = ClientSchema()
 clients_schema = ClientSchema(many=True)
+dump_client = make_serializer(client_schema)
+dump_clients = make_serializer(clients_schema)
@@ -0,0 +1,154 @@
+import json
+import unittest
+
+from application import db
+from application.clients.routes import import_clients
+from tests import AppTest
+
+
+class ClientsTest(AppTest):
+
+    def setUp(self):
+        super().setUp()
+        self.prefix = '/api/clients'
+
+    def create_client(self, client_tin='300000000000003'):
+        return self.test_client.post(f'{self.prefix}', json={
+            "client_name": "Acme Trading",
+            "client_address": "King Fahd Road",
+            "client_city": "Riyadh",
+            "client_tin": client_tin,
+            "is_client_taxable": True
+        })
+
+    def get_client_by_id(self, client_id):
+        return self.test_client.get(f'{self.prefix}/{client_id}')
+
+    def test_index(self):
+        response = self.test_client.get(f'{self.prefix}')
+        self.assertEqual(response.status_code, 200)
+
+    def test_create_client(self):
+        response = self.create_client()
+        self.assertEqual(response.status_code, 201)
+        client_id = response.get_json()['added_client']['client_id']
+        response = self.get_client_by_id(client_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['client_id'], client_id)
+
+    def test_update_invalidates_cached_client(self):
+        client_id = self.create_client().get_json()['added_client']['client_id']
+        self.assertEqual(self.get_client_by_id(client_id).get_json()['client_city'], 'Riyadh')
+        self.assertEqual(len(self.test_client.get(f'{self.prefix}').get_json()), 1)
+        response = self.test_client.put(f'{self.prefix}/{client_id}', json={"client_city": "Jeddah"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_client_by_id(client_id).get_json()['client_city'], 'Jeddah')
+        self.assertEqual(self.test_client.get(f'{self.prefix}').get_json()[0]['client_city'], 'Jeddah')
+        self.create_client(client_tin='300000000000004')
+        self.assertEqual(len(self.test_client.get(f'{self.prefix}').get_json()), 2)
+
+    def search(self, q, **params):
+        return self.test_client.get(f'{self.prefix}/search', query_string={'q': q, **params})
+
+    def test_search_clients(self):
+        client_id = self.create_client().get_json()['added_client']['client_id']
+        self.test_client.post(f'{self.prefix}', json={
+            "client_name": "Riyadh Trading House",
+            "client_address": "Olaya Street",
+            "client_city": "Riyadh",
+            "client_tin": "300000000000004",
+            "is_client_taxable": True
+        })
+        self.assertEqual([client['client_id'] for client in self.search('acm').get_json()], [client_id])
+        self.assertEqual([client['client_tin'] for client in self.search('3000000000000').get_json()],
+                         ['300000000000003', '300000000000004'])
+        # A name match ranks above a city match
+        self.assertEqual(self.search('riyadh').get_json()[0]['client_name'], 'Riyadh Trading House')
+        response = self.search('riyadh', limit=1)
+        self.assertEqual(len(response.get_json()), 1)
+        self.assertEqual(response.headers['X-Next-Offset'], '1')
+        response = self.search('riyadh', limit=1, offset=1)
+        self.assertEqual(response.get_json()[0]['client_name'], 'Acme Trading')
+        self.assertNotIn('X-Next-Offset', response.headers)
+
+        self.test_client.put(f'{self.prefix}/{client_id}', json={"client_name": "Zenith Supplies"})
+        self.assertEqual(self.search('acme').get_json(), [])
+        self.assertEqual(self.search('zen sup').get_json()[0]['client_id'], client_id)
+        self.assertEqual(self.search('"*').status_code, 400)
+        self.assertEqual(self.search('riyadh', limit=-2).status_code, 400)
+        self.assertEqual(self.search('riyadh', offset=-1).status_code, 400)
+
+    def import_clients(self, data, **params):
+        response = self.test_client.post(f'{self.prefix}/import', data=data, content_type='text/csv', query_string=params)
+        return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    def test_import_clients_csv(self):
+        self.create_client('300000000000003')
+        rows = ['client_name,client_address,client_city,client_tin,is_client_taxable']
+        rows += [f'Client {i},Street {i},Riyadh,31{i:013d},{"yes" if i % 2 else "no"}' for i in range(5)]
+        rows += ['Duplicate,Street,Riyadh,310000000000001,true', 'Existing,Street,Riyadh,300000000000003,true',
+                 'Missing TIN,Street,Riyadh,,true', 'Bad flag,Street,Riyadh,319999999999999,maybe']
+        self.test_client.get(f'{self.prefix}')
+        events = self.import_clients('\n'.join(rows) + '\n')
+        errors = {event['line']: event['errors'] for event in events if event['event'] == 'row_error'}
+        self.assertEqual(sorted(errors), [7, 8, 9, 10])
+        self.assertEqual(errors[9], ['client_tin is required'])
+        self.assertEqual(events[-1], {'event': 'done', 'status': 'PARTIAL', 'rows': 9, 'imported': 5, 'failed': 4})
+        clients = self.test_client.get(f'{self.prefix}').get_json()
+        self.assertEqual(len(clients), 6)
+        self.assertEqual(sum(client['is_client_taxable'] for client in clients), 3)
+        self.assertEqual(len(self.search('client').get_json()), 5)
+
+    def test_import_clients_dryrun(self):
+        data = json.dumps({"client_name": "Acme", "client_address": "Street", "client_city": "Riyadh",
+                           "client_tin": "300000000000003", "is_client_taxable": True})
+        response = self.test_client.post(f'{self.prefix}/import', data=data + '\n{not json\n', query_string={'dryrun': 'true'},
+                                         content_type='application/x-ndjson')
+        events = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual(events[0]['line'], 2)
+        self.assertEqual(events[-1]['imported'], 1)
+        self.assertEqual(self.test_client.get(f'{self.prefix}').get_json(), [])
+        self.assertEqual(self.import_clients('', format='xml')[0]['status'], 'ERROR')
+
+    def test_import_clients_dryrun_across_chunks(self):
+        records = [(line, {"client_name": f"Client {line}", "client_address": "Street", "client_city": "Riyadh",
+                           "client_tin": tin, "is_client_taxable": True})
+                   for line, tin in enumerate(('300000000000003', '310000000000003', '300000000000003'), 1)]
+        with self.app.app_context():
+            events = list(import_clients(iter(records), True, chunk_size=2))
+        self.assertEqual([event['line'] for event in events if event['event'] == 'row_error'], [3])
+        self.assertEqual(events[-1], {'event': 'done', 'status': 'PARTIAL', 'rows': 3, 'imported': 2, 'failed': 1})
+        self.assertEqual(self.test_client.get(f'{self.prefix}').get_json(), [])
+
+    def test_get_client_reloads_entry_outdated_by_another_worker(self):
+        client_id = self.create_client().get_json()['added_client']['client_id']
+        etag = self.get_client_by_id(client_id).headers['ETag']
+        # Another worker's PUT leaves this worker's cache entry in place
+        with self.app.app_context():
+            db.engine.execute("UPDATE clients SET client_city = 'Jeddah', last_updated_at = '2030-01-01 00:00:00.000000' "
+                              "WHERE client_id = ?", client_id)
+        response = self.get_client_by_id(client_id)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.get_json()['client_city'], 'Jeddah')
+        self.assertNotIn('_etag', response.get_json())
+
+    def test_conditional_get_client(self):
+        client_id = self.create_client().get_json()['added_client']['client_id']
+        etag = self.get_client_by_id(client_id).headers['ETag']
+        self.assertTrue(etag.startswith('W/"v'))
+        response = self.test_client.get(f'{self.prefix}/{client_id}', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.test_client.put(f'{self.prefix}/{client_id}', json={"client_city": "Jeddah"})
+        response = self.test_client.get(f'{self.prefix}/{client_id}', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['client_city'], 'Jeddah')
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_unknown_client(self):
+        response = self.get_client_by_id('SOME_RANDOM_ID')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.get_json()['error_code'], 'CLIENT_NOT_FOUND')
+
+
+if __name__ == '__main__':
+    unittest.main()
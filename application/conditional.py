@@ -0,0 +1,38 @@
+from flask import current_app, request
+
+
+def version_etag(last_updated_at):
+    # Clients and products change in place, their version is the time of the last update
+    return last_updated_at.strftime('v%Y%m%d%H%M%S%f')
+
+
+def with_etag(entry, last_updated_at):
+    # A catalog cache entry carries the ETag of the row it was dumped from. A worker's cache only sees its
+    # own invalidations, so GET and invoice pricing compare it with the row's and reload an entry outdated
+    # by another worker.
+    entry['_etag'] = version_etag(last_updated_at) if last_updated_at else None
+    return entry
+
+
+def without_etag(entry):
+    return {name: value for name, value in entry.items() if name != '_etag'}
+
+
+def is_not_modified(etag, last_modified=None):
+    # If-None-Match takes precedence over If-Modified-Since; GET compares ETags weakly
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if last_modified is not None and request.if_modified_since is not None:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+def set_validators(response, etag, last_modified=None, weak=False):
+    response.set_etag(etag, weak)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
+def not_modified(etag, last_modified=None, weak=False):
+    return set_validators(current_app.response_class(status=304), etag, last_modified, weak)
@@ -0,0 +1,107 @@
+import hashlib
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import current_app, g, jsonify, request
+from sqlalchemy import Column, DateTime, Integer, String, Text, bindparam, text
+
+from application import db
+
+IDEMPOTENCY_KEY_HEADER = 'Idempotency-Key'
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+DEFAULT_IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+
+# Takes over an expired key, leaves a live one alone; either way a single statement
+CLAIM_KEY = text('''
+INSERT INTO idempotency_keys (idempotency_key, fingerprint, created_at, expires_at)
+VALUES (:idempotency_key, :fingerprint, :created_at, :expires_at)
+ON CONFLICT (idempotency_key) DO UPDATE SET fingerprint = excluded.fingerprint, status_code = NULL,
+    response_body = NULL, created_at = excluded.created_at, expires_at = excluded.expires_at
+WHERE idempotency_keys.expires_at <= excluded.created_at
+''').bindparams(bindparam('created_at', type_=DateTime), bindparam('expires_at', type_=DateTime))
+
+
+class IdempotencyKey(db.Model):
+    # Responses of requests sent with an Idempotency-Key header, replayed to retries until they expire
+    __tablename__ = 'idempotency_keys'
+
+    idempotency_key = Column(String, primary_key=True)
+    fingerprint = Column(String, nullable=False)
+    status_code = Column(Integer)
+    response_body = Column(Text)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+
+def request_fingerprint():
+    # The same key with a different method, URL or body is a client bug, not a retry
+    digest = hashlib.sha256(f'{request.method} {request.full_path}\n'.encode())
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+def find_key(idempotency_key):
+    row = db.session.query(IdempotencyKey.fingerprint, IdempotencyKey.status_code, IdempotencyKey.response_body) \
+        .filter(IdempotencyKey.idempotency_key == idempotency_key, IdempotencyKey.expires_at > datetime.utcnow()).first()
+    return row
+
+
+def replay_response(row):
+    if row.fingerprint != g.idempotency_fingerprint:
+        return jsonify(status='ERROR', error_code='IDEMPOTENCY_KEY_REUSED',
+                       message='Idempotency key was already used for a different request!'), 422
+    response = current_app.response_class(row.response_body, status=row.status_code, mimetype='application/json')
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(view):
+    # Answers a retry with the stored response before the view does any work. Only successful responses
+    # are stored, so a request that failed can be fixed and sent again with the same key.
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        idempotency_key = request.headers.get(IDEMPOTENCY_KEY_HEADER)
+        if idempotency_key is None:
+            return view(*args, **kwargs)
+        if not 0 < len(idempotency_key) <= MAX_IDEMPOTENCY_KEY_LENGTH:
+            return jsonify(status='ERROR', errors=[f'{IDEMPOTENCY_KEY_HEADER} must be 1 to {MAX_IDEMPOTENCY_KEY_LENGTH} characters']), 400
+        g.idempotency_key = idempotency_key
+        g.idempotency_fingerprint = request_fingerprint()
+        row = find_key(idempotency_key)
+        if row is not None:
+            return replay_response(row)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def claim_idempotency_key():
+    """
+    Records the request's key as the first write of the view's transaction and returns None, or rolls back
+    and returns the response to replay when a concurrent duplicate got there first.
+
+    The insert waits for SQLite's write lock, so a duplicate sent while the first request is still running
+    blocks until that request commits and then finds its key, without any polling or extra lock.
+    """
+    if 'idempotency_key' not in g:
+        return None
+    now = datetime.utcnow()
+    ttl = current_app.config.get('IDEMPOTENCY_KEY_TTL', DEFAULT_IDEMPOTENCY_KEY_TTL)
+    params = {'idempotency_key': g.idempotency_key, 'fingerprint': g.idempotency_fingerprint,
+              'created_at': now, 'expires_at': now + timedelta(seconds=ttl)}
+    if db.session.execute(CLAIM_KEY, params).rowcount == 0:
+        db.session.rollback()
+        return replay_response(find_key(g.idempotency_key))
+    return None
+
+
+def save_idempotent_response(response, status_code):
+    # Called before the view commits, so the key and its response are committed together with the writes
+    if 'idempotency_key' in g:
+        db.session.query(IdempotencyKey).filter(IdempotencyKey.idempotency_key == g.idempotency_key) \
+            .update({'status_code': status_code, 'response_body': response.get_data(as_text=True)}, synchronize_session=False)
+
+
+def purge_expired_keys():
+    deleted = IdempotencyKey.query.filter(IdempotencyKey.expires_at <= datetime.utcnow()).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
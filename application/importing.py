@@ -0,0 +1,149 @@
+import csv
+import io
+import json
+import math
+from datetime import datetime
+from itertools import islice
+from uuid import uuid4
+
+from application import db
+
+IMPORT_FORMATS = ('csv', 'ndjson')
+# Every chunk is its own transaction, so a 100k row file takes 100
+IMPORT_CHUNK_SIZE = 1000
+REQUIRED = object()
+
+
+def to_string(value):
+    if isinstance(value, (bool, dict, list)):
+        raise ValueError
+    value = str(value).strip()
+    if not value:
+        raise ValueError
+    return value
+
+
+def to_float(value):
+    if isinstance(value, bool):
+        raise ValueError
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError
+    return value
+
+
+def to_bool(value):
+    if isinstance(value, bool):
+        return value
+    value = str(value).strip().lower()
+    if value in ('true', '1', 'yes'):
+        return True
+    if value in ('false', '0', 'no'):
+        return False
+    raise ValueError
+
+
+def get_import_format(request):
+    # ?format= wins over the content type, anything that is not CSV is read as NDJSON
+    import_format = request.args.get('format')
+    if import_format is None:
+        import_format = 'csv' if request.mimetype in ('text/csv', 'application/csv') else 'ndjson'
+    if import_format not in IMPORT_FORMATS:
+        raise ValueError(f'Import format must be one of {", ".join(IMPORT_FORMATS)}')
+    return import_format
+
+
+def read_records(stream, import_format):
+    # Yields (line, record) one at a time from a binary stream; a line that does not parse is
+    # yielded as the exception so it is reported like any other bad row
+    if import_format == 'csv':
+        reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for line, text in enumerate(io.TextIOWrapper(stream, encoding='utf-8-sig'), 1):
+        if not text.strip():
+            continue
+        try:
+            yield line, json.loads(text)
+        except ValueError as e:
+            yield line, e
+
+
+def convert_record(record, fields):
+    # Returns the column values and a list of errors for one record
+    if isinstance(record, Exception):
+        return None, [f'Invalid JSON: {record}']
+    if not isinstance(record, dict):
+        return None, ['Row must be an object']
+    values, errors = {}, []
+    for name, convert, default in fields:
+        value = record.get(name)
+        if value is None or value == '':
+            if default is REQUIRED:
+                errors.append(f'{name} is required')
+            else:
+                values[name] = default
+            continue
+        try:
+            values[name] = convert(value)
+        except (TypeError, ValueError):
+            errors.append(f'{name} has an invalid value: {value!r}')
+    return values, errors
+
+
+def import_records(model, fields, records, validate_chunk=None, is_dryrun=False, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    Inserts `records` into `model`'s table and yields progress, per-row errors and a final summary as dicts.
+
+    Only one chunk of rows is held at a time. `validate_chunk(rows)` may return {index: [errors]} for rows
+    that are valid on their own but clash with each other or with the table. Each chunk is read and
+    validated before its insert and committed right after it, so SQLite's write lock is never held while
+    the upload is read. A dry run inserts each chunk in a savepoint and rolls it back.
+    """
+    table = model.__table__
+    primary_key = table.primary_key.columns.values()[0].name
+    summary = {'rows': 0, 'imported': 0, 'failed': 0}
+    committed = 0
+    try:
+        while True:
+            chunk = list(islice(records, chunk_size))
+            if not chunk:
+                break
+            now = datetime.utcnow()
+            rows, lines = [], []
+            for line, record in chunk:
+                values, errors = convert_record(record, fields)
+                if errors:
+                    summary['failed'] += 1
+                    yield {'event': 'row_error', 'line': line, 'errors': errors}
+                    continue
+                values[primary_key] = uuid4().hex
+                values['created_at'] = values['last_updated_at'] = now
+                rows.append(values)
+                lines.append(line)
+            if validate_chunk and rows:
+                chunk_errors = validate_chunk(rows)
+                for index in sorted(chunk_errors):
+                    summary['failed'] += 1
+                    yield {'event': 'row_error', 'line': lines[index], 'errors': chunk_errors[index]}
+                rows = [row for index, row in enumerate(rows) if index not in chunk_errors]
+            if rows:
+                # One executemany per chunk; the search index triggers run inside the same statement
+                savepoint = db.session.begin_nested() if is_dryrun else None
+                db.session.execute(table.insert(), rows)
+                if savepoint:
+                    savepoint.rollback()
+                summary['imported'] += len(rows)
+            db.session.commit()
+            if not is_dryrun:
+                committed = summary['imported']
+            summary['rows'] += len(chunk)
+            yield dict(event='progress', **summary)
+    except Exception as e:
+        # Rows of earlier chunks stay imported, the summary counts only those
+        db.session.rollback()
+        summary['imported'] = committed
+        yield dict(event='done', status='ERROR', errors=[str(arg) for arg in e.args], **summary)
+        return
+    yield dict(event='done', status='SUCCESS' if not summary['failed'] else 'PARTIAL', **summary)
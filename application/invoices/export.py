@@ -0,0 +1,119 @@
+import json
+import os
+import time
+import zipfile
+from collections import deque
+from tempfile import SpooledTemporaryFile
+
+from application.invoices.numbering import format_invoice_number
+from application.invoices.rendering import get_cached_pdf_path, get_render_job_id, submit_render_job
+
+EXPORT_CHUNK_SIZE = 64 * 1024
+MAX_PDF_MEMORY_SIZE = 16 * 1024 * 1024
+
+
+class ExportReport:
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.invoice_count = 0
+        self.rendered_count = 0
+        self.failed_invoices = []
+
+    @property
+    def elapsed_seconds(self):
+        return time.perf_counter() - self.started_at
+
+    @property
+    def invoices_per_second(self):
+        elapsed = self.elapsed_seconds
+        return self.invoice_count / elapsed if elapsed > 0 else 0.0
+
+    def to_dict(self):
+        return {
+            'invoice_count': self.invoice_count,
+            'rendered_count': self.rendered_count,
+            'failed_invoices': self.failed_invoices,
+            'elapsed_seconds': round(self.elapsed_seconds, 3),
+            'invoices_per_second': round(self.invoices_per_second, 2)
+        }
+
+
+class _StreamBuffer:
+    # Write-only file object for zipfile, drained into the response after every entry
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def render_invoices(invoices, template_name, render_html, report, window):
+    # Keep up to `window` renders in flight on the pool and yield finished PDFs in invoice order
+    pending = deque()
+    for invoice in invoices:
+        job_id = get_render_job_id(invoice.invoice_id, template_name)
+        filepath = get_cached_pdf_path(job_id)
+        future = None
+        if not os.path.exists(filepath):
+            future = submit_render_job(job_id, lambda invoice=invoice: render_html(invoice))
+            report.rendered_count += 1
+        pending.append((invoice.invoice_id, format_invoice_number(invoice), filepath, future))
+        if len(pending) >= window:
+            yield from _finish(pending.popleft(), report)
+    while pending:
+        yield from _finish(pending.popleft(), report)
+
+
+def _finish(entry, report):
+    invoice_id, invoice_number, filepath, future = entry
+    try:
+        if future is not None:
+            future.result()
+    except Exception as e:
+        report.failed_invoices.append({'invoice_id': invoice_id, 'errors': [str(arg) for arg in e.args]})
+        return
+    report.invoice_count += 1
+    yield invoice_number, filepath
+
+
+def stream_zip(rendered_invoices, report):
+    buffer = _StreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for invoice_number, filepath in rendered_invoices:
+            archive.write(filepath, f'invoice_{invoice_number}.pdf')
+            yield buffer.drain()
+        archive.writestr('export_report.json', json.dumps(report.to_dict(), indent=2))
+    yield buffer.drain()
+
+
+def stream_merged_pdf(rendered_invoices):
+    # The cross-reference table of a PDF comes last, so parts are merged as they finish
+    # and the document is sent once the final part has been appended. PyPDF2 is only needed here.
+    from PyPDF2 import PdfFileMerger
+    merger = PdfFileMerger(strict=False)
+    part_files = []
+    try:
+        for _, filepath in rendered_invoices:
+            part_file = open(filepath, 'rb')
+            part_files.append(part_file)
+            merger.append(part_file)
+        with SpooledTemporaryFile(max_size=MAX_PDF_MEMORY_SIZE) as merged_file:
+            merger.write(merged_file)
+            merged_file.seek(0)
+            for chunk in iter(lambda: merged_file.read(EXPORT_CHUNK_SIZE), b''):
+                yield chunk
+    finally:
+        merger.close()
+        for part_file in part_files:
+            part_file.close()
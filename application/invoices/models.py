@@ -1,36 +1,57 @@
 from datetime import datetime
-from sqlalchemy import Column, String, ForeignKey, DateTime, Float, Integer
+from sqlalchemy import Column, String, ForeignKey, DateTime, Float, Integer, Index
 from sqlalchemy.orm import relationship
 from application import db
+from application.clients.models import ClientVersion
+from application.products.models import ProductVersion
+from application.versioning import copied_column
 
 
 class Invoice(db.Model):
     __tablename__ = 'invoices'
+    __table_args__ = (
+        Index('ix_invoices_client_id_created_at', 'client_id', 'created_at'),
+        Index('ix_invoices_series_year_sequence', 'invoice_series', 'invoice_year', 'sequence_number', unique=True),
+        Index('ix_invoices_client_version_id', 'client_version_id'),
+    )
 
     invoice_id = Column(String, unique=True)
     invoice_number = Column(Integer, primary_key=True, autoincrement=True)
+    # Gapless number per series and year, allocated by application.invoices.numbering
+    invoice_series = Column(String, nullable=False, default='INV')
+    invoice_year = Column(Integer)
+    sequence_number = Column(Integer)
     client_id = Column(String, ForeignKey('clients.client_id'))
     invoice_items = relationship('InvoiceItem', backref='invoice')
-    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
     invoice_gross_amount = Column(Float, nullable=False)
     total_discount_amount = Column(Float, nullable=False)
     total_tax_amount = Column(Float, nullable=False)
     invoice_net_amount = Column(Float, nullable=False)
 
-    # Copy these fields from Client details as they ar subject to change
-    client_name = Column(String, nullable=False)
-    client_tin = Column(String, nullable=False)
-    client_address = Column(String, nullable=False)
-    client_city = Column(String, nullable=False)
-    is_client_taxable = Column(String, nullable=False)
+    # Client details are subject to change, the invoice keeps the version it was issued to
+    client_version_id = Column(Integer, ForeignKey('client_versions.version_id'))
+    client_name = copied_column(ClientVersion, client_version_id, 'client_name')
+    client_tin = copied_column(ClientVersion, client_version_id, 'client_tin')
+    client_address = copied_column(ClientVersion, client_version_id, 'client_address')
+    client_city = copied_column(ClientVersion, client_version_id, 'client_city')
+    is_client_taxable = copied_column(ClientVersion, client_version_id, 'is_client_taxable')
+
+
+class InvoiceSequence(db.Model):
+    __tablename__ = 'invoice_sequences'
+
+    series = Column(String, primary_key=True)
+    year = Column(Integer, primary_key=True)
+    next_number = Column(Integer, nullable=False)
 
 
 class InvoiceItem(db.Model):
     __tablename__ = 'invoice_items'
 
     invoice_item_id = Column(String, primary_key=True)
-    product_id = Column(String, ForeignKey('products.product_id'))
-    invoice_id = Column(String, ForeignKey('invoices.invoice_id'))
+    product_id = Column(String, ForeignKey('products.product_id'), index=True)
+    invoice_id = Column(String, ForeignKey('invoices.invoice_id'), index=True)
     product_quantity = Column(Float, nullable=False)
     total_price = Column(Float, nullable=False)
     markup_amount = Column(Float, nullable=False)
@@ -40,10 +61,12 @@ class InvoiceItem(db.Model):
     vat_amount = Column(Float, nullable=False)
     net_amount = Column(Float, nullable=False)
 
-    # Copy these fields from Product details as they ar subject to change
-    product_name = Column(String, nullable=False)
-    product_price = Column(Float, nullable=False)
-    product_price_currency = Column(String, nullable=False)
     product_discount_percent = Column(Float, nullable=False)
     product_markup_percent = Column(Float, nullable=False)
-    product_vat_percent = Column(Float, nullable=False)
\ No newline at end of file
+
+    # Product details are subject to change, the line keeps the version it was priced with
+    product_version_id = Column(Integer, ForeignKey('product_versions.version_id'))
+    product_name = copied_column(ProductVersion, product_version_id, 'product_name')
+    product_price = copied_column(ProductVersion, product_version_id, 'product_price')
+    product_price_currency = copied_column(ProductVersion, product_version_id, 'product_price_currency')
+    product_vat_percent = copied_column(ProductVersion, product_version_id, 'product_vat_percent')
\ No newline at end of file
@@ -0,0 +1,81 @@
+import re
+import threading
+
+from flask import current_app
+
+from application import db
+
+DEFAULT_INVOICE_SERIES = 'INV'
+INVOICE_SERIES_PATTERN = re.compile(r'^[A-Z0-9]{1,10}$')
+
+RESERVE_NUMBERS = '''
+INSERT INTO invoice_sequences (series, year, next_number) VALUES (:series, :year, 1 + :count)
+ON CONFLICT (series, year) DO UPDATE SET next_number = next_number + :count
+'''
+NEXT_NUMBER = 'SELECT next_number FROM invoice_sequences WHERE series = :series AND year = :year'
+
+_blocks = {}
+_blocks_lock = threading.Lock()
+
+
+def is_valid_series(series):
+    return isinstance(series, str) and bool(INVOICE_SERIES_PATTERN.match(series))
+
+
+def format_invoice_number(invoice):
+    # The number printed on the invoice; invoice_number itself is only the row id and may have gaps
+    if invoice.sequence_number is None:
+        return str(invoice.invoice_number).zfill(8)
+    return f'{invoice.invoice_series}-{invoice.invoice_year}-{invoice.sequence_number:06d}'
+
+
+def reserve_numbers(connection, series, year, count):
+    # The upsert takes SQLite's write lock, so nobody else can reserve until this transaction ends
+    params = {'series': series, 'year': year, 'count': count}
+    connection.execute(RESERVE_NUMBERS, params)
+    return connection.execute(NEXT_NUMBER, params).scalar() - count
+
+
+def get_block_size(series):
+    return current_app.config.get('INVOICE_SEQUENCE_BLOCK_SIZES', {}).get(series)
+
+
+def allocate_invoice_numbers(series, year, count=1):
+    # Returns the first of `count` consecutive numbers
+    block_size = get_block_size(series)
+    if not block_size:
+        # Gapless: reserved on the session's transaction, so the numbers are committed with the invoices
+        # or handed back by the rollback
+        return reserve_numbers(db.session, series, year, count)
+
+    # Series that allow gaps reserve a block in a transaction of its own and hand it out from memory.
+    # Numbers left in a block when the process exits, or used by a rolled back invoice, are skipped.
+    with _blocks_lock:
+        next_number, end = _blocks.get((series, year), (0, 0))
+        if end - next_number < count:
+            size = max(block_size, count)
+            with db.engine.begin() as connection:
+                next_number = reserve_numbers(connection, series, year, size)
+            end = next_number + size
+        _blocks[(series, year)] = (next_number + count, end)
+        return next_number
+
+
+def assign_invoice_numbers(invoices, gapless):
+    """
+    Numbers the invoices of gapless series, or with gapless=False those of series that allow gaps.
+    invoices are dicts with invoice_series and created_at; numbers follow the order of the list.
+
+    A block is reserved on a connection of its own, which waits for SQLite's write lock like any other
+    writer: number the series that allow gaps before the session's first write, or the request waits
+    for its own lock until busy_timeout.
+    """
+    groups = {}
+    for invoice in invoices:
+        if (not get_block_size(invoice['invoice_series'])) == gapless:
+            invoice['invoice_year'] = invoice['created_at'].year
+            groups.setdefault((invoice['invoice_series'], invoice['invoice_year']), []).append(invoice)
+    for (series, year), group in sorted(groups.items()):
+        first_number = allocate_invoice_numbers(series, year, len(group))
+        for offset, invoice in enumerate(group):
+            invoice['sequence_number'] = first_number + offset
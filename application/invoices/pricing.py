@@ -0,0 +1,156 @@
+import numbers
+from decimal import Decimal, ROUND_HALF_UP, localcontext
+
+import numpy as np
+
+# Amounts are computed in halalas (1/100 SAR), quantities in thousandths and percents in hundredths
+# of a percent. Every step rounds half away from zero, like ROUND_HALF_UP in the decimal module.
+CURRENCY_SCALE = 100
+QUANTITY_SCALE = 1000
+PERCENT_SCALE = 100
+PERCENT_DENOMINATOR = 100 * PERCENT_SCALE
+MAX_INTERMEDIATE = 2 ** 61
+
+LINE_AMOUNTS = (
+    'total_price',
+    'markup_amount',
+    'gross_amount',
+    'discount_amount',
+    'amount_after_discount',
+    'vat_amount',
+    'net_amount'
+)
+INVOICE_TOTALS = {
+    'invoice_gross_amount': 'gross_amount',
+    'total_discount_amount': 'discount_amount',
+    'total_tax_amount': 'vat_amount',
+    'invoice_net_amount': 'net_amount'
+}
+
+
+def is_number(value):
+    return isinstance(value, numbers.Real) and not isinstance(value, bool)
+
+
+def to_scaled(values, scale: int, name: str):
+    values = np.asarray(values)
+    # Converted to float64, None would be NaN and '2' would be 2.0
+    if values.dtype.kind not in 'iuf' and not all(is_number(value) for value in values.flat):
+        raise ValueError(f'{name} must be a number')
+    values = values.astype(np.float64)
+    if not np.all(np.isfinite(values)):
+        raise ValueError(f'{name} must be a finite number')
+    raw = values * scale
+    scaled = np.rint(raw)
+    if not np.all(np.abs(raw - scaled) <= np.maximum(1e-6, 4 * np.spacing(np.abs(raw)))):
+        raise ValueError(f'{name} has more than {len(str(scale)) - 1} decimal places')
+    return scaled.astype(np.int64)
+
+
+def multiply(a, b):
+    if np.any(np.abs(np.asarray(a, dtype=np.float64) * b) >= MAX_INTERMEDIATE):
+        raise OverflowError('Invoice amount is too large')
+    return a * b
+
+
+def divide_half_up(numerator, denominator: int):
+    return np.sign(numerator) * ((2 * np.abs(numerator) + denominator) // (2 * denominator))
+
+
+def price_lines(prices, quantities, markup_percents, discount_percents, vat_percents, is_taxable):
+    prices = to_scaled(prices, CURRENCY_SCALE, 'product_price')
+    quantities = to_scaled(quantities, QUANTITY_SCALE, 'product_quantity')
+    markup_percents = to_scaled(markup_percents, PERCENT_SCALE, 'product_markup_percent')
+    discount_percents = to_scaled(discount_percents, PERCENT_SCALE, 'product_discount_percent')
+    vat_percents = to_scaled(vat_percents, PERCENT_SCALE, 'product_vat_percent')
+    vat_percents = np.where(np.asarray(is_taxable, dtype=bool), vat_percents, 0)
+
+    total_price = divide_half_up(multiply(prices, quantities), QUANTITY_SCALE)
+    markup_amount = divide_half_up(multiply(total_price, markup_percents), PERCENT_DENOMINATOR)
+    gross_amount = total_price + markup_amount
+    discount_amount = divide_half_up(multiply(gross_amount, discount_percents), PERCENT_DENOMINATOR)
+    amount_after_discount = gross_amount - discount_amount
+    vat_amount = divide_half_up(multiply(amount_after_discount, vat_percents), PERCENT_DENOMINATOR)
+    net_amount = amount_after_discount + vat_amount
+    return {
+        'total_price': total_price,
+        'markup_amount': markup_amount,
+        'gross_amount': gross_amount,
+        'discount_amount': discount_amount,
+        'amount_after_discount': amount_after_discount,
+        'vat_amount': vat_amount,
+        'net_amount': net_amount
+    }
+
+
+def sum_per_invoice(line_amounts, line_counts):
+    # Lines of one invoice are contiguous, every invoice has at least one line
+    offsets = np.concatenate(([0], np.cumsum(line_counts)[:-1])).astype(np.intp)
+    return {
+        total_name: np.add.reduceat(line_amounts[amount_name], offsets)
+        for total_name, amount_name in INVOICE_TOTALS.items()
+    }
+
+
+def to_major_units(amounts):
+    return (np.asarray(amounts) / CURRENCY_SCALE).tolist()
+
+
+def price_invoices(items, line_counts, is_taxable):
+    # items holds the lines of all invoices back to back, line_counts and is_taxable are per invoice
+    line_taxable = np.repeat(np.asarray(is_taxable, dtype=bool), line_counts)
+    line_amounts = price_lines(
+        [item['product_price'] for item in items],
+        [item['product_quantity'] for item in items],
+        [item['product_markup_percent'] for item in items],
+        [item['product_discount_percent'] for item in items],
+        [item['product_vat_percent'] for item in items],
+        line_taxable
+    )
+    totals = sum_per_invoice(line_amounts, line_counts)
+    return {name: to_major_units(values) for name, values in line_amounts.items()}, \
+        {name: to_major_units(values) for name, values in totals.items()}
+
+
+def price_invoice(items, is_client_taxable):
+    line_amounts, totals = price_invoices(items, [len(items)], [is_client_taxable])
+    return [{name: line_amounts[name][i] for name in LINE_AMOUNTS} for i in range(len(items))], \
+        {name: values[0] for name, values in totals.items()}
+
+
+def _to_decimal(value, scale: int, name: str):
+    scaled = Decimal(repr(float(value))) * scale
+    if scaled != scaled.to_integral_value():
+        raise ValueError(f'{name} has more than {len(str(scale)) - 1} decimal places')
+    return int(scaled)
+
+
+def _divide_half_up_reference(numerator: int, denominator: int):
+    return int((Decimal(numerator) / Decimal(denominator)).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def price_line_reference(price, quantity, markup_percent, discount_percent, vat_percent, is_taxable):
+    # One line at a time with the decimal module, the specification price_lines is tested against
+    with localcontext() as context:
+        context.prec = 50
+        price = _to_decimal(price, CURRENCY_SCALE, 'product_price')
+        quantity = _to_decimal(quantity, QUANTITY_SCALE, 'product_quantity')
+        markup_percent = _to_decimal(markup_percent, PERCENT_SCALE, 'product_markup_percent')
+        discount_percent = _to_decimal(discount_percent, PERCENT_SCALE, 'product_discount_percent')
+        vat_percent = _to_decimal(vat_percent, PERCENT_SCALE, 'product_vat_percent') if is_taxable else 0
+
+        total_price = _divide_half_up_reference(price * quantity, QUANTITY_SCALE)
+        markup_amount = _divide_half_up_reference(total_price * markup_percent, PERCENT_DENOMINATOR)
+        gross_amount = total_price + markup_amount
+        discount_amount = _divide_half_up_reference(gross_amount * discount_percent, PERCENT_DENOMINATOR)
+        amount_after_discount = gross_amount - discount_amount
+        vat_amount = _divide_half_up_reference(amount_after_discount * vat_percent, PERCENT_DENOMINATOR)
+        return {
+            'total_price': total_price,
+            'markup_amount': markup_amount,
+            'gross_amount': gross_amount,
+            'discount_amount': discount_amount,
+            'amount_after_discount': amount_after_discount,
+            'vat_amount': vat_amount,
+            'net_amount': amount_after_discount + vat_amount
+        }
@@ -0,0 +1,211 @@
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from flask import current_app
+
+from application.invoices.templating import template_dir
+from application.metrics import metrics
+from definitions import ROOT_DIR
+
+pdf_dir = os.path.join(ROOT_DIR, 'pdf')
+wkhtmltopdf_path = '/app/bin/wkhtmltopdf' if 'DYNO' in os.environ else None
+
+DEFAULT_RENDER_WORKERS = 2
+DEFAULT_PDF_RENDERER = 'wkhtmltopdf'
+MAX_FAILED_JOBS = 1000
+# Part of every cached PDF's address: bump it whenever a change to the rendering code changes the PDFs,
+# such as how invoice numbers are formatted, so the old ones are no longer served
+RENDER_VERSION = 1
+
+_executor = None
+_jobs = {}
+# Errors of the latest failed jobs, reported by their status until the PDF is submitted again
+_failed_jobs = OrderedDict()
+_jobs_lock = threading.Lock()
+_template_hashes = {}
+
+
+def get_template_hash(template_name: str):
+    path = os.path.join(template_dir, template_name)
+    mtime = os.path.getmtime(path)
+    cached = _template_hashes.get(template_name)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path, 'rb') as template_file:
+        digest = hashlib.sha256(template_file.read()).hexdigest()
+    _template_hashes[template_name] = (mtime, digest)
+    return digest
+
+
+def get_render_job_id(invoice_id: str, template_name: str):
+    # Invoices are immutable, so the invoice, the template, the renderer and the render code fully address the PDF
+    renderer_name = current_app.config.get('PDF_RENDERER', DEFAULT_PDF_RENDERER)
+    digest = hashlib.sha256(f'{get_template_hash(template_name)} {renderer_name} {RENDER_VERSION}'.encode()).hexdigest()
+    return f'{invoice_id}-{digest[:16]}'
+
+
+def is_valid_render_job_id(job_id: str):
+    return job_id.replace('-', '').isalnum()
+
+
+def get_cached_pdf_path(job_id: str):
+    return os.path.join(pdf_dir, f'{job_id}.pdf')
+
+
+class WkhtmltopdfRenderer:
+    # Starts one wkhtmltopdf process per PDF. pdfkit is only imported by the pool processes that render.
+
+    def __init__(self):
+        import pdfkit
+        self.pdfkit = pdfkit
+        self.configuration = pdfkit.configuration(wkhtmltopdf=wkhtmltopdf_path) if wkhtmltopdf_path else None
+
+    def render(self, html: str, filepath: str):
+        self.pdfkit.from_string(html, filepath, configuration=self.configuration)
+
+
+class WeasyPrintRenderer:
+    # Renders inside the pool process. WeasyPrint parses its default stylesheets on import and the
+    # instance lives as long as the process, so fonts and stylesheets stay loaded between renders
+
+    def __init__(self):
+        from weasyprint import HTML
+        from weasyprint.fonts import FontConfiguration
+        self.html_class = HTML
+        self.font_config = FontConfiguration()
+
+    def render(self, html: str, filepath: str):
+        self.html_class(string=html, base_url=template_dir).write_pdf(filepath, font_config=self.font_config)
+
+
+PDF_RENDERERS = {
+    'wkhtmltopdf': WkhtmltopdfRenderer,
+    'weasyprint': WeasyPrintRenderer
+}
+
+_renderers = {}
+
+
+def get_renderer(name: str):
+    # One renderer per backend and process, created on first use
+    renderer = _renderers.get(name)
+    if renderer is None:
+        renderer = _renderers[name] = PDF_RENDERERS[name]()
+    return renderer
+
+
+def render_pdf(html: str, filepath: str, renderer_name=DEFAULT_PDF_RENDERER):
+    # Runs inside a pool process; write to a private file first so readers never see a partial PDF
+    tmp_filepath = f'{filepath}.{os.getpid()}.tmp'
+    get_renderer(renderer_name).render(html, tmp_filepath)
+    os.replace(tmp_filepath, filepath)
+    return filepath
+
+
+async def run_wkhtmltopdf(html: str, filepath: str):
+    # Event loop counterpart of WkhtmltopdfRenderer and render_pdf: the subprocess is awaited, so a render
+    # holds neither a thread nor a pool process while wkhtmltopdf runs. Same arguments as pdfkit uses.
+    tmp_filepath = f'{filepath}.{os.getpid()}.{id(html)}.tmp'
+    process = await asyncio.create_subprocess_exec(
+        wkhtmltopdf_path or 'wkhtmltopdf', '--quiet', '-', tmp_filepath,
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    stdout, stderr = await process.communicate(html.encode('utf-8'))
+    if process.returncode != 0:
+        raise IOError(f'wkhtmltopdf exited with non-zero code {process.returncode}. error:\n'
+                      f'{(stderr or stdout).decode("utf-8", "replace")}')
+    os.replace(tmp_filepath, filepath)
+    return filepath
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        max_workers = current_app.config.get('PDF_RENDER_WORKERS', DEFAULT_RENDER_WORKERS)
+        _executor = ProcessPoolExecutor(max_workers=max_workers)
+    return _executor
+
+
+def start_pool_render(html: str, filepath: str, renderer_name: str):
+    global _executor
+    try:
+        return get_executor().submit(render_pdf, html, filepath, renderer_name)
+    except BrokenProcessPool:
+        # A pool process died (a wkhtmltopdf crash, an OOM kill) and took the pool with it. The jobs it held
+        # have failed, this and later ones go to a new pool.
+        _executor.shutdown(wait=False)
+        _executor = None
+        return get_executor().submit(render_pdf, html, filepath, renderer_name)
+
+
+def _active_job(job_id: str):
+    future = _jobs.get(job_id)
+    if future is not None and not (future.done() and future.exception() is not None):
+        return future
+    return None
+
+
+def submit_render_job(job_id: str, render_html, start_render=start_pool_render):
+    # render_html is only called when no job for this PDF is queued or running already. start_render returns
+    # the job's concurrent.futures.Future, the ASGI app passes one that renders on its event loop.
+    with _jobs_lock:
+        future = _active_job(job_id)
+    if future is not None:
+        return future
+    os.makedirs(pdf_dir, exist_ok=True)
+    renderer_name = current_app.config.get('PDF_RENDERER', DEFAULT_PDF_RENDERER)
+    # Outside the lock, so the templates of different invoices render in parallel
+    html = render_html()
+    with _jobs_lock:
+        future = _active_job(job_id)
+        if future is not None:
+            # A concurrent request submitted the same PDF while this one rendered its template
+            return future
+        submitted_at = time.perf_counter()
+        future = start_render(html, get_cached_pdf_path(job_id), renderer_name)
+        _jobs[job_id] = future
+        _failed_jobs.pop(job_id, None)
+    future.add_done_callback(lambda finished: metrics.observe_render(renderer_name, finished, submitted_at))
+    future.add_done_callback(lambda finished: _forget_job(job_id, finished))
+    return future
+
+
+def _forget_job(job_id: str, future):
+    # Successful jobs are answered from the PDF cache, failed ones only keep their errors
+    with _jobs_lock:
+        if _jobs.get(job_id) is future:
+            del _jobs[job_id]
+        if future.exception() is not None:
+            _failed_jobs[job_id] = [str(arg) for arg in future.exception().args]
+            _failed_jobs.move_to_end(job_id)
+            while len(_failed_jobs) > MAX_FAILED_JOBS:
+                _failed_jobs.popitem(last=False)
+
+
+def get_render_job(job_id: str):
+    job = {'job_id': job_id}
+    if os.path.exists(get_cached_pdf_path(job_id)):
+        job['status'] = 'DONE'
+        return job
+    with _jobs_lock:
+        future = _jobs.get(job_id)
+        errors = _failed_jobs.get(job_id)
+    if future is None:
+        if errors is None:
+            return None
+        job['status'] = 'FAILED'
+        job['errors'] = errors
+        return job
+    if not future.done():
+        job['status'] = 'RUNNING' if future.running() else 'QUEUED'
+    elif future.exception() is not None:
+        job['status'] = 'FAILED'
+        job['errors'] = [str(arg) for arg in future.exception().args]
+    else:
+        job['status'] = 'DONE'
+    return job
@@ -1,120 +1,454 @@
 import os
+from concurrent.futures import TimeoutError
 from datetime import datetime
 from uuid import uuid4
 
-import jinja2
-from flask import Blueprint, jsonify, request, send_file
-import pdfkit
+from flask import Blueprint, Response, current_app, json, jsonify, request, send_file, stream_with_context, url_for
+from sqlalchemy.orm import selectinload
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
 
-from application import db
-from application.clients.routes import get_client_by_id
+from application import db, SQLITE_MAX_VARIABLE_NUMBER
+from application.clients.models import ClientVersion
+from application.clients.routes import get_clients_by_ids
+from application.conditional import is_not_modified, not_modified, set_validators
+from application.idempotency import claim_idempotency_key, idempotent, save_idempotent_response
 from application.invoices.models import Invoice, InvoiceItem
-from application.invoices.schemas import invoices_schema, invoice_schema
-from application.products.routes import get_product_by_id
-from definitions import ROOT_DIR
+from application.invoices.numbering import DEFAULT_INVOICE_SERIES, assign_invoice_numbers, format_invoice_number, \
+    is_valid_series
+from application.invoices.pricing import LINE_AMOUNTS, is_number, price_invoice, price_invoices
+from application.invoices.export import ExportReport, render_invoices, stream_merged_pdf, stream_zip
+from application.invoices.rendering import DEFAULT_RENDER_WORKERS, get_cached_pdf_path, get_render_job, \
+    get_render_job_id, is_valid_render_job_id, submit_render_job
+from application.invoices.schemas import dump_invoice, dump_invoices, invoice_schema
+from application.invoices.templating import INVOICE_TEMPLATE, render_invoice_html
+from application.products.models import ProductVersion
+from application.products.routes import get_products_by_ids
+from application.reports.routes import record_invoice_summaries
+from application.search import search
+from application.serialization import fast_jsonify
+from application.versioning import get_version_ids
 
 invoices_api = Blueprint('invoices_api', __name__)
-template_dir = os.path.join(ROOT_DIR, 'templates')
-pdf_dir = os.path.join(ROOT_DIR, 'pdf')
-template_loader = jinja2.FileSystemLoader(searchpath=template_dir)
-template_env = jinja2.Environment(loader=template_loader)
-pdfkit_config = pdfkit.configuration(wkhtmltopdf='/app/bin/wkhtmltopdf') if 'DYNO' in os.environ else None
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_PAGE_SIZE = 500
+DEFAULT_RENDER_TIMEOUT = 60
+MAX_MERGED_PDF_INVOICES = 500
+MAX_BATCH_SIZE = 1000
+BATCH_INVOICE_FIELDS = ('client_id', 'invoice_items')
+BATCH_INVOICE_ITEM_FIELDS = ('product_id', 'product_quantity', 'product_discount_percent', 'product_markup_percent')
+# Invoices never change once committed, so the id and this version address the JSON; bump it whenever
+# the invoice schema changes
+INVOICE_ETAG_VERSION = 1
+
+
+def copy_client_details(invoice, client_details):
+    # Make copy of client details as they are subject to changes, the invoice stores them as a ClientVersion
+    invoice['client_name'] = client_details['client_name']
+    invoice['client_address'] = client_details['client_address']
+    invoice['client_city'] = client_details['client_city']
+    invoice['client_tin'] = client_details['client_tin']
+    invoice['is_client_taxable'] = client_details['is_client_taxable']
+
+
+def copy_product_details(item, product):
+    # Make copy of these entries as product details are subject to change, the item stores them as a ProductVersion
+    item['product_price'] = product['product_price']
+    item['product_price_currency'] = product['product_price_currency']
+    item['product_name'] = product['product_name']
+    item['product_vat_percent'] = product['product_vat_percent']
+
+
+def get_invoice_series(data):
+    return data.get('invoice_series') or current_app.config.get('INVOICE_SERIES', DEFAULT_INVOICE_SERIES)
+
+
+def product_not_found(missing_product_ids):
+    return dict(error_code='PRODUCT_NOT_FOUND',
+                message='Products with ids ' + ', '.join(missing_product_ids) + ' not found!',
+                product_ids=missing_product_ids)
 
 
 @invoices_api.route('', methods=['POST'])
+@idempotent
 def create_invoice(**kwargs):
     try:
         data = request.get_json()
         invoice_id = uuid4().hex
         data['invoice_id'] = invoice_id
-        data['invoice_gross_amount'] = 0
         data['invoice_number'] = None
-        data['invoice_gross_amount'] = 0
-        data['total_discount_amount'] = 0
-        data['total_tax_amount'] = 0
-        data['invoice_net_amount'] = 0
-        client_details = get_client_by_id(data['client_id'])
-        is_client_taxable = getattr(client_details, 'is_client_taxable')
+        data['created_at'] = datetime.utcnow()
+        data['invoice_series'] = get_invoice_series(data)
+        if not is_valid_series(data['invoice_series']):
+            return jsonify(status='ERROR', errors=['Invoice series must be 1 to 10 upper case letters or digits']), 400
+        clients, _ = get_clients_by_ids([data['client_id']])
+        client_details = clients.get(data['client_id'])
         if not client_details:
             return jsonify(status='ERROR', error_code='CLIENT_NOT_FOUND', message='Client not found!'), 404
-
-        # Make copy of client details as they are subject to changes
-        data['client_name'] = getattr(client_details, 'client_name')
-        data['client_address'] = getattr(client_details, 'client_address')
-        data['client_city'] = getattr(client_details, 'client_city')
-        data['client_tin'] = getattr(client_details, 'client_tin')
-        data['is_client_taxable'] = is_client_taxable
+        copy_client_details(data, client_details)
 
         invoice_items = data['invoice_items']
         if len(invoice_items) < 1:
             return jsonify(status='ERROR', errors=['Invoice must contain at least one invoice item']), 400
-        for i in range(len(invoice_items)):
-            product = get_product_by_id(invoice_items[i]['product_id'])
-            if not product:
-                return jsonify(error_code='PRODUCT_NOT_FOUND', message='Product with id ' + invoice_items[i]['product_id'] +  ' not found!'), 404
-            price_per_unit = getattr(product, 'product_price')
-            vat_percent = getattr(product, 'product_vat_percent')
-            discount_percent = invoice_items[i]['product_discount_percent']
-            markup_percent = invoice_items[i]['product_markup_percent']
-            quantity = invoice_items[i]['product_quantity']
-            total_price = price_per_unit * quantity
-            markup_amount = total_price * (markup_percent / 100)
-            gross_amount = total_price + markup_amount
-            discount_amount = gross_amount * (discount_percent / 100)
-            amount_after_discount = gross_amount - discount_amount
-            vat_amount = amount_after_discount * (vat_percent / 100) if is_client_taxable else 0
-            net_amount = amount_after_discount + vat_amount
-
-            # Make copy of these entries as product details are subject to change
-            invoice_items[i]['product_price'] = price_per_unit
-            invoice_items[i]['product_price_currency'] = getattr(product, 'product_price_currency')
-            invoice_items[i]['product_name'] = getattr(product, 'product_name')
-            invoice_items[i]['product_vat_percent'] = vat_percent
-
-            # Save calculations to the database
-            invoice_items[i]['total_price'] = total_price
-            invoice_items[i]['markup_amount'] = markup_amount
-            invoice_items[i]['gross_amount'] = gross_amount
-            data['invoice_gross_amount'] += gross_amount
-            invoice_items[i]['discount_amount'] = discount_amount
-            data['total_discount_amount'] += discount_amount
-            invoice_items[i]['amount_after_discount'] = amount_after_discount
-            invoice_items[i]['vat_amount'] = vat_amount
-            data['total_tax_amount'] += vat_amount
-            invoice_items[i]['net_amount'] = net_amount
-            data['invoice_net_amount'] += net_amount
-
-            item = InvoiceItem(**invoice_items[i], invoice_item_id=uuid4().hex)
-            data['invoice_items'][i] = item
-        invoice = Invoice(**data)
+        products, missing_product_ids = get_products_by_ids([item['product_id'] for item in invoice_items])
+        if missing_product_ids:
+            return jsonify(**product_not_found(missing_product_ids)), 404
+        for item in invoice_items:
+            copy_product_details(item, products[item['product_id']])
+
+        # Save calculations to the database
+        line_amounts, totals = price_invoice(invoice_items, data['is_client_taxable'])
+        data.update(totals)
+        priced_items = [{**invoice_items[i], **line_amounts[i]} for i in range(len(invoice_items))]
         is_dryrun = request.args.get('dryrun').lower() in ('true', '1') if request.args.get('dryrun') else False
+        if not is_dryrun:
+            # A series that allows gaps takes its number before the session writes, a replay skips it
+            assign_invoice_numbers([data], gapless=False)
+            # First write of the transaction: a concurrent retry with the same Idempotency-Key waits here
+            # and gets the stored response
+            replay = claim_idempotency_key()
+            if replay:
+                return replay
+            # A gapless number is only kept if the invoice is committed
+            assign_invoice_numbers([data], gapless=True)
+        client_version_id, = get_version_ids(ClientVersion, [data], create=not is_dryrun)
+        product_version_ids = get_version_ids(ProductVersion, priced_items, create=not is_dryrun)
+        invoice = Invoice(**{**data, 'client_version_id': client_version_id, 'invoice_items': [
+            InvoiceItem(**item, product_version_id=product_version_id, invoice_item_id=uuid4().hex)
+            for item, product_version_id in zip(priced_items, product_version_ids)
+        ]})
         if is_dryrun:
-            return jsonify(status='SUCCESS', message='Invoice creation dry run successful!', invoice_details=invoice_schema.dump(invoice)), 200
+            return jsonify(status='SUCCESS', message='Invoice creation dry run successful!', invoice_details=dump_invoice(invoice)), 200
         else:
             db.session.add(invoice)
+            record_invoice_summaries([{**data, 'invoice_items': priced_items}])
+            db.session.flush()
+            response = jsonify(status='SUCCESS', message='Invoice created successfully!', invoice_details=dump_invoice(invoice))
+            save_idempotent_response(response, 201)
             db.session.commit()
-            return jsonify(status='SUCCESS', message='Invoice created successfully!', invoice_details=invoice_schema.dump(invoice)), 201
+            return response, 201
     except Exception as e:
         db.session.rollback()
         return jsonify(status='ERROR', errors=e.args), 400
 
 
+def validate_batch_invoice(data):
+    # Rejects one invoice of the batch for what would otherwise fail the lookups, pricing or summaries of all
+    if not isinstance(data, dict):
+        return ['Invoice must be an object']
+    errors = [f'Missing field {field}' for field in BATCH_INVOICE_FIELDS if field not in data]
+    if 'client_id' in data and not isinstance(data['client_id'], str):
+        errors.append('client_id must be a string')
+    invoice_items = data.get('invoice_items')
+    if 'invoice_items' in data and (not isinstance(invoice_items, list) or len(invoice_items) < 1):
+        errors.append('Invoice must contain at least one invoice item')
+    elif invoice_items:
+        for i, item in enumerate(invoice_items):
+            if not isinstance(item, dict):
+                errors.append(f'Invoice item {i} must be an object')
+                continue
+            errors += [f'Invoice item {i} is missing field {field}' for field in BATCH_INVOICE_ITEM_FIELDS if field not in item]
+            if 'product_id' in item and not isinstance(item['product_id'], str):
+                errors.append(f'Invoice item {i} product_id must be a string')
+            errors += [f'Invoice item {i} {field} must be a number' for field in BATCH_INVOICE_ITEM_FIELDS[1:]
+                       if field in item and not is_number(item[field])]
+    if 'invoice_series' in data and not is_valid_series(data['invoice_series']):
+        errors.append('Invoice series must be 1 to 10 upper case letters or digits')
+    return errors
+
+
+def price_batch(invoices):
+    # Price every invoice in one pass, on a bad value fall back to one pass per invoice to tell which one failed
+    items = [item for invoice in invoices for item in invoice['invoice_items']]
+    try:
+        line_amounts, totals = price_invoices(items, [len(invoice['invoice_items']) for invoice in invoices],
+                                              [invoice['is_client_taxable'] for invoice in invoices])
+    except (TypeError, ValueError, OverflowError):
+        return [price_batch_invoice(invoice) for invoice in invoices]
+    line = 0
+    for i, invoice in enumerate(invoices):
+        for item in invoice['invoice_items']:
+            item.update({name: line_amounts[name][line] for name in LINE_AMOUNTS})
+            line += 1
+        invoice.update({name: values[i] for name, values in totals.items()})
+    return [None] * len(invoices)
+
+
+def price_batch_invoice(invoice):
+    try:
+        line_amounts, totals = price_invoice(invoice['invoice_items'], invoice['is_client_taxable'])
+    except (TypeError, ValueError, OverflowError) as e:
+        return list(e.args)
+    for item, amounts in zip(invoice['invoice_items'], line_amounts):
+        item.update(amounts)
+    invoice.update(totals)
+    return None
+
+
+@invoices_api.route('batch', methods=['POST'])
+def create_invoice_batch():
+    try:
+        batch = request.get_json()['invoices']
+        if not isinstance(batch, list) or not 0 < len(batch) <= MAX_BATCH_SIZE:
+            return jsonify(status='ERROR', errors=[f'A batch must contain between 1 and {MAX_BATCH_SIZE} invoices']), 400
+        results = [{'index': i} for i in range(len(batch))]
+        for result, data in zip(results, batch):
+            errors = validate_batch_invoice(data)
+            if errors:
+                result.update(status='ERROR', errors=errors)
+
+        candidates = [i for i, result in enumerate(results) if 'status' not in result]
+        clients, _ = get_clients_by_ids([batch[i]['client_id'] for i in candidates])
+        products, _ = get_products_by_ids([item['product_id'] for i in candidates for item in batch[i]['invoice_items']])
+        created_at = datetime.utcnow()
+        invoices = []
+        for i in candidates:
+            data = batch[i]
+            client_details = clients.get(data['client_id'])
+            if not client_details:
+                results[i].update(status='ERROR', error_code='CLIENT_NOT_FOUND', message='Client not found!')
+                continue
+            missing_product_ids = list(dict.fromkeys(item['product_id'] for item in data['invoice_items']
+                                                     if item['product_id'] not in products))
+            if missing_product_ids:
+                results[i].update(status='ERROR', **product_not_found(missing_product_ids))
+                continue
+            invoice = {'invoice_id': uuid4().hex, 'invoice_number': None, 'client_id': data['client_id'], 'created_at': created_at,
+                       'invoice_series': get_invoice_series(data)}
+            copy_client_details(invoice, client_details)
+            invoice['invoice_items'] = []
+            for item_data in data['invoice_items']:
+                item = {field: item_data[field] for field in BATCH_INVOICE_ITEM_FIELDS}
+                item['invoice_item_id'] = uuid4().hex
+                item['invoice_id'] = invoice['invoice_id']
+                copy_product_details(item, products[item['product_id']])
+                invoice['invoice_items'].append(item)
+            invoices.append((i, invoice))
+
+        pricing_errors = price_batch([invoice for _, invoice in invoices]) if invoices else []
+        for (i, invoice), errors in zip(invoices, pricing_errors):
+            if errors:
+                results[i].update(status='ERROR', errors=errors)
+        invoices = [(i, invoice) for (i, invoice), errors in zip(invoices, pricing_errors) if not errors]
+
+        is_dryrun = request.args.get('dryrun').lower() in ('true', '1') if request.args.get('dryrun') else False
+        if invoices and not is_dryrun:
+            assign_invoice_numbers([invoice for _, invoice in invoices], gapless=False)
+            assign_invoice_numbers([invoice for _, invoice in invoices], gapless=True)
+            # The copied details stay in the dicts for the response, the mappings only insert the version ids
+            client_version_ids = get_version_ids(ClientVersion, [invoice for _, invoice in invoices])
+            for (_, invoice), client_version_id in zip(invoices, client_version_ids):
+                invoice['client_version_id'] = client_version_id
+            items = [item for _, invoice in invoices for item in invoice['invoice_items']]
+            for item, product_version_id in zip(items, get_version_ids(ProductVersion, items)):
+                item['product_version_id'] = product_version_id
+            db.session.bulk_insert_mappings(Invoice, [
+                {column: value for column, value in invoice.items() if column not in ('invoice_items', 'invoice_number')}
+                for _, invoice in invoices
+            ])
+            db.session.bulk_insert_mappings(InvoiceItem, items)
+            record_invoice_summaries([invoice for _, invoice in invoices])
+            invoice_numbers = get_invoice_numbers([invoice['invoice_id'] for _, invoice in invoices])
+            db.session.commit()
+            for _, invoice in invoices:
+                invoice['invoice_number'] = invoice_numbers[invoice['invoice_id']]
+        # Batch invoices are plain dicts, which only the marshmallow schema knows how to read
+        for i, invoice in invoices:
+            results[i].update(status='SUCCESS', invoice_details=invoice_schema.dump(invoice))
+
+        created_count = len(invoices)
+        if created_count == len(batch):
+            status, status_code = 'SUCCESS', 200 if is_dryrun else 201
+        elif created_count:
+            status, status_code = 'PARTIAL', 207
+        else:
+            status, status_code = 'ERROR', 400
+        message = f'{created_count} of {len(batch)} invoices ' + ('passed the dry run!' if is_dryrun else 'created!')
+        return jsonify(status=status, message=message, results=results), status_code
+    except Exception as e:
+        db.session.rollback()
+        return jsonify(status='ERROR', errors=e.args), 400
+
+
+def get_invoice_numbers(invoice_ids):
+    invoice_numbers = {}
+    for offset in range(0, len(invoice_ids), SQLITE_MAX_VARIABLE_NUMBER):
+        chunk = invoice_ids[offset:offset + SQLITE_MAX_VARIABLE_NUMBER]
+        query = db.session.query(Invoice.invoice_id, Invoice.invoice_number).filter(Invoice.invoice_id.in_(chunk))
+        invoice_numbers.update(query)
+    return invoice_numbers
+
+
+def query_invoices(cursor=None, client_id=None, created_from=None, created_to=None):
+    query = Invoice.query.options(selectinload(Invoice.invoice_items)).order_by(Invoice.invoice_number)
+    if cursor is not None:
+        query = query.filter(Invoice.invoice_number > cursor)
+    if client_id:
+        query = query.filter(Invoice.client_id == client_id)
+    if created_from:
+        query = query.filter(Invoice.created_at >= created_from)
+    if created_to:
+        query = query.filter(Invoice.created_at < created_to)
+    return query
+
+
+def iterate_invoices(query, limit=None):
+    # Walk the result set page by page on invoice_number so only one page is held in memory
+    cursor = None
+    remaining = limit
+    while remaining is None or remaining > 0:
+        page_size = STREAM_PAGE_SIZE if remaining is None else min(remaining, STREAM_PAGE_SIZE)
+        page_query = query if cursor is None else query.filter(Invoice.invoice_number > cursor)
+        page = page_query.limit(page_size).all()
+        yield from page
+        if len(page) < page_size:
+            break
+        cursor = page[-1].invoice_number
+        if remaining is not None:
+            remaining -= len(page)
+
+
+def stream_invoices(query, limit=None):
+    for invoice in iterate_invoices(query, limit):
+        yield json.dumps(dump_invoice(invoice)) + '\n'
+
+
 @invoices_api.route('', methods=['GET'])
 def get_invoices():
     try:
-        query_result = Invoice.query.all()
-        invoices = invoices_schema.dump(query_result)
-        return jsonify(invoices), 200
+        cursor = request.args.get('cursor', type=int)
+        client_id = request.args.get('client_id')
+        created_from = datetime.fromisoformat(request.args['created_from']) if request.args.get('created_from') else None
+        created_to = datetime.fromisoformat(request.args['created_to']) if request.args.get('created_to') else None
+        query = query_invoices(cursor, client_id, created_from, created_to)
+        # SQLite reads a negative LIMIT as no limit at all
+        limit = request.args.get('limit', type=int)
+        if limit is not None and limit < 1:
+            return jsonify(status='ERROR', errors=['Limit must be at least 1']), 400
+
+        is_stream = request.args.get('stream').lower() in ('true', '1') if request.args.get('stream') else False
+        if is_stream:
+            return Response(stream_with_context(stream_invoices(query, limit)), mimetype='application/x-ndjson'), 200
+
+        limit = min(DEFAULT_PAGE_SIZE if limit is None else limit, MAX_PAGE_SIZE)
+        query_result = query.limit(limit).all()
+        invoices = dump_invoices(query_result)
+        response = fast_jsonify(invoices)
+        if query_result and len(query_result) == limit:
+            response.headers['X-Next-Cursor'] = str(query_result[-1].invoice_number)
+        return response, 200
+    except Exception as e:
+        return jsonify(status='ERROR', errors=e.args), 400
+
+
+@invoices_api.route('search', methods=['GET'])
+def search_invoices():
+    # Searches the client details as they were copied onto each invoice
+    try:
+        invoices, next_offset = search(Invoice, [selectinload(Invoice.invoice_items)])
+        response = fast_jsonify(dump_invoices(invoices))
+        if next_offset is not None:
+            response.headers['X-Next-Offset'] = str(next_offset)
+        return response, 200
     except Exception as e:
         return jsonify(status='ERROR', errors=e.args), 400
 
 
+def log_export_report(chunks, report):
+    yield from chunks
+    current_app.logger.info('Invoice export finished: %s', json.dumps(report.to_dict()))
+
+
+@invoices_api.route('export', methods=['GET'])
+def export_invoices():
+    try:
+        client_id = request.args.get('client_id')
+        created_from = datetime.fromisoformat(request.args['created_from']) if request.args.get('created_from') else None
+        created_to = datetime.fromisoformat(request.args['created_to']) if request.args.get('created_to') else None
+        if not (client_id or created_from or created_to):
+            return jsonify(status='ERROR', errors=['Export requires a client_id or a created_from/created_to range']), 400
+        export_format = request.args.get('format', 'zip').lower()
+        if export_format not in ('zip', 'pdf'):
+            return jsonify(status='ERROR', errors=['Export format must be zip or pdf']), 400
+
+        query = query_invoices(client_id=client_id, created_from=created_from, created_to=created_to)
+        if export_format == 'pdf' and query.count() > MAX_MERGED_PDF_INVOICES:
+            return jsonify(status='ERROR', errors=[f'Merged PDF exports are limited to {MAX_MERGED_PDF_INVOICES} invoices, use format=zip']), 400
+
+        report = ExportReport()
+        window = 4 * current_app.config.get('PDF_RENDER_WORKERS', DEFAULT_RENDER_WORKERS)
+        rendered_invoices = render_invoices(iterate_invoices(query), INVOICE_TEMPLATE, render_invoice_html, report, window)
+        if export_format == 'zip':
+            chunks, mimetype = stream_zip(rendered_invoices, report), 'application/zip'
+        else:
+            chunks, mimetype = stream_merged_pdf(rendered_invoices), 'application/pdf'
+        response = Response(stream_with_context(log_export_report(chunks, report)), mimetype=mimetype)
+        response.headers['Content-Disposition'] = f'attachment; filename=invoices.{export_format}'
+        return response, 200
+    except Exception as e:
+        return jsonify(status='ERROR', errors=e.args), 400
+
+
+def get_invoice_etag(invoice_id: str):
+    return f'{invoice_id}-{INVOICE_ETAG_VERSION}'
+
+
 @invoices_api.route('<invoice_id>', methods=['GET'])
 def get_invoice(invoice_id: str):
     try:
+        etag = get_invoice_etag(invoice_id)
+        if request.if_none_match or request.if_modified_since:
+            # Revalidation only needs to know the invoice exists, not its items
+            created_at = db.session.query(Invoice.created_at).filter_by(invoice_id=invoice_id).scalar()
+            if created_at is not None and is_not_modified(etag, created_at):
+                return not_modified(etag, created_at)
         query_result = Invoice.query.filter_by(invoice_id=invoice_id).first()
-        invoice = invoice_schema.dump(query_result)
-        return jsonify(invoice), 200
+        if not query_result:
+            return jsonify(status='ERROR', error_code='INVOICE_NOT_FOUND', message='Invoice not found!'), 404
+        return set_validators(fast_jsonify(dump_invoice(query_result)), etag, query_result.created_at), 200
+    except Exception as e:
+        return jsonify(status='ERROR', errors=e.args), 400
+
+
+def render_job_details(job):
+    job['status_url'] = url_for('invoices_api.get_render_job_status', job_id=job['job_id'])
+    return job
+
+
+@invoices_api.route('<invoice_id>/render', methods=['POST'])
+def render_invoice(invoice_id: str):
+    try:
+        query_result = Invoice.query.filter_by(invoice_id=invoice_id).first()
+        if not query_result:
+            return jsonify(status='ERROR', error_code='INVOICE_NOT_FOUND', message='Invoice not found!'), 404
+        job_id = get_render_job_id(invoice_id, INVOICE_TEMPLATE)
+        job = get_render_job(job_id)
+        if job and job['status'] == 'DONE':
+            return jsonify(status='SUCCESS', job=render_job_details(job)), 200
+        submit_render_job(job_id, lambda: render_invoice_html(query_result))
+        return jsonify(status='SUCCESS', message='Invoice rendering queued!', job=render_job_details(get_render_job(job_id))), 202
+    except Exception as e:
+        return jsonify(status='ERROR', errors=e.args), 400
+
+
+@invoices_api.route('render-jobs/<job_id>', methods=['GET'])
+def get_render_job_status(job_id: str):
+    try:
+        job = get_render_job(job_id) if is_valid_render_job_id(job_id) else None
+        if not job:
+            return jsonify(status='ERROR', error_code='RENDER_JOB_NOT_FOUND', message='Render job not found!'), 404
+        return jsonify(render_job_details(job)), 200
+    except Exception as e:
+        return jsonify(status='ERROR', errors=e.args), 400
+
+
+@invoices_api.route('<invoice_id>/preview', methods=['GET'])
+def preview_invoice(invoice_id: str):
+    try:
+        query_result = Invoice.query.options(selectinload(Invoice.invoice_items)).filter_by(invoice_id=invoice_id).first()
+        if not query_result:
+            return jsonify(status='ERROR', error_code='INVOICE_NOT_FOUND', message='Invoice not found!'), 404
+        return Response(render_invoice_html(query_result), mimetype='text/html'), 200
     except Exception as e:
         return jsonify(status='ERROR', errors=e.args), 400
 
@@ -122,15 +456,35 @@ def get_invoice(invoice_id: str):
 @invoices_api.route('<invoice_id>/download', methods=['GET'])
 def download_invoice(invoice_id: str):
     try:
+        # The render job id changes with the template, the renderer and RENDER_VERSION, which makes it a strong
+        # ETag for the PDF. A cached PDF also proves the invoice exists, so revalidation does not touch the database.
+        job_id = get_render_job_id(invoice_id, INVOICE_TEMPLATE)
+        filepath = get_cached_pdf_path(job_id)
+        if request.if_none_match and is_valid_render_job_id(job_id) and is_not_modified(job_id) and os.path.exists(filepath):
+            return not_modified(job_id)
         query_result = Invoice.query.filter_by(invoice_id=invoice_id).first()
-        invoice = invoice_schema.dump(query_result)
-        invoice['invoice_number'] = str(invoice['invoice_number']).zfill(8)
-        invoice['created_at'] = datetime.fromisoformat(invoice['created_at'])
-        template = template_env.get_template('invoice_template.html')
-        html = template.render(invoice=invoice, currency='SAR')
-        filename = f'invoice_{invoice["invoice_number"]}.pdf'
-        filepath = f'{pdf_dir}/{filename}'
-        pdfkit.from_string(html, filepath, configuration=pdfkit_config)
-        return send_file(filepath, attachment_filename=filename), 200
+        if not query_result:
+            return jsonify(status='ERROR', error_code='INVOICE_NOT_FOUND', message='Invoice not found!'), 404
+        filename = f'invoice_{format_invoice_number(query_result)}.pdf'
+        if not os.path.exists(filepath):
+            future = submit_render_job(job_id, lambda: render_invoice_html(query_result))
+            is_async = request.args.get('async').lower() in ('true', '1') if request.args.get('async') else False
+            try:
+                future.result(timeout=0 if is_async else current_app.config.get('PDF_RENDER_TIMEOUT', DEFAULT_RENDER_TIMEOUT))
+            except TimeoutError:
+                return jsonify(status='SUCCESS', message='Invoice rendering queued!', job=render_job_details(get_render_job(job_id))), 202
+        response = send_file(filepath, attachment_filename=filename, add_etags=False)
+        response.set_etag(job_id)
+        response.accept_ranges = 'bytes'
+        # Answers Range and If-Range with 206, If-None-Match and If-Modified-Since with 304
+        try:
+            return response.make_conditional(request, accept_ranges=True, complete_length=os.path.getsize(filepath))
+        except RequestedRangeNotSatisfiable:
+            response.close()
+            raise
+    except RequestedRangeNotSatisfiable as e:
+        response = jsonify(status='ERROR', errors=['Requested range not satisfiable'])
+        response.headers['Content-Range'] = f'bytes */{e.length}'
+        return response, 416
     except Exception as e:
-        return jsonify(status='ERROR', errors=e.args), 400
\ No newline at end of file
+        return jsonify(status='ERROR', errors=e.args), 400
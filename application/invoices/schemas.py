@@ -1,5 +1,6 @@
-from flask_marshmallow import Schema
-from marshmallow import fields
+from marshmallow import Schema, fields
+
+from application.serialization import make_serializer
 
 
 class InvoiceItemSchema(Schema):
@@ -28,6 +29,9 @@ class InvoiceItemSchema(Schema):
 class InvoiceSchema(Schema):
     invoice_id = fields.String()
     invoice_number = fields.Integer()
+    invoice_series = fields.String()
+    invoice_year = fields.Integer()
+    sequence_number = fields.Integer()
     invoice_items = fields.List(fields.Nested(InvoiceItemSchema(exclude=('invoice_id',))))
     created_at = fields.DateTime()
     invoice_gross_amount = fields.Float()
@@ -42,4 +46,6 @@ class InvoiceSchema(Schema):
 
 
 invoice_schema = InvoiceSchema()
-invoices_schema = InvoiceSchema(many=True)
\ No newline at end of file
+invoices_schema = InvoiceSchema(many=True)
+dump_invoice = make_serializer(invoice_schema)
+dump_invoices = make_serializer(invoices_schema)
@@ -0,0 +1,40 @@
+import os
+
+import jinja2
+
+from application.invoices.numbering import format_invoice_number
+from definitions import ROOT_DIR
+
+template_dir = os.path.join(ROOT_DIR, 'templates')
+bytecode_cache_dir = os.path.join(ROOT_DIR, '.jinja_cache')
+INVOICE_TEMPLATE = 'invoice_template.html'
+CURRENCY = 'SAR'
+
+_template_env = None
+
+
+def get_template_env():
+    # Compiled templates are kept in memory per process and as bytecode on disk, so a new
+    # worker loads the bytecode written by `flask templates_compile` instead of parsing the source
+    global _template_env
+    if _template_env is None:
+        os.makedirs(bytecode_cache_dir, exist_ok=True)
+        _template_env = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(searchpath=template_dir),
+            bytecode_cache=jinja2.FileSystemBytecodeCache(bytecode_cache_dir)
+        )
+    return _template_env
+
+
+def compile_templates():
+    template_env = get_template_env()
+    template_names = template_env.list_templates(extensions=('html',))
+    for template_name in template_names:
+        template_env.get_template(template_name)
+    return template_names
+
+
+def render_invoice_html(invoice):
+    # Renders straight from the Invoice row, the template reads its columns and invoice_items as attributes
+    template = get_template_env().get_template(INVOICE_TEMPLATE)
+    return template.render(invoice=invoice, invoice_number=format_invoice_number(invoice), currency=CURRENCY)
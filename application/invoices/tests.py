@@ -0,0 +1,689 @@
+import io
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import zipfile
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+
+from PyPDF2 import PdfFileReader, PdfFileWriter
+
+from app import create_app
+from application import db
+from application.clients.models import ClientVersion
+from application.idempotency import IdempotencyKey
+from application.invoices.models import Invoice, InvoiceItem, InvoiceSequence
+from application.invoices.numbering import _blocks, allocate_invoice_numbers
+from application.invoices.pricing import price_invoices, price_line_reference, price_lines
+from application.invoices.rendering import _jobs, _jobs_lock, get_cached_pdf_path, get_executor, get_render_job_id, start_pool_render, \
+    submit_render_job
+from application.invoices.routes import query_invoices
+from application.invoices.templating import INVOICE_TEMPLATE, bytecode_cache_dir, compile_templates
+from application.products.models import ProductVersion
+from tests import AppTest
+
+
+class InvoiceFixtures:
+    prefix = '/api/invoices'
+
+    def create_client(self, client_tin='300000000000003', is_client_taxable=True):
+        return self.test_client.post('/api/clients', json={
+            "client_name": "Acme Trading",
+            "client_address": "King Fahd Road",
+            "client_city": "Riyadh",
+            "client_tin": client_tin,
+            "is_client_taxable": is_client_taxable
+        }).get_json()['added_client']['client_id']
+
+    def create_product(self, product_price=30.0):
+        return self.test_client.post('/api/products', json={
+            "product_description": "Design various stuffs",
+            "product_discount_percent": 0.0,
+            "product_markup_percent": 20.0,
+            "product_name": "Designing",
+            "product_price": product_price,
+            "product_price_currency": "SAR",
+            "product_vat_percent": 15.0
+        }).get_json()['added_product']['product_id']
+
+    def invoice_data(self, client_id, product_ids):
+        return {
+            "client_id": client_id,
+            "invoice_items": [{
+                "product_id": product_id,
+                "product_quantity": 2,
+                "product_discount_percent": 10.0,
+                "product_markup_percent": 20.0
+            } for product_id in product_ids]
+        }
+
+    def render_job_id(self, invoice_id):
+        with self.app.app_context():
+            return get_render_job_id(invoice_id, INVOICE_TEMPLATE)
+
+    def create_invoice(self, client_id, product_ids, query_string=None):
+        return self.test_client.post(f'{self.prefix}', query_string=query_string,
+                                     json=self.invoice_data(client_id, product_ids))
+
+
+class InvoicesTest(InvoiceFixtures, AppTest):
+
+    def test_create_invoice(self):
+        client_id = self.create_client()
+        product_id = self.create_product()
+        response = self.create_invoice(client_id, [product_id])
+        self.assertEqual(response.status_code, 201)
+        invoice = response.get_json()['invoice_details']
+        self.assertEqual(len(invoice['invoice_items']), 1)
+        self.assertAlmostEqual(invoice['invoice_gross_amount'], 72.0)
+        self.assertAlmostEqual(invoice['total_discount_amount'], 7.2)
+        self.assertAlmostEqual(invoice['total_tax_amount'], 9.72)
+        self.assertAlmostEqual(invoice['invoice_net_amount'], 74.52)
+
+    def test_create_invoice_reloads_catalog_outdated_by_another_worker(self):
+        client_id = self.create_client()
+        product_id = self.create_product()
+        self.assertEqual(self.create_invoice(client_id, [product_id]).status_code, 201)
+        # Another worker's PUTs leave this worker's cache entries in place
+        with self.app.app_context():
+            db.engine.execute("UPDATE products SET product_price = 99.0, last_updated_at = '2030-01-01 00:00:00.000000' "
+                              "WHERE product_id = ?", product_id)
+            db.engine.execute("UPDATE clients SET is_client_taxable = 0, last_updated_at = '2030-01-01 00:00:00.000000' "
+                              "WHERE client_id = ?", client_id)
+        invoice = self.create_invoice(client_id, [product_id]).get_json()['invoice_details']
+        self.assertEqual(invoice['invoice_items'][0]['product_price'], 99.0)
+        self.assertAlmostEqual(invoice['total_tax_amount'], 0.0)
+        self.assertAlmostEqual(invoice['invoice_net_amount'], 213.84)
+
+    def test_create_invoice_rejects_quantities_that_are_not_numbers(self):
+        client_id = self.create_client()
+        product_id = self.create_product()
+        for quantity in ('2', None):
+            data = self.invoice_data(client_id, [product_id])
+            data['invoice_items'][0]['product_quantity'] = quantity
+            response = self.test_client.post(f'{self.prefix}', json=data)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.get_json()['errors'], ['product_quantity must be a number'])
+        self.assertEqual(self.test_client.get(f'{self.prefix}').get_json(), [])
+
+    def test_create_invoice_with_repeated_products(self):
+        client_id = self.create_client()
+        first_product_id = self.create_product()
+        second_product_id = self.create_product(product_price=10.0)
+        response = self.create_invoice(client_id, [first_product_id, second_product_id, first_product_id])
+        self.assertEqual(response.status_code, 201)
+        items = response.get_json()['invoice_details']['invoice_items']
+        self.assertEqual([item['product_id'] for item in items], [first_product_id, second_product_id, first_product_id])
+        self.assertEqual([item['product_price'] for item in items], [30.0, 10.0, 30.0])
+
+    def test_create_invoice_reports_all_missing_products(self):
+        client_id = self.create_client()
+        product_id = self.create_product()
+        response = self.create_invoice(client_id, ['MISSING_1', product_id, 'MISSING_2', 'MISSING_1'])
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.get_json()['error_code'], 'PRODUCT_NOT_FOUND')
+        self.assertEqual(response.get_json()['product_ids'], ['MISSING_1', 'MISSING_2'])
+
+    def test_create_invoice_unknown_client(self):
+        product_id = self.create_product()
+        response = self.create_invoice('SOME_RANDOM_ID', [product_id])
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.get_json()['error_code'], 'CLIENT_NOT_FOUND')
+
+    def test_get_invoices_paginates_by_cursor(self):
+        client_id = self.create_client()
+        product_id = self.create_product()
+        invoice_ids = [self.create_invoice(client_id, [product_id]).get_json()['invoice_details']['invoice_id']
+                       for _ in range(5)]
+        response = self.test_client.get(f'{self.prefix}', query_string={'limit': 3})
+        self.assertEqual(response.status_code, 200)
+        first_page = response.get_json()
+        self.assertEqual([invoice['invoice_id'] for invoice in first_page], invoice_ids[:3])
+        self.assertEqual(len(first_page[0]['invoice_items']), 1)
+        cursor = response.headers['X-Next-Cursor']
+        response = self.test_client.get(f'{self.prefix}', query_string={'limit': 3, 'cursor': cursor})
+        self.assertEqual([invoice['invoice_id'] for invoice in response.get_json()], invoice_ids[3:])
+        self.assertNotIn('X-Next-Cursor', response.headers)
+
+    def test_get_invoices_rejects_limit_below_one(self):
+        self.create_invoice(self.create_client(), [self.create_product()])
+        for query_string in ({'limit': -1}, {'limit': 0}, {'limit': -1, 'stream': 'true'}):
+            response = self.test_client.get(f'{self.prefix}', query_string=query_string)
+            self.assertEqual(response.status_code, 400)
+
+    def test_get_invoices_filters_by_client(self):
+        client_id = self.create_client()
+        other_client_id = self.create_client(client_tin='300000000000004')
+        product_id = self.create_product()
+        self.create_invoice(client_id, [product_id])
+        invoice_id = self.create_invoice(other_client_id, [product_id]).get_json()['invoice_details']['invoice_id']
+        response = self.test_client.get(f'{self.prefix}', query_string={'client_id': other_client_id})
+        self.assertEqual([invoice['invoice_id'] for invoice in response.get_json()], [invoice_id])
+        response = self.test_client.get(f'{self.prefix}', query_string={'created_to': '2000-01-01'})
+        self.assertEqual(response.get_json(), [])
+
+    def test_get_invoices_stream(self):
+        client_id = self.create_client()
+        product_id = self.create_product()
+        invoice_ids = [self.create_invoice(client_id, [product_id, product_id]).get_json()['invoice_details']['invoice_id']
+                       for _ in range(3)]
+        response = self.test_client.get(f'{self.prefix}', query_string={'stream': 'true'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        invoices = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([invoice['invoice_id'] for invoice in invoices], invoice_ids)
+        self.assertEqual(len(invoices[0]['invoice_items']), 2)
+
+    def test_download_invoice_served_from_pdf_cache(self):
+        client_id = self.create_client()
+        product_id = self.create_product()
+        invoice_id = self.create_invoice(client_id, [product_id]).get_json()['invoice_details']['invoice_id']
+        job_id = self.render_job_id(invoice_id)
+        filepath = get_cached_pdf_path(job_id)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'wb') as pdf_file:
+            pdf_file.write(b'%PDF-1.4 cached')
+        try:
+            response = self.test_client.get(f'{self.prefix}/{invoice_id}/download')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data, b'%PDF-1.4 cached')
+            response.close()
+            response = self.test_client.get(f'{self.prefix}/render-jobs/{job_id}')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_json()['status'], 'DONE')
+            response = self.test_client.post(f'{self.prefix}/{invoice_id}/render')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_json()['job']['job_id'], job_id)
+        finally:
+            os.unlink(filepath)
+
+    def test_get_invoice_conditional(self):
+        client_id = self.create_client()
+        product_id = self.create_product()
+        invoice_id = self.create_invoice(client_id, [product_id]).get_json()['invoice_details']['invoice_id']
+        response = self.test_client.get(f'{self.prefix}/{invoice_id}')
+        self.assertEqual(response.status_code, 200)
+        etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+        self.assertFalse(etag.startswith('W/'))
+        response = self.test_client.get(f'{self.prefix}/{invoice_id}', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(response.headers['ETag'], etag)
+        response = self.test_client.get(f'{self.prefix}/{invoice_id}', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 304)
+        response = self.test_client.get(f'{self.prefix}/{invoice_id}', headers={'If-None-Match': '"other"'})
+        self.assertEqual(response.status_code, 200)
+        response = self.test_client.get(f'{self.prefix}/SOME_RANDOM_ID', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 404)
+
+    def test_download_invoice_ranges(self):
+        client_id = self.create_client()
+        product_id = self.create_product()
+        invoice_id = self.create_invoice(client_id, [product_id]).get_json()['invoice_details']['invoice_id']
+        self.write_cached_pdf(invoice_id)
+        url = f'{self.prefix}/{invoice_id}/download'
+        response = self.test_client.get(url)
+        pdf, etag = response.data, response.headers['ETag']
+        response.close()
+        self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+        self.assertEqual(etag, f'"{self.render_job_id(invoice_id)}"')
+        response = self.test_client.get(url, headers={'Range': 'bytes=0-9'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, pdf[:10])
+        self.assertEqual(response.headers['Content-Range'], f'bytes 0-9/{len(pdf)}')
+        response.close()
+        response = self.test_client.get(url, headers={'Range': 'bytes=10-', 'If-Range': etag})
+        self.assertEqual(response.data, pdf[10:])
+        response.close()
+        response = self.test_client.get(url, headers={'Range': 'bytes=10-', 'If-Range': '"stale"'})
+        self.assertEqual(response.status_code, 200)
+        response.close()
+        response = self.test_client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        response = self.test_client.get(url, headers={'Range': f'bytes={len(pdf)}-'})
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response.headers['Content-Range'], f'bytes */{len(pdf)}')
+
+    def test_preview_invoice(self):
+        client_id = self.create_client()
+        product_id = self.create_product()
+        invoice = self.create_invoice(client_id, [product_id]).get_json()['invoice_details']
+        response = self.test_client.get(f'{self.prefix}/{invoice["invoice_id"]}/preview')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/html')
+        html = response.get_data(as_text=True)
+        self.assertIn(f'INVOICE #INV-{invoice["invoice_year"]}-000001', html)
+        self.assertIn('Acme Trading', html)
+        self.assertIn('SAR 74.52', html)
+
+    def test_compile_templates(self):
+        self.assertIn(INVOICE_TEMPLATE, compile_templates())
+        self.assertTrue(any(name.endswith('.cache') for name in os.listdir(bytecode_cache_dir)))
+
+    def test_download_unknown_invoice(self):
+        response = self.test_client.get(f'{self.prefix}/SOME_RANDOM_ID/download')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.get_json()['error_code'], 'INVOICE_NOT_FOUND')
+
+    def test_unknown_render_job(self):
+        response = self.test_client.get(f'{self.prefix}/render-jobs/SOME_RANDOM_ID')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.get_json()['error_code'], 'RENDER_JOB_NOT_FOUND')
+
+    def test_render_job_id_changes_with_renderer(self):
+        job_id = self.render_job_id('INVOICE_ID')
+        self.assertTrue(job_id.startswith('INVOICE_ID-'))
+        self.app.config['PDF_RENDERER'] = 'weasyprint'
+        self.assertNotEqual(self.render_job_id('INVOICE_ID'), job_id)
+
+    def test_failed_render_job_keeps_only_its_errors(self):
+        def start_failing_render(html, filepath, renderer_name):
+            future = Future()
+            future.set_exception(IOError('wkhtmltopdf exited with non-zero code 1'))
+            return future
+
+        def render_html():
+            # Templates render outside the lock, in parallel with other jobs
+            self.assertFalse(_jobs_lock.locked())
+            return '<html></html>'
+
+        with self.app.app_context():
+            submit_render_job('failedjob', render_html, start_failing_render)
+        self.assertNotIn('failedjob', _jobs)
+        response = self.test_client.get(f'{self.prefix}/render-jobs/failedjob')
+        self.assertEqual(response.get_json()['status'], 'FAILED')
+        self.assertEqual(response.get_json()['errors'], ['wkhtmltopdf exited with non-zero code 1'])
+
+    def test_render_pool_is_replaced_after_a_worker_dies(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        with self.app.app_context():
+            self.assertIsInstance(get_executor().submit(os._exit, 1).exception(), BrokenProcessPool)
+            future = start_pool_render('<html></html>', os.path.join(work_dir, 'invoice.pdf'), 'wkhtmltopdf')
+            # Fails here without wkhtmltopdf, but in the new pool
+            self.assertNotIsInstance(future.exception(timeout=60), BrokenProcessPool)
+
+    def write_cached_pdf(self, invoice_id):
+        filepath = get_cached_pdf_path(self.render_job_id(invoice_id))
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        writer = PdfFileWriter()
+        writer.addBlankPage(width=595, height=842)
+        with open(filepath, 'wb') as pdf_file:
+            writer.write(pdf_file)
+        self.addCleanup(os.unlink, filepath)
+
+    def test_export_invoices(self):
+        client_id = self.create_client()
+        product_id = self.create_product()
+        invoices = [self.create_invoice(client_id, [product_id]).get_json()['invoice_details'] for _ in range(2)]
+        for invoice in invoices:
+            self.write_cached_pdf(invoice['invoice_id'])
+
+        response = self.test_client.get(f'{self.prefix}/export', query_string={'client_id': client_id})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/zip')
+        with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+            self.assertEqual(archive.namelist(), [
+                f'invoice_INV-{invoice["invoice_year"]}-{invoice["sequence_number"]:06d}.pdf' for invoice in invoices
+            ] + ['export_report.json'])
+            report = json.loads(archive.read('export_report.json'))
+        self.assertEqual(report['invoice_count'], 2)
+        self.assertEqual(report['rendered_count'], 0)
+        self.assertEqual(report['failed_invoices'], [])
+
+        response = self.test_client.get(f'{self.prefix}/export', query_string={'client_id': client_id, 'format': 'pdf'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/pdf')
+        self.assertEqual(PdfFileReader(io.BytesIO(response.data)).getNumPages(), 2)
+
+    def test_search_invoices(self):
+        client_id = self.create_client()
+        product_id = self.create_product()
+        invoice = self.create_invoice(client_id, [product_id]).get_json()['invoice_details']
+        # Invoices keep the client details they were created with
+        self.test_client.put(f'/api/clients/{client_id}', json={"client_name": "Zenith Supplies"})
+        response = self.test_client.get(f'{self.prefix}/search', query_string={'q': 'acme riy'})
+        self.assertEqual([result['invoice_id'] for result in response.get_json()], [invoice['invoice_id']])
+        self.assertEqual(len(response.get_json()[0]['invoice_items']), 1)
+        response = self.test_client.get(f'{self.prefix}/search', query_string={'q': 'zenith'})
+        self.assertEqual(response.get_json(), [])
+
+    def test_invoices_share_catalog_versions(self):
+        client_id = self.create_client()
+        product_id = self.create_product()
+        first = self.create_invoice(client_id, [product_id, product_id]).get_json()['invoice_details']
+        # Fields that are not copied onto invoices leave the version as it is
+        self.test_client.put(f'/api/products/{product_id}', json={"product_description": "Logo work"})
+        self.create_invoice(client_id, [product_id])
+        self.test_client.put(f'/api/products/{product_id}', json={"product_price": 45.0})
+        self.create_invoice(client_id, [product_id], query_string={'dryrun': 'true'})
+        with self.app.app_context():
+            self.assertEqual(ProductVersion.query.count(), 1)
+        response = self.test_client.post(f'{self.prefix}/batch', json={"invoices": [self.invoice_data(client_id, [product_id])]})
+        last = response.get_json()['results'][0]['invoice_details']
+        with self.app.app_context():
+            self.assertEqual(ProductVersion.query.count(), 2)
+            self.assertEqual(ClientVersion.query.count(), 1)
+        response = self.test_client.get(f'{self.prefix}/{first["invoice_id"]}')
+        self.assertEqual(response.get_json(), first)
+        self.assertEqual([item['product_price'] for item in first['invoice_items']], [30.0, 30.0])
+        response = self.test_client.get(f'{self.prefix}/{last["invoice_id"]}')
+        self.assertEqual(response.get_json()['invoice_items'][0]['product_price'], 45.0)
+        self.assertEqual(response.get_json()['client_name'], 'Acme Trading')
+
+    def test_export_invoices_requires_filter(self):
+        response = self.test_client.get(f'{self.prefix}/export')
+        self.assertEqual(response.status_code, 400)
+
+    def test_create_invoice_batch(self):
+        client_id = self.create_client()
+        product_id = self.create_product()
+        response = self.test_client.post(f'{self.prefix}/batch', json={
+            "invoices": [self.invoice_data(client_id, [product_id] * n) for n in (1, 2, 3)]
+        })
+        self.assertEqual(response.status_code, 201)
+        results = response.get_json()['results']
+        self.assertEqual([result['status'] for result in results], ['SUCCESS'] * 3)
+        self.assertEqual([len(result['invoice_details']['invoice_items']) for result in results], [1, 2, 3])
+        self.assertAlmostEqual(results[0]['invoice_details']['invoice_net_amount'], 74.52)
+        invoice = results[2]['invoice_details']
+        response = self.test_client.get(f'{self.prefix}/{invoice["invoice_id"]}')
+        self.assertEqual(response.get_json()['invoice_number'], invoice['invoice_number'])
+        self.assertEqual(len(response.get_json()['invoice_items']), 3)
+
+    def test_create_invoice_batch_reports_errors_per_invoice(self):
+        client_id = self.create_client()
+        product_id = self.create_product()
+        response = self.test_client.post(f'{self.prefix}/batch', json={"invoices": [
+            self.invoice_data(client_id, [product_id]),
+            self.invoice_data('SOME_RANDOM_ID', [product_id]),
+            self.invoice_data(client_id, [product_id, 'MISSING_1']),
+            {"client_id": client_id, "invoice_items": []},
+            self.invoice_data(client_id, [product_id]),
+        ]})
+        self.assertEqual(response.status_code, 207)
+        results = response.get_json()['results']
+        self.assertEqual([result['status'] for result in results], ['SUCCESS', 'ERROR', 'ERROR', 'ERROR', 'SUCCESS'])
+        self.assertEqual(results[1]['error_code'], 'CLIENT_NOT_FOUND')
+        self.assertEqual(results[2]['product_ids'], ['MISSING_1'])
+        self.assertEqual(results[3]['errors'], ['Invoice must contain at least one invoice item'])
+        self.assertEqual(len(self.test_client.get(f'{self.prefix}').get_json()), 2)
+
+    def test_create_invoice_batch_rejects_wrong_types_per_invoice(self):
+        client_id = self.create_client()
+        product_id = self.create_product()
+        string_quantity = self.invoice_data(client_id, [product_id])
+        string_quantity['invoice_items'][0]['product_quantity'] = '2'
+        response = self.test_client.post(f'{self.prefix}/batch', json={"invoices": [
+            self.invoice_data(client_id, [product_id]),
+            self.invoice_data({"x": 1}, [product_id]),
+            self.invoice_data(client_id, [[1]]),
+            string_quantity
+        ]})
+        self.assertEqual(response.status_code, 207)
+        results = response.get_json()['results']
+        self.assertEqual([result['status'] for result in results], ['SUCCESS', 'ERROR', 'ERROR', 'ERROR'])
+        self.assertEqual(results[1]['errors'], ['client_id must be a string'])
+        self.assertEqual(results[2]['errors'], ['Invoice item 0 product_id must be a string'])
+        self.assertEqual(results[3]['errors'], ['Invoice item 0 product_quantity must be a number'])
+
+    def test_create_invoice_batch_dryrun(self):
+        client_id = self.create_client()
+        product_id = self.create_product()
+        response = self.test_client.post(f'{self.prefix}/batch', query_string={'dryrun': 'true'}, json={
+            "invoices": [self.invoice_data(client_id, [product_id])] * 2
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['status'] for result in response.get_json()['results']], ['SUCCESS'] * 2)
+        self.assertEqual(self.test_client.get(f'{self.prefix}').get_json(), [])
+
+    def query_plan(self, query):
+        compiled = query.statement.compile(dialect=db.engine.dialect)
+        params = tuple(compiled.params[name] for name in compiled.positiontup)
+        rows = db.engine.execute('EXPLAIN QUERY PLAN ' + str(compiled), params)
+        return ' '.join(row[-1] for row in rows)
+
+    def test_hot_queries_use_indexes(self):
+        with self.app.app_context():
+            created_from = datetime(2021, 1, 1)
+            plan = self.query_plan(query_invoices(client_id='CLIENT_ID', created_from=created_from))
+            self.assertIn('USING INDEX ix_invoices_client_id_created_at', plan)
+            plan = self.query_plan(query_invoices(created_from=created_from, created_to=datetime(2021, 2, 1)))
+            self.assertIn('USING INDEX ix_invoices_created_at', plan)
+            plan = self.query_plan(InvoiceItem.query.filter(InvoiceItem.invoice_id.in_(['A', 'B'])))
+            self.assertIn('USING INDEX ix_invoice_items_invoice_id', plan)
+            plan = self.query_plan(InvoiceItem.query.filter_by(product_id='PRODUCT_ID'))
+            self.assertIn('USING INDEX ix_invoice_items_product_id', plan)
+
+
+def create_invoices_in_process(db_uri, payloads):
+    test_client = create_app({'SQLALCHEMY_DATABASE_URI': db_uri}).test_client()
+    return [test_client.post('/api/invoices', json=payload).status_code for payload in payloads]
+
+
+class InvoiceNumberingTest(InvoiceFixtures, AppTest):
+
+    def setUp(self):
+        super().setUp()
+        _blocks.clear()
+        self.client_id = self.create_client()
+        self.product_id = self.create_product()
+
+    def invoice_in_series(self, series):
+        return dict(self.invoice_data(self.client_id, [self.product_id]), invoice_series=series)
+
+    def sequence_numbers(self):
+        with self.app.app_context():
+            numbers = {}
+            for series, year, sequence_number in db.session.query(
+                    Invoice.invoice_series, Invoice.invoice_year, Invoice.sequence_number).order_by(Invoice.invoice_number):
+                numbers.setdefault((series, year), []).append(sequence_number)
+            next_numbers = {(sequence.series, sequence.year): sequence.next_number for sequence in InvoiceSequence.query}
+            return numbers, next_numbers
+
+    def test_numbers_per_series(self):
+        self.create_invoice(self.client_id, [self.product_id])
+        response = self.test_client.post(self.prefix, json=self.invoice_in_series('EXP'))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.get_json()['invoice_details']['sequence_number'], 1)
+        response = self.test_client.post(f'{self.prefix}/batch', json={'invoices': [
+            self.invoice_in_series('INV'), self.invoice_in_series('EXP'), self.invoice_in_series('INV')
+        ]})
+        self.assertEqual([result['invoice_details']['sequence_number'] for result in response.get_json()['results']], [2, 2, 3])
+        numbers, next_numbers = self.sequence_numbers()
+        year = datetime.utcnow().year
+        self.assertEqual(numbers, {('INV', year): [1, 2, 3], ('EXP', year): [1, 2]})
+        self.assertEqual(next_numbers, {('INV', year): 4, ('EXP', year): 3})
+
+    def test_invalid_series(self):
+        response = self.test_client.post(self.prefix, json=self.invoice_in_series('inv-1'))
+        self.assertEqual(response.status_code, 400)
+
+    def test_failed_invoice_leaves_no_gap(self):
+        data = self.invoice_in_series('INV')
+        data['invoice_items'][0]['not_a_column'] = True
+        self.assertEqual(self.test_client.post(self.prefix, json=data).status_code, 400)
+        response = self.create_invoice(self.client_id, [self.product_id])
+        self.assertEqual(response.get_json()['invoice_details']['sequence_number'], 1)
+
+    def test_block_allocation(self):
+        self.app.config['INVOICE_SEQUENCE_BLOCK_SIZES'] = {'DRAFT': 10}
+        with self.app.app_context():
+            self.assertEqual([allocate_invoice_numbers('DRAFT', 2021) for _ in range(3)], [1, 2, 3])
+            self.assertEqual(allocate_invoice_numbers('DRAFT', 2021, count=8), 11)
+            self.assertEqual(InvoiceSequence.query.get(('DRAFT', 2021)).next_number, 21)
+
+    def test_block_allocation_with_idempotency_key(self):
+        self.app.config['INVOICE_SEQUENCE_BLOCK_SIZES'] = {'DRAFT': 10}
+        payload = self.invoice_in_series('DRAFT')
+        response = self.test_client.post(self.prefix, json=payload, headers={'Idempotency-Key': 'draft-1'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.get_json()['invoice_details']['sequence_number'], 1)
+        retry = self.test_client.post(self.prefix, json=payload, headers={'Idempotency-Key': 'draft-1'})
+        self.assertEqual(retry.get_data(), response.get_data())
+
+    def test_batch_mixing_gapless_and_block_series(self):
+        # PRO sorts after INV, so its block is reserved after the gapless numbers unless it goes first
+        self.app.config['INVOICE_SEQUENCE_BLOCK_SIZES'] = {'PRO': 10}
+        response = self.test_client.post(f'{self.prefix}/batch', json={'invoices': [
+            self.invoice_in_series('INV'), self.invoice_in_series('PRO'), self.invoice_in_series('INV')
+        ]})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([result['invoice_details']['sequence_number'] for result in response.get_json()['results']], [1, 1, 2])
+        year = datetime.utcnow().year
+        self.assertEqual(self.sequence_numbers()[1], {('INV', year): 3, ('PRO', year): 11})
+
+    def test_concurrent_writers_are_gapless(self):
+        failing = self.invoice_in_series('INV')
+        failing['invoice_items'][0]['not_a_column'] = True
+        payloads = [self.invoice_in_series(('INV', 'EXP')[i % 2]) for i in range(20)] + [failing] * 4
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(4) as pool:
+            results = pool.starmap(create_invoices_in_process, [(self.app.config['SQLALCHEMY_DATABASE_URI'], payloads)] * 4)
+        for statuses in results:
+            self.assertEqual(statuses, [201] * 20 + [400] * 4)
+        numbers, next_numbers = self.sequence_numbers()
+        year = datetime.utcnow().year
+        for series in ('INV', 'EXP'):
+            self.assertEqual(sorted(numbers[(series, year)]), list(range(1, 41)))
+            self.assertEqual(next_numbers[(series, year)], 41)
+
+
+def post_idempotent_invoice_in_process(db_uri, payload, idempotency_key):
+    response = create_app({'SQLALCHEMY_DATABASE_URI': db_uri}).test_client().post('/api/invoices', json=payload, headers={'Idempotency-Key': idempotency_key})
+    return response.status_code, response.get_data(as_text=True)
+
+
+class InvoiceIdempotencyTest(InvoiceFixtures, AppTest):
+
+    def setUp(self):
+        super().setUp()
+        self.client_id = self.create_client()
+        self.product_id = self.create_product()
+
+    def post_invoice(self, payload, idempotency_key='retry-1', query_string=None):
+        return self.test_client.post(self.prefix, json=payload, query_string=query_string,
+                                     headers={'Idempotency-Key': idempotency_key})
+
+    def invoice_count(self):
+        with self.app.app_context():
+            return Invoice.query.count()
+
+    def test_retry_replays_stored_response(self):
+        payload = self.invoice_data(self.client_id, [self.product_id])
+        first = self.post_invoice(payload)
+        self.assertEqual(first.status_code, 201)
+        retry = self.post_invoice(payload)
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.get_json(), first.get_json())
+        self.assertEqual(self.invoice_count(), 1)
+        self.assertEqual(self.post_invoice(payload, 'retry-2').status_code, 201)
+        self.assertEqual(self.invoice_count(), 2)
+
+    def test_key_reused_for_different_request(self):
+        self.post_invoice(self.invoice_data(self.client_id, [self.product_id]))
+        response = self.post_invoice(self.invoice_data(self.client_id, [self.product_id, self.product_id]))
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(response.get_json()['error_code'], 'IDEMPOTENCY_KEY_REUSED')
+        self.assertEqual(self.invoice_count(), 1)
+
+    def test_failed_request_can_be_retried(self):
+        payload = self.invoice_data('UNKNOWN_CLIENT', [self.product_id])
+        self.assertEqual(self.post_invoice(payload).status_code, 404)
+        self.assertEqual(self.post_invoice(payload, query_string={'dryrun': 'true'}).status_code, 404)
+        payload = self.invoice_data(self.client_id, [self.product_id])
+        self.assertEqual(self.post_invoice(payload, 'retry-2', query_string={'dryrun': 'true'}).status_code, 200)
+        self.assertEqual(self.post_invoice(payload, 'retry-2').status_code, 201)
+        self.assertEqual(self.post_invoice(payload, 'x' * 256).status_code, 400)
+        self.assertEqual(self.invoice_count(), 1)
+
+    def test_expired_key_is_reused(self):
+        payload = self.invoice_data(self.client_id, [self.product_id])
+        self.post_invoice(payload)
+        with self.app.app_context():
+            IdempotencyKey.query.update({'expires_at': datetime(2000, 1, 1)})
+            db.session.commit()
+        response = self.post_invoice(payload)
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn('Idempotent-Replayed', response.headers)
+        self.assertEqual(self.invoice_count(), 2)
+        with self.app.app_context():
+            self.assertEqual(IdempotencyKey.query.count(), 1)
+
+    def test_concurrent_duplicates_create_one_invoice(self):
+        payload = self.invoice_data(self.client_id, [self.product_id])
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(4) as pool:
+            results = pool.starmap(post_idempotent_invoice_in_process,
+                                   [(self.app.config['SQLALCHEMY_DATABASE_URI'], payload, 'concurrent')] * 8)
+        self.assertEqual({status for status, _ in results}, {201})
+        self.assertEqual(len({json.loads(body)['invoice_details']['invoice_id'] for _, body in results}), 1)
+        self.assertEqual(self.invoice_count(), 1)
+
+
+class PricingTest(unittest.TestCase):
+
+    def test_price_lines_matches_reference(self):
+        rng = random.Random(5)
+        lines = [(
+            rng.randint(1, 10 ** 7) / 100,
+            rng.randint(1, 10 ** 5) / 1000,
+            rng.randint(0, 5000) / 100,
+            rng.randint(0, 10000) / 100,
+            rng.choice((0.0, 5.0, 15.0, 2.5)),
+            rng.random() < 0.8
+        ) for _ in range(2000)]
+        line_amounts = price_lines(*zip(*lines))
+        for i, line in enumerate(lines):
+            expected = price_line_reference(*line)
+            self.assertEqual({name: int(values[i]) for name, values in line_amounts.items()}, expected)
+
+    def test_rounds_half_up(self):
+        # 0.15 * 10% = 0.015 SAR, which rounds to 0.02 and not to the even 0.01
+        line_amounts = price_lines([0.15], [1], [10.0], [0.0], [0.0], [True])
+        self.assertEqual(line_amounts['markup_amount'].tolist(), [2])
+        self.assertEqual(price_line_reference(0.15, 1, 10.0, 0.0, 0.0, True)['markup_amount'], 2)
+
+    def test_totals_are_sums_of_rounded_lines(self):
+        items = [{
+            'product_price': 0.1,
+            'product_quantity': 1,
+            'product_markup_percent': 0.0,
+            'product_discount_percent': 0.0,
+            'product_vat_percent': 15.0
+        }] * 3 + [{
+            'product_price': 0.2,
+            'product_quantity': 1,
+            'product_markup_percent': 0.0,
+            'product_discount_percent': 0.0,
+            'product_vat_percent': 15.0
+        }]
+        line_amounts, totals = price_invoices(items, [3, 1], [True, False])
+        self.assertEqual(line_amounts['vat_amount'], [0.02, 0.02, 0.02, 0.0])
+        self.assertEqual(totals['invoice_gross_amount'], [0.3, 0.2])
+        self.assertEqual(totals['total_tax_amount'], [0.06, 0.0])
+        self.assertEqual(totals['invoice_net_amount'], [0.36, 0.2])
+
+    def test_rejects_sub_minor_unit_prices(self):
+        with self.assertRaises(ValueError):
+            price_lines([1.005], [1], [0.0], [0.0], [0.0], [True])
+        with self.assertRaises(ValueError):
+            price_line_reference(1.005, 1, 0.0, 0.0, 0.0, True)
+
+    def test_rejects_values_that_are_not_finite_numbers(self):
+        for quantities, message in (([None], 'product_quantity must be a number'), (['2'], 'product_quantity must be a number'),
+                                    ([True], 'product_quantity must be a number'),
+                                    ([float('inf')], 'product_quantity must be a finite number')):
+            with self.assertRaisesRegex(ValueError, f'^{message}$'):
+                price_lines([1.0], quantities, [0.0], [0.0], [0.0], [True])
+        self.assertEqual(price_lines([1.0], [2], [0], [0], [0], [True])['net_amount'].tolist(), [200])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import cProfile
+import os
+import threading
+import time
+from bisect import bisect_left
+from datetime import datetime
+
+from flask import g, has_app_context, request
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+RENDER_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    # Cumulative buckets per label set, rendered in the Prometheus text format
+
+    def __init__(self, name, help_text, label_names, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0}
+            series['counts'][bisect_left(self.buckets, value)] += 1
+            series['sum'] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for labels, series in sorted(self.series.items()):
+                label_text = ','.join(f'{name}="{value}"' for name, value in zip(self.label_names, labels))
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), series['counts']):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{{{label_text},le="{bound}"}} {cumulative}')
+                lines.append(f'{self.name}_sum{{{label_text}}} {series["sum"]}')
+                lines.append(f'{self.name}_count{{{label_text}}} {cumulative}')
+        return lines
+
+
+class Metrics:
+    # Per process, like the catalog cache: each gunicorn worker serves its own /metrics
+
+    def __init__(self):
+        self.request_duration = Histogram('http_request_duration_seconds', 'Request latency by endpoint.',
+                                          ('blueprint', 'endpoint', 'method', 'status'), LATENCY_BUCKETS)
+        self.sql_statements = Histogram('sql_statements_per_request', 'SQL statements executed per request.',
+                                        ('blueprint', 'endpoint'), STATEMENT_BUCKETS)
+        self.sql_duration = Histogram('sql_duration_seconds_per_request', 'Time spent in SQL per request.',
+                                      ('blueprint', 'endpoint'), LATENCY_BUCKETS)
+        self.pdf_render_duration = Histogram('pdf_render_duration_seconds', 'PDF render jobs from submit to finish.',
+                                             ('renderer', 'status'), RENDER_BUCKETS)
+        self.profile_threshold = None
+        self.profile_dir = None
+
+    def init_app(self, app):
+        # PROFILE_SLOW_REQUESTS is a threshold in seconds; every request is profiled and the ones at or
+        # over the threshold are dumped as .prof files for pstats or snakeviz
+        self.profile_threshold = app.config.get('PROFILE_SLOW_REQUESTS')
+        self.profile_dir = app.config.get('PROFILE_DIR', 'profiles')
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+
+    def before_request(self):
+        g.request_started_at = time.perf_counter()
+        g.sql_statements = 0
+        g.sql_duration = 0.0
+        if self.profile_threshold:
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    def after_request(self, response):
+        if 'request_started_at' not in g:
+            return response
+        labels = (request.blueprint or '', request.endpoint or 'unmatched', request.method, str(response.status_code))
+        state = g._get_current_object()
+        if response.is_streamed:
+            # A streamed body (NDJSON listing, export, import) is generated after this, with its SQL; the request
+            # is over when the server has sent it and closes the response
+            response.call_on_close(lambda: self.observe_request(state, *labels))
+        else:
+            self.observe_request(state, *labels)
+        return response
+
+    def observe_request(self, state, blueprint, endpoint, method, status):
+        # state is the request's g, which streamed responses outlive
+        duration = time.perf_counter() - state.request_started_at
+        self.request_duration.observe(duration, blueprint, endpoint, method, status)
+        self.sql_statements.observe(state.sql_statements, blueprint, endpoint)
+        self.sql_duration.observe(state.sql_duration, blueprint, endpoint)
+        if 'profiler' in state:
+            state.profiler.disable()
+            if duration >= self.profile_threshold:
+                self.dump_profile(state.profiler, endpoint, duration)
+
+    def dump_profile(self, profiler, endpoint, duration):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        timestamp = datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+        profiler.dump_stats(os.path.join(self.profile_dir, f'{timestamp}-{endpoint}-{duration * 1e3:.0f}ms.prof'))
+
+    def observe_render(self, renderer_name, future, submitted_at):
+        status = 'failed' if future.exception() is not None else 'done'
+        self.pdf_render_duration.observe(time.perf_counter() - submitted_at, renderer_name, status)
+
+    def render(self):
+        lines = []
+        for histogram in (self.request_duration, self.sql_statements, self.sql_duration, self.pdf_render_duration):
+            lines += histogram.render()
+        return '\n'.join(lines) + '\n'
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started_at', []).append((statement, time.perf_counter()))
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info['query_started_at'].pop()[1]
+    if has_app_context() and 'sql_statements' in g:
+        g.sql_statements += 1
+        g.sql_duration += duration
+
+
+def handle_error(exception_context):
+    # A statement that raised never reaches after_cursor_execute, its start must not stay on the pooled connection.
+    # Errors raised before the cursor executed, e.g. by a bind parameter, have no start to remove.
+    started = exception_context.connection.info.get('query_started_at') if exception_context.connection else None
+    if started and started[-1][0] is exception_context.statement:
+        started.pop()
+
+
+metrics = Metrics()
@@ -0,0 +1,260 @@
+from collections import namedtuple
+from datetime import datetime
+
+from application.clients.models import ClientVersion
+from application.products.models import ProductVersion
+from application.reports.routes import REBUILD_SUMMARIES
+from application.search import SEARCH_INDEXES, search_index_statements
+from application.versioning import content_hash
+
+# A migration is a list of SQL statements or callables taking a DBAPI cursor. Every schema change
+# made to the models also gets a migration here, so existing databases can be brought up to date.
+# Deploys apply them with `flask db_migrate` before the workers start, see the Procfile.
+Migration = namedtuple('Migration', ('version', 'description', 'operations'))
+
+
+def _backfill_versions(model, table, version_column, expressions=None):
+    # Stores each distinct copy of the catalog fields held by `table` once as a version and points the rows
+    # at it. The hash is computed in SQL through a function, so both steps are a single statement.
+    fields = (model.owner_field,) + model.copied_fields
+    # Qualified, the versions table has columns of the same names
+    values = ', '.join((expressions or {}).get(field, f'{table}.{field}') for field in fields)
+    versions = model.__tablename__
+
+    def backfill(cursor):
+        cursor.connection.create_function(f'{versions}_hash', len(fields), deterministic=True,
+                                          func=lambda *row: content_hash(model.snapshot(dict(zip(fields, row)))))
+        cursor.execute(f'''
+            INSERT OR IGNORE INTO {versions} (content_hash, created_at, {', '.join(fields)})
+            SELECT {versions}_hash({values}), ?, {values} FROM {table}
+        ''', (datetime.utcnow().isoformat(' '),))
+        cursor.execute(f'''
+            UPDATE {table} SET {version_column} = (
+                SELECT version_id FROM {versions} WHERE content_hash = {versions}_hash({values})
+            )
+        ''')
+    return backfill
+
+
+MIGRATIONS = [
+    Migration(1, 'Index invoice query hot paths', [
+        'CREATE INDEX IF NOT EXISTS ix_invoices_client_id_created_at ON invoices (client_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS ix_invoices_created_at ON invoices (created_at)',
+        'CREATE INDEX IF NOT EXISTS ix_invoice_items_invoice_id ON invoice_items (invoice_id)',
+        'CREATE INDEX IF NOT EXISTS ix_invoice_items_product_id ON invoice_items (product_id)',
+        'ANALYZE'
+    ]),
+    Migration(2, 'Add daily client and product summaries', [
+        '''
+        CREATE TABLE IF NOT EXISTS daily_client_summaries (
+            day DATE NOT NULL,
+            client_id VARCHAR NOT NULL,
+            invoice_count INTEGER NOT NULL,
+            invoice_gross_amount INTEGER NOT NULL,
+            total_discount_amount INTEGER NOT NULL,
+            total_tax_amount INTEGER NOT NULL,
+            invoice_net_amount INTEGER NOT NULL,
+            standard_rated_amount INTEGER NOT NULL,
+            zero_rated_amount INTEGER NOT NULL,
+            PRIMARY KEY (day, client_id)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS ix_daily_client_summaries_client_id_day ON daily_client_summaries (client_id, day)',
+        '''
+        CREATE TABLE IF NOT EXISTS daily_product_summaries (
+            day DATE NOT NULL,
+            product_id VARCHAR NOT NULL,
+            line_count INTEGER NOT NULL,
+            product_quantity FLOAT NOT NULL,
+            gross_amount INTEGER NOT NULL,
+            discount_amount INTEGER NOT NULL,
+            vat_amount INTEGER NOT NULL,
+            net_amount INTEGER NOT NULL,
+            PRIMARY KEY (day, product_id)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS ix_daily_product_summaries_product_id_day ON daily_product_summaries (product_id, day)'
+        # Filled by migration 7, REBUILD_SUMMARIES reads the catalog versions of migration 6
+    ]),
+    Migration(3, 'Number invoices per series and year', [
+        "ALTER TABLE invoices ADD COLUMN invoice_series VARCHAR NOT NULL DEFAULT 'INV'",
+        'ALTER TABLE invoices ADD COLUMN invoice_year INTEGER',
+        'ALTER TABLE invoices ADD COLUMN sequence_number INTEGER',
+        "UPDATE invoices SET invoice_year = CAST(strftime('%Y', created_at) AS INTEGER)",
+        # Existing invoices keep their order, numbered from 1 within each year
+        '''
+        CREATE TEMP TABLE invoice_sequence_backfill AS
+        SELECT invoice_number, row_number() OVER (PARTITION BY invoice_series, invoice_year ORDER BY invoice_number) AS sequence_number
+        FROM invoices
+        ''',
+        'CREATE UNIQUE INDEX temp.ix_invoice_sequence_backfill ON invoice_sequence_backfill (invoice_number)',
+        '''
+        UPDATE invoices SET sequence_number = (
+            SELECT sequence_number FROM invoice_sequence_backfill WHERE invoice_sequence_backfill.invoice_number = invoices.invoice_number
+        )
+        ''',
+        'DROP TABLE invoice_sequence_backfill',
+        '''
+        CREATE UNIQUE INDEX IF NOT EXISTS ix_invoices_series_year_sequence
+        ON invoices (invoice_series, invoice_year, sequence_number)
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS invoice_sequences (
+            series VARCHAR NOT NULL,
+            year INTEGER NOT NULL,
+            next_number INTEGER NOT NULL,
+            PRIMARY KEY (series, year)
+        )
+        ''',
+        '''
+        INSERT INTO invoice_sequences (series, year, next_number)
+        SELECT invoice_series, invoice_year, max(sequence_number) + 1 FROM invoices GROUP BY invoice_series, invoice_year
+        '''
+    ]),
+    Migration(4, 'Add full text search over clients, products and invoices', [
+        *search_index_statements('clients', *SEARCH_INDEXES['clients']),
+        *search_index_statements('products', *SEARCH_INDEXES['products']),
+        # Moved to client_versions by migration 6
+        *search_index_statements('invoices', ('client_name', 'client_tin', 'client_city'), (10.0, 5.0, 1.0)),
+        *[f"INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild')" for table in ('clients', 'products', 'invoices')]
+    ]),
+    Migration(5, 'Store responses of idempotent requests', [
+        '''
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            idempotency_key VARCHAR NOT NULL PRIMARY KEY,
+            fingerprint VARCHAR NOT NULL,
+            status_code INTEGER,
+            response_body TEXT,
+            created_at DATETIME NOT NULL,
+            expires_at DATETIME NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS ix_idempotency_keys_expires_at ON idempotency_keys (expires_at)'
+    ]),
+    # Run VACUUM afterwards to hand the space of the dropped columns back, it cannot run inside the migration
+    Migration(6, 'Store catalog snapshots once as versions', [
+        '''
+        CREATE TABLE IF NOT EXISTS product_versions (
+            version_id INTEGER NOT NULL PRIMARY KEY,
+            content_hash VARCHAR NOT NULL UNIQUE,
+            created_at DATETIME NOT NULL,
+            product_id VARCHAR NOT NULL REFERENCES products (product_id),
+            product_name VARCHAR NOT NULL,
+            product_price FLOAT NOT NULL,
+            product_price_currency VARCHAR NOT NULL,
+            product_vat_percent FLOAT NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS client_versions (
+            version_id INTEGER NOT NULL PRIMARY KEY,
+            content_hash VARCHAR NOT NULL UNIQUE,
+            created_at DATETIME NOT NULL,
+            client_id VARCHAR NOT NULL REFERENCES clients (client_id),
+            client_name VARCHAR NOT NULL,
+            client_tin VARCHAR NOT NULL,
+            client_address VARCHAR NOT NULL,
+            client_city VARCHAR NOT NULL,
+            is_client_taxable BOOLEAN NOT NULL CHECK (is_client_taxable IN (0, 1))
+        )
+        ''',
+        'ALTER TABLE invoice_items ADD COLUMN product_version_id INTEGER REFERENCES product_versions (version_id)',
+        'ALTER TABLE invoices ADD COLUMN client_version_id INTEGER REFERENCES client_versions (version_id)',
+        _backfill_versions(ProductVersion, 'invoice_items', 'product_version_id'),
+        # The old column was a VARCHAR, holding '1' and '0' or 'True' and 'False'
+        _backfill_versions(ClientVersion, 'invoices', 'client_version_id',
+                           {'is_client_taxable': "lower(invoices.is_client_taxable) IN ('1', 'true')"}),
+        'CREATE INDEX IF NOT EXISTS ix_invoices_client_version_id ON invoices (client_version_id)',
+        # Invoices are searched through the client versions they reference
+        'DROP TRIGGER IF EXISTS invoices_fts_insert',
+        'DROP TRIGGER IF EXISTS invoices_fts_delete',
+        'DROP TRIGGER IF EXISTS invoices_fts_update',
+        'DROP TABLE IF EXISTS invoices_fts',
+        *search_index_statements('client_versions', *SEARCH_INDEXES['client_versions']),
+        "INSERT INTO client_versions_fts (client_versions_fts) VALUES ('rebuild')",
+        *[f'ALTER TABLE invoice_items DROP COLUMN {column}' for column in ProductVersion.copied_fields],
+        *[f'ALTER TABLE invoices DROP COLUMN {column}' for column in ClientVersion.copied_fields],
+        # DROP COLUMN writes every REAL back as an 8 byte float, assigned again whole numbers get their compact
+        # integer form back, which is how inserted rows store them
+        *[f"UPDATE {table} SET {', '.join(f'{column} = {column}' for column in columns)}" for table, columns in (
+            ('invoice_items', ('product_quantity', 'total_price', 'markup_amount', 'gross_amount', 'discount_amount',
+                               'amount_after_discount', 'vat_amount', 'net_amount', 'product_discount_percent',
+                               'product_markup_percent')),
+            ('invoices', ('invoice_gross_amount', 'total_discount_amount', 'total_tax_amount', 'invoice_net_amount'))
+        )]
+    ]),
+    # Lines used to be filed by the sign of their rounded VAT, credit lines and VAT rounded to 0 were zero rated
+    Migration(7, 'Classify summary amounts by VAT rate', REBUILD_SUMMARIES),
+]
+
+CREATE_MIGRATIONS_TABLE = '''
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INTEGER NOT NULL PRIMARY KEY,
+    description VARCHAR NOT NULL,
+    applied_at DATETIME NOT NULL
+)
+'''
+
+
+def _applied_versions(cursor):
+    cursor.execute(CREATE_MIGRATIONS_TABLE)
+    return {row[0] for row in cursor.execute('SELECT version FROM schema_migrations')}
+
+
+def _run(engine, apply):
+    # Manage the transaction by hand, pysqlite does not open one around DDL statements.
+    # BEGIN IMMEDIATE takes the write lock up front so concurrent migrators run one after another.
+    connection = engine.raw_connection()
+    dbapi_connection = connection.connection
+    isolation_level = dbapi_connection.isolation_level
+    dbapi_connection.isolation_level = None
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        result = apply(cursor)
+        cursor.execute('COMMIT')
+        return result
+    except Exception:
+        cursor.execute('ROLLBACK')
+        raise
+    finally:
+        cursor.close()
+        dbapi_connection.isolation_level = isolation_level
+        connection.close()
+
+
+def get_schema_version(engine):
+    return _run(engine, lambda cursor: max(_applied_versions(cursor), default=0))
+
+
+def migrate(engine, target_version=None):
+    def apply(cursor):
+        applied = _applied_versions(cursor)
+        applied_now = []
+        for migration in MIGRATIONS:
+            if migration.version in applied or (target_version is not None and migration.version > target_version):
+                continue
+            for operation in migration.operations:
+                if callable(operation):
+                    operation(cursor)
+                else:
+                    cursor.execute(operation)
+            _record(cursor, migration)
+            applied_now.append(migration)
+        return applied_now
+    return _run(engine, apply)
+
+
+def stamp(engine):
+    # For databases built by create_all, which already match the latest migration
+    def apply(cursor):
+        applied = _applied_versions(cursor)
+        for migration in MIGRATIONS:
+            if migration.version not in applied:
+                _record(cursor, migration)
+    _run(engine, apply)
+
+
+def _record(cursor, migration):
+    cursor.execute('INSERT INTO schema_migrations (version, description, applied_at) VALUES (?, ?, ?)',
+                   (migration.version, migration.description, datetime.utcnow().isoformat(' ')))
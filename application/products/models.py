@@ -1,7 +1,8 @@
 from datetime import datetime
-from sqlalchemy import Column, String, Float, DateTime
+from sqlalchemy import Column, String, Float, DateTime, ForeignKey
 from sqlalchemy.orm import relationship
 from application import db
+from application.versioning import CatalogVersion
 
 
 class Product(db.Model):
@@ -17,3 +18,15 @@ class Product(db.Model):
     created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
     last_updated_at = Column(DateTime, default=datetime.utcnow)
     invoice_items = relationship('InvoiceItem', backref='product')
+
+
+class ProductVersion(CatalogVersion, db.Model):
+    __tablename__ = 'product_versions'
+    product_id = Column(String, ForeignKey('products.product_id'), nullable=False)
+    product_name = Column(String, nullable=False)
+    product_price = Column(Float, nullable=False)
+    product_price_currency = Column(String, nullable=False)
+    product_vat_percent = Column(Float, nullable=False)
+
+    owner_field = 'product_id'
+    copied_fields = ('product_name', 'product_price', 'product_price_currency', 'product_vat_percent')
@@ -1,12 +1,30 @@
+import json
 from datetime import datetime
 from uuid import uuid4
-from flask import jsonify, request, Blueprint
+from flask import jsonify, request, stream_with_context, Blueprint, Response
+from application import SQLITE_MAX_VARIABLE_NUMBER
+from application.cache import cache
+from application.conditional import is_not_modified, not_modified, set_validators, version_etag, with_etag, \
+    without_etag
+from application.importing import IMPORT_CHUNK_SIZE, REQUIRED, get_import_format, import_records, read_records, to_float, to_string
+from application.search import search
+from application.serialization import fast_jsonify
 from .models import db, Product
-from .schemas import product_schema, products_schema
+from .schemas import dump_product, dump_products, validate_product, validate_product_rows
 
 
 products_api = Blueprint('products_api', __name__)
 
+PRODUCT_IMPORT_FIELDS = (
+    ('product_name', to_string, REQUIRED),
+    ('product_description', to_string, None),
+    ('product_price_currency', to_string, 'SAR'),
+    ('product_price', to_float, REQUIRED),
+    ('product_discount_percent', to_float, 0),
+    ('product_markup_percent', to_float, 20),
+    ('product_vat_percent', to_float, 0)
+)
+
 
 def insert_product(**args):
     args['product_id'] = uuid4().hex
@@ -15,33 +33,105 @@ def insert_product(**args):
     product = Product(**args)
     db.session.add(product)
     db.session.commit()
+    invalidate_product()
     return product
 
 
+def invalidate_product(product_id: str = None):
+    if product_id:
+        cache.delete('product', product_id)
+    cache.delete('product_list', 'all')
+
+
+def import_products(records, is_dryrun=False, chunk_size=IMPORT_CHUNK_SIZE):
+    for event in import_records(Product, PRODUCT_IMPORT_FIELDS, records, validate_product_rows, is_dryrun, chunk_size):
+        if event['event'] == 'done' and event['imported']:
+            invalidate_product()
+        yield event
+
+
+@products_api.route('import', methods=['POST'])
+def import_products_file():
+    try:
+        import_format = get_import_format(request)
+        is_dryrun = request.args.get('dryrun').lower() in ('true', '1') if request.args.get('dryrun') else False
+    except Exception as e:
+        return jsonify(status='ERROR', errors=e.args), 400
+    # Progress and row errors are streamed back as NDJSON while the upload is still being read
+    events = import_products(read_records(request.stream, import_format), is_dryrun)
+    return Response(stream_with_context(json.dumps(event) + '\n' for event in events), mimetype='application/x-ndjson')
+
+
 @products_api.route('', methods=['GET'])
 def get_products():
-    query_result = db.session.query(Product).all()
-    products_list = products_schema.dump(query_result)
-    return jsonify(products_list)
+    products_list = cache.get('product_list', 'all', lambda: dump_products(db.session.query(Product).all()))
+    return fast_jsonify(products_list)
+
+
+@products_api.route('search', methods=['GET'])
+def search_products():
+    try:
+        products, next_offset = search(Product)
+        response = fast_jsonify(dump_products(products))
+        if next_offset is not None:
+            response.headers['X-Next-Offset'] = str(next_offset)
+        return response, 200
+    except Exception as e:
+        return jsonify(status='ERROR', errors=e.args), 400
+
+
+def load_products(product_ids):
+    # Resolve every requested product with one IN (...) query per chunk of ids
+    products = {}
+    for offset in range(0, len(product_ids), SQLITE_MAX_VARIABLE_NUMBER):
+        chunk = product_ids[offset:offset + SQLITE_MAX_VARIABLE_NUMBER]
+        for product in Product.query.filter(Product.product_id.in_(chunk)):
+            products[product.product_id] = with_etag(dump_product(product), product.last_updated_at)
+    return products
+
+
+def get_product_by_id(product_id: str, etag):
+    # Returns the serialized product, served from the catalog cache unless the entry is of another version than etag
+    return cache.get('product', product_id, lambda: load_products([product_id]).get(product_id),
+                     lambda product: product['_etag'] == etag)
+
+
+def load_product_etags(product_ids):
+    # The version of every requested product that exists, one IN (...) query of two columns per chunk of ids
+    etags = {}
+    for offset in range(0, len(product_ids), SQLITE_MAX_VARIABLE_NUMBER):
+        chunk = product_ids[offset:offset + SQLITE_MAX_VARIABLE_NUMBER]
+        query = db.session.query(Product.product_id, Product.last_updated_at).filter(Product.product_id.in_(chunk))
+        for product_id, last_updated_at in query:
+            etags[product_id] = version_etag(last_updated_at) if last_updated_at else None
+    return etags
 
 
-def get_product_by_id(product_id: str):
-    return Product.query.filter_by(product_id=product_id).first()
+def get_products_by_ids(product_ids):
+    # Invoices are priced from these, a cached product of another version than the row's is loaded again
+    unique_ids = list(dict.fromkeys(product_ids))
+    etags = load_product_etags(unique_ids)
+    products = cache.get_many('product', [product_id for product_id in unique_ids if product_id in etags], load_products,
+                              lambda product_id, product: product['_etag'] == etags[product_id])
+    missing_ids = [product_id for product_id in unique_ids if product_id not in products]
+    return products, missing_ids
 
 
 @products_api.route('<product_id>', methods=['PUT'])
 def put_product_details(product_id: str):
     try:
-        row = get_product_by_id(product_id)
+        row = Product.query.filter_by(product_id=product_id).first()
         if row:
             data = request.get_json()
+            validate_product(data)
             exclude_columns = ('created_at', 'last_updated_at', 'product_id')
             for column_name in data:
                 if column_name not in exclude_columns:
                     setattr(row, column_name, data[column_name])
             setattr(row, 'last_updated_at', datetime.utcnow())
             db.session.commit()
-            return jsonify(status='SUCCESS', message='Product updated successfully!', updated_product=product_schema.dump(row)), 200
+            invalidate_product(product_id)
+            return jsonify(status='SUCCESS', message='Product updated successfully!', updated_product=dump_product(row)), 200
         else:
             return jsonify(error_code='PRODUCT_NOT_FOUND', message='Product not found!'), 404
     except Exception as e:
@@ -51,9 +141,16 @@ def put_product_details(product_id: str):
 
 @products_api.route('<product_id>', methods=['GET'])
 def get_product_details(product_id: str):
-    row = get_product_by_id(product_id)
-    if row:
-        return jsonify(product_schema.dump(row)), 200
+    # The version is a primary key lookup of one column, a matching ETag is answered without the product
+    version = db.session.query(Product.last_updated_at).filter_by(product_id=product_id).first()
+    etag = version_etag(version.last_updated_at) if version and version.last_updated_at else None
+    if etag and is_not_modified(etag):
+        return not_modified(etag, weak=True)
+    # The cached body is the one the ETag names, or it is loaded again
+    product = get_product_by_id(product_id, etag) if version else None
+    if product:
+        response = fast_jsonify(without_etag(product))
+        return (set_validators(response, etag, weak=True) if etag else response), 200
     else:
         return jsonify(error_code='PRODUCT_NOT_FOUND', message='Product not found!'), 404
 
@@ -62,8 +159,9 @@ def get_product_details(product_id: str):
 def add_product():
     try:
         data = request.get_json()
+        validate_product(data)
         product = insert_product(**data)
-        product = product_schema.dump(product)
+        product = dump_product(product)
         return jsonify(status='SUCCESS', message='Product added successfully!', added_product=product), 201
     except Exception as e:
         db.session.rollback()
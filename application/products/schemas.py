@@ -1,4 +1,15 @@
-from flask_marshmallow import Schema
+from marshmallow import EXCLUDE, Schema, ValidationError, validates_schema
+
+from application.invoices.pricing import CURRENCY_SCALE, PERCENT_SCALE, to_scaled
+from application.serialization import make_serializer
+
+# Invoices price products in halalas and hundredths of a percent, a product with more decimals could not be invoiced
+SCALED_FIELDS = (
+    ('product_price', CURRENCY_SCALE),
+    ('product_discount_percent', PERCENT_SCALE),
+    ('product_vat_percent', PERCENT_SCALE),
+    ('product_markup_percent', PERCENT_SCALE)
+)
 
 
 class ProductSchema(Schema):
@@ -14,6 +25,43 @@ class ProductSchema(Schema):
             'product_markup_percent'
         )
 
+    @validates_schema
+    def validate_precision(self, data, **kwargs):
+        errors = {}
+        for name, scale in SCALED_FIELDS:
+            if name in data:
+                try:
+                    to_scaled(data[name], scale, name)
+                except (TypeError, ValueError) as e:
+                    errors[name] = [str(e)]
+        if errors:
+            raise ValidationError(errors)
+
 
 product_schema = ProductSchema()
 products_schema = ProductSchema(many=True)
+dump_product = make_serializer(product_schema)
+dump_products = make_serializer(products_schema)
+# Checks the values a POST, PUT or import row writes; nulls and the columns it does not know are left to the model
+product_input_schema = ProductSchema(unknown=EXCLUDE)
+
+
+def get_input_errors(data):
+    return product_input_schema.validate({name: value for name, value in data.items() if value is not None}, partial=True)
+
+
+def validate_product(data):
+    # Raises a ValidationError with the messages of every invalid field
+    errors = get_input_errors(data)
+    if errors:
+        raise ValidationError(errors)
+
+
+def validate_product_rows(rows):
+    # validate_chunk for imports: {index: [errors]} of the rows that fail validate_product
+    errors = {}
+    for index, row in enumerate(rows):
+        row_errors = get_input_errors(row)
+        if row_errors:
+            errors[index] = [message for messages in row_errors.values() for message in messages]
+    return errors
@@ -1,6 +1,11 @@
+import json
+import os
+import sqlite3
 import unittest
 
-from app import app
+from app import basedir
+from application import db
+from application.products.routes import import_products
 from tests import AppTest
 
 
@@ -24,6 +29,84 @@ class ProductsTest(AppTest):
     def get_product_by_id(self, product_id):
         return self.test_client.get(f'{self.prefix}/{product_id}')
 
+    def test_search_products(self):
+        product_id = self.create_product().get_json()['added_product']['product_id']
+        response = self.test_client.get(f'{self.prefix}/search', query_string={'q': 'stuff'})
+        self.assertEqual([product['product_id'] for product in response.get_json()], [product_id])
+        self.test_client.put(f'{self.prefix}/{product_id}', json={"product_description": "Logo work"})
+        response = self.test_client.get(f'{self.prefix}/search', query_string={'q': 'stuff'})
+        self.assertEqual(response.get_json(), [])
+        response = self.test_client.get(f'{self.prefix}/search', query_string={'q': 'desi lo'})
+        self.assertEqual([product['product_id'] for product in response.get_json()], [product_id])
+
+    def test_import_products_ndjson(self):
+        lines = [json.dumps({"product_name": f"Service {i}", "product_price": i + 0.5}) for i in range(3)]
+        lines += ['', json.dumps({"product_name": "Free", "product_price": "abc"}), '[1, 2]']
+        response = self.test_client.post(f'{self.prefix}/import', data='\n'.join(lines), content_type='application/x-ndjson')
+        events = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([event['line'] for event in events if event['event'] == 'row_error'], [5, 6])
+        self.assertEqual(events[-1]['status'], 'PARTIAL')
+        self.assertEqual(events[-1]['imported'], 3)
+        products = {product['product_name']: product for product in self.test_client.get(f'{self.prefix}').get_json()}
+        self.assertEqual(products['Service 2']['product_price'], 2.5)
+        self.assertEqual(products['Service 2']['product_markup_percent'], 20)
+        self.assertEqual(products['Service 2']['product_price_currency'], 'SAR')
+
+    def test_import_releases_write_lock_between_chunks(self):
+        def records():
+            for line in range(1, 5):
+                if line == 3:
+                    # Another writer, without a busy timeout, while the upload is still being read
+                    connection = sqlite3.connect(os.path.join(basedir, 'invoice_tests.db'), timeout=0, isolation_level=None)
+                    connection.execute('BEGIN IMMEDIATE')
+                    connection.execute('ROLLBACK')
+                    connection.close()
+                yield line, {"product_name": f"Service {line}", "product_price": 1.5}
+
+        with self.app.app_context():
+            for is_dryrun, stored in ((True, 0), (False, 4)):
+                events = list(import_products(records(), is_dryrun, chunk_size=2))
+                self.assertEqual(events[-1], {'event': 'done', 'status': 'SUCCESS', 'rows': 4, 'imported': 4, 'failed': 0})
+                self.assertEqual(db.engine.execute('SELECT count(*) FROM products').scalar(), stored)
+
+    def test_products_reject_amounts_invoices_cannot_price(self):
+        response = self.test_client.post(f'{self.prefix}', json={"product_name": "Design", "product_price": 30.005})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()['errors'], [{'product_price': ['product_price has more than 2 decimal places']}])
+        product_id = self.create_product().get_json()['added_product']['product_id']
+        response = self.test_client.put(f'{self.prefix}/{product_id}', json={"product_vat_percent": 15.125})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.get_product_by_id(product_id).get_json()['product_vat_percent'], 3.0)
+
+        lines = [json.dumps({"product_name": "Hourly", "product_price": 12.5, "product_markup_percent": 12.5}),
+                 json.dumps({"product_name": "Per minute", "product_price": 0.125})]
+        response = self.test_client.post(f'{self.prefix}/import', data='\n'.join(lines), content_type='application/x-ndjson')
+        events = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual(events[0], {'event': 'row_error', 'line': 2, 'errors': ['product_price has more than 2 decimal places']})
+        self.assertEqual(events[-1]['imported'], 1)
+
+    def test_get_product_reloads_entry_outdated_by_another_worker(self):
+        product_id = self.create_product().get_json()['added_product']['product_id']
+        etag = self.get_product_by_id(product_id).headers['ETag']
+        # Another worker's PUT leaves this worker's cache entry in place
+        with self.app.app_context():
+            db.engine.execute("UPDATE products SET product_price = 99.0, last_updated_at = '2030-01-01 00:00:00.000000' "
+                              "WHERE product_id = ?", product_id)
+        response = self.get_product_by_id(product_id)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.get_json()['product_price'], 99.0)
+        self.assertNotIn('_etag', response.get_json())
+
+    def test_conditional_get_product(self):
+        product_id = self.create_product().get_json()['added_product']['product_id']
+        etag = self.get_product_by_id(product_id).headers['ETag']
+        response = self.test_client.get(f'{self.prefix}/{product_id}', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.test_client.put(f'{self.prefix}/{product_id}', json={"product_price": 35.0})
+        response = self.test_client.get(f'{self.prefix}/{product_id}', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['product_price'], 35.0)
+
     def test_index(self):
         response = self.test_client.get(f'{self.prefix}')
         status_code = response.status_code
@@ -47,6 +130,16 @@ class ProductsTest(AppTest):
         response = self.get_product_by_id(product_id)
         self.assertEqual(response.get_json()['product_description'], description)
 
+    def test_update_invalidates_cached_product(self):
+        product_id = self.create_product().get_json()['added_product']['product_id']
+        self.assertEqual(self.get_product_by_id(product_id).get_json()['product_price'], 30.0)
+        self.assertEqual(len(self.test_client.get(f'{self.prefix}').get_json()), 1)
+        self.test_client.put(f'{self.prefix}/{product_id}', json={"product_price": 45.0})
+        self.assertEqual(self.get_product_by_id(product_id).get_json()['product_price'], 45.0)
+        self.assertEqual(self.test_client.get(f'{self.prefix}').get_json()[0]['product_price'], 45.0)
+        self.create_product()
+        self.assertEqual(len(self.test_client.get(f'{self.prefix}').get_json()), 2)
+
     def test_product_id_cannot_be_updated(self):
         product_id = self.create_product().get_json()['added_product']['product_id']
         random_id = 'SOME_RANDOM_ID'
@@ -0,0 +1,37 @@
+from sqlalchemy import Column, String, Date, Float, Integer, Index
+from application import db
+
+
+# Summaries are maintained by create_invoice in the same transaction as the invoice itself.
+# Amounts are stored as integer halalas so that sums over any period stay exact.
+class DailyClientSummary(db.Model):
+    __tablename__ = 'daily_client_summaries'
+    __table_args__ = (
+        Index('ix_daily_client_summaries_client_id_day', 'client_id', 'day'),
+    )
+
+    day = Column(Date, primary_key=True)
+    client_id = Column(String, primary_key=True)
+    invoice_count = Column(Integer, nullable=False, default=0)
+    invoice_gross_amount = Column(Integer, nullable=False, default=0)
+    total_discount_amount = Column(Integer, nullable=False, default=0)
+    total_tax_amount = Column(Integer, nullable=False, default=0)
+    invoice_net_amount = Column(Integer, nullable=False, default=0)
+    standard_rated_amount = Column(Integer, nullable=False, default=0)
+    zero_rated_amount = Column(Integer, nullable=False, default=0)
+
+
+class DailyProductSummary(db.Model):
+    __tablename__ = 'daily_product_summaries'
+    __table_args__ = (
+        Index('ix_daily_product_summaries_product_id_day', 'product_id', 'day'),
+    )
+
+    day = Column(Date, primary_key=True)
+    product_id = Column(String, primary_key=True)
+    line_count = Column(Integer, nullable=False, default=0)
+    product_quantity = Column(Float, nullable=False, default=0)
+    gross_amount = Column(Integer, nullable=False, default=0)
+    discount_amount = Column(Integer, nullable=False, default=0)
+    vat_amount = Column(Integer, nullable=False, default=0)
+    net_amount = Column(Integer, nullable=False, default=0)
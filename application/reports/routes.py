@@ -0,0 +1,212 @@
+from collections import defaultdict
+from datetime import date
+
+from flask import Blueprint, jsonify, request
+from sqlalchemy import func
+
+from application import db
+from application.invoices.pricing import CURRENCY_SCALE
+from .models import DailyClientSummary, DailyProductSummary
+
+reports_api = Blueprint('reports_api', __name__)
+
+CLIENT_AMOUNTS = ('invoice_gross_amount', 'total_discount_amount', 'total_tax_amount', 'invoice_net_amount',
+                  'standard_rated_amount', 'zero_rated_amount')
+PRODUCT_AMOUNTS = ('gross_amount', 'discount_amount', 'vat_amount', 'net_amount')
+
+UPSERT_CLIENT_SUMMARY = '''
+INSERT INTO daily_client_summaries (day, client_id, invoice_count, invoice_gross_amount, total_discount_amount,
+    total_tax_amount, invoice_net_amount, standard_rated_amount, zero_rated_amount)
+VALUES (:day, :client_id, :invoice_count, :invoice_gross_amount, :total_discount_amount,
+    :total_tax_amount, :invoice_net_amount, :standard_rated_amount, :zero_rated_amount)
+ON CONFLICT (day, client_id) DO UPDATE SET
+    invoice_count = invoice_count + excluded.invoice_count,
+    invoice_gross_amount = invoice_gross_amount + excluded.invoice_gross_amount,
+    total_discount_amount = total_discount_amount + excluded.total_discount_amount,
+    total_tax_amount = total_tax_amount + excluded.total_tax_amount,
+    invoice_net_amount = invoice_net_amount + excluded.invoice_net_amount,
+    standard_rated_amount = standard_rated_amount + excluded.standard_rated_amount,
+    zero_rated_amount = zero_rated_amount + excluded.zero_rated_amount
+'''
+
+UPSERT_PRODUCT_SUMMARY = '''
+INSERT INTO daily_product_summaries (day, product_id, line_count, product_quantity, gross_amount, discount_amount,
+    vat_amount, net_amount)
+VALUES (:day, :product_id, :line_count, :product_quantity, :gross_amount, :discount_amount, :vat_amount, :net_amount)
+ON CONFLICT (day, product_id) DO UPDATE SET
+    line_count = line_count + excluded.line_count,
+    product_quantity = product_quantity + excluded.product_quantity,
+    gross_amount = gross_amount + excluded.gross_amount,
+    discount_amount = discount_amount + excluded.discount_amount,
+    vat_amount = vat_amount + excluded.vat_amount,
+    net_amount = net_amount + excluded.net_amount
+'''
+
+# A line is standard rated when VAT applies to it, whatever the sign (credit lines) or the rounding of its VAT
+STANDARD_RATED_LINE = 'client_versions.is_client_taxable AND product_versions.product_vat_percent > 0'
+
+# Backfill from the invoice tables; invoice totals are defined as the sum of their rounded lines
+REBUILD_SUMMARIES = [
+    'DELETE FROM daily_client_summaries',
+    'DELETE FROM daily_product_summaries',
+    f'''
+    INSERT INTO daily_client_summaries (day, client_id, invoice_count, invoice_gross_amount, total_discount_amount,
+        total_tax_amount, invoice_net_amount, standard_rated_amount, zero_rated_amount)
+    SELECT date(invoices.created_at), invoices.client_id, count(DISTINCT invoices.invoice_id),
+        sum(CAST(round(invoice_items.gross_amount * 100) AS INTEGER)),
+        sum(CAST(round(invoice_items.discount_amount * 100) AS INTEGER)),
+        sum(CAST(round(invoice_items.vat_amount * 100) AS INTEGER)),
+        sum(CAST(round(invoice_items.net_amount * 100) AS INTEGER)),
+        sum(CASE WHEN {STANDARD_RATED_LINE}
+            THEN CAST(round(invoice_items.amount_after_discount * 100) AS INTEGER) ELSE 0 END),
+        sum(CASE WHEN {STANDARD_RATED_LINE}
+            THEN 0 ELSE CAST(round(invoice_items.amount_after_discount * 100) AS INTEGER) END)
+    FROM invoice_items JOIN invoices ON invoices.invoice_id = invoice_items.invoice_id
+    JOIN client_versions ON client_versions.version_id = invoices.client_version_id
+    JOIN product_versions ON product_versions.version_id = invoice_items.product_version_id
+    GROUP BY date(invoices.created_at), invoices.client_id
+    ''',
+    '''
+    INSERT INTO daily_product_summaries (day, product_id, line_count, product_quantity, gross_amount, discount_amount,
+        vat_amount, net_amount)
+    SELECT date(invoices.created_at), invoice_items.product_id, count(*), sum(invoice_items.product_quantity),
+        sum(CAST(round(invoice_items.gross_amount * 100) AS INTEGER)),
+        sum(CAST(round(invoice_items.discount_amount * 100) AS INTEGER)),
+        sum(CAST(round(invoice_items.vat_amount * 100) AS INTEGER)),
+        sum(CAST(round(invoice_items.net_amount * 100) AS INTEGER))
+    FROM invoice_items JOIN invoices ON invoices.invoice_id = invoice_items.invoice_id
+    GROUP BY date(invoices.created_at), invoice_items.product_id
+    '''
+]
+
+
+def to_minor_units(amount):
+    return int(round(amount * CURRENCY_SCALE))
+
+
+def record_invoice_summaries(invoices):
+    # Runs on the session's connection, so the caller's commit covers the invoices and their summaries.
+    # invoices are dicts with created_at, client_id, is_client_taxable and invoice_items holding the priced
+    # line amounts and product_vat_percent.
+    client_rows = defaultdict(lambda: dict.fromkeys(('invoice_count',) + CLIENT_AMOUNTS, 0))
+    product_rows = defaultdict(lambda: dict.fromkeys(('line_count', 'product_quantity') + PRODUCT_AMOUNTS, 0))
+    for invoice in invoices:
+        day = invoice['created_at'].date().isoformat()
+        client_row = client_rows[(day, invoice['client_id'])]
+        client_row['invoice_count'] += 1
+        for item in invoice['invoice_items']:
+            is_standard_rated = invoice['is_client_taxable'] and item['product_vat_percent'] > 0
+            amount_after_discount = to_minor_units(item['amount_after_discount'])
+            vat_amount = to_minor_units(item['vat_amount'])
+            client_row['invoice_gross_amount'] += to_minor_units(item['gross_amount'])
+            client_row['total_discount_amount'] += to_minor_units(item['discount_amount'])
+            client_row['total_tax_amount'] += vat_amount
+            client_row['invoice_net_amount'] += to_minor_units(item['net_amount'])
+            client_row['standard_rated_amount' if is_standard_rated else 'zero_rated_amount'] += amount_after_discount
+
+            product_row = product_rows[(day, item['product_id'])]
+            product_row['line_count'] += 1
+            product_row['product_quantity'] += item['product_quantity']
+            product_row['gross_amount'] += to_minor_units(item['gross_amount'])
+            product_row['discount_amount'] += to_minor_units(item['discount_amount'])
+            product_row['vat_amount'] += vat_amount
+            product_row['net_amount'] += to_minor_units(item['net_amount'])
+
+    if client_rows:
+        db.session.execute(UPSERT_CLIENT_SUMMARY, [
+            dict(row, day=day, client_id=client_id) for (day, client_id), row in client_rows.items()
+        ])
+    if product_rows:
+        db.session.execute(UPSERT_PRODUCT_SUMMARY, [
+            dict(row, day=day, product_id=product_id) for (day, product_id), row in product_rows.items()
+        ])
+
+
+def rebuild_summaries():
+    for statement in REBUILD_SUMMARIES:
+        db.session.execute(statement)
+    db.session.commit()
+
+
+def get_date_range():
+    from_date = date.fromisoformat(request.args['from_date']) if request.args.get('from_date') else None
+    to_date = date.fromisoformat(request.args['to_date']) if request.args.get('to_date') else None
+    return from_date, to_date
+
+
+def filter_days(query, model, from_date, to_date):
+    if from_date:
+        query = query.filter(model.day >= from_date)
+    if to_date:
+        query = query.filter(model.day <= to_date)
+    return query
+
+
+def summary_rows(query, keys, counts, amounts):
+    rows = []
+    for result in query:
+        row = dict(zip(keys + counts + amounts, result))
+        for key in keys:
+            if isinstance(row[key], date):
+                row[key] = row[key].isoformat()
+        for amount in amounts:
+            row[amount] = (row[amount] or 0) / CURRENCY_SCALE
+        rows.append(row)
+    return rows
+
+
+@reports_api.route('clients', methods=['GET'])
+def get_client_report():
+    try:
+        from_date, to_date = get_date_range()
+        group_by = request.args.get('group_by', 'day')
+        if group_by not in ('day', 'client'):
+            return jsonify(status='ERROR', errors=['group_by must be day or client']), 400
+        keys = ('day', 'client_id') if group_by == 'day' else ('client_id',)
+        columns = [getattr(DailyClientSummary, key) for key in keys]
+        query = db.session.query(*columns, func.sum(DailyClientSummary.invoice_count),
+                                 *[func.sum(getattr(DailyClientSummary, amount)) for amount in CLIENT_AMOUNTS])
+        query = filter_days(query, DailyClientSummary, from_date, to_date)
+        if request.args.get('client_id'):
+            query = query.filter(DailyClientSummary.client_id == request.args['client_id'])
+        query = query.group_by(*columns).order_by(*columns)
+        return jsonify(summary_rows(query, keys, ('invoice_count',), CLIENT_AMOUNTS)), 200
+    except Exception as e:
+        return jsonify(status='ERROR', errors=e.args), 400
+
+
+@reports_api.route('products', methods=['GET'])
+def get_product_report():
+    try:
+        from_date, to_date = get_date_range()
+        group_by = request.args.get('group_by', 'day')
+        if group_by not in ('day', 'product'):
+            return jsonify(status='ERROR', errors=['group_by must be day or product']), 400
+        keys = ('day', 'product_id') if group_by == 'day' else ('product_id',)
+        columns = [getattr(DailyProductSummary, key) for key in keys]
+        query = db.session.query(*columns, func.sum(DailyProductSummary.line_count),
+                                 func.sum(DailyProductSummary.product_quantity),
+                                 *[func.sum(getattr(DailyProductSummary, amount)) for amount in PRODUCT_AMOUNTS])
+        query = filter_days(query, DailyProductSummary, from_date, to_date)
+        if request.args.get('product_id'):
+            query = query.filter(DailyProductSummary.product_id == request.args['product_id'])
+        query = query.group_by(*columns).order_by(*columns)
+        return jsonify(summary_rows(query, keys, ('line_count', 'product_quantity'), PRODUCT_AMOUNTS)), 200
+    except Exception as e:
+        return jsonify(status='ERROR', errors=e.args), 400
+
+
+@reports_api.route('vat', methods=['GET'])
+def get_vat_report():
+    try:
+        from_date, to_date = get_date_range()
+        if not (from_date and to_date):
+            return jsonify(status='ERROR', errors=['from_date and to_date are required']), 400
+        query = db.session.query(func.sum(DailyClientSummary.invoice_count),
+                                 *[func.sum(getattr(DailyClientSummary, amount)) for amount in CLIENT_AMOUNTS])
+        query = filter_days(query, DailyClientSummary, from_date, to_date)
+        report = summary_rows(query, (), ('invoice_count',), CLIENT_AMOUNTS)[0]
+        report = {name: value or 0 for name, value in report.items()}
+        return jsonify(from_date=from_date.isoformat(), to_date=to_date.isoformat(), **report), 200
+    except Exception as e:
+        return jsonify(status='ERROR', errors=e.args), 400
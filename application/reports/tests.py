@@ -0,0 +1,89 @@
+import unittest
+from datetime import datetime
+
+from application.invoices.tests import InvoiceFixtures
+from application.reports.routes import rebuild_summaries
+from tests import AppTest
+
+
+class ReportsTest(InvoiceFixtures, AppTest):
+
+    def setUp(self):
+        super().setUp()
+        self.today = datetime.utcnow().date().isoformat()
+        self.client_id = self.create_client()
+        self.exempt_client_id = self.create_client(client_tin='300000000000004', is_client_taxable=False)
+        self.product_id = self.create_product()
+        self.other_product_id = self.create_product(product_price=10.0)
+        self.create_invoice(self.client_id, [self.product_id, self.other_product_id])
+        self.create_invoice(self.client_id, [self.product_id])
+        self.create_invoice(self.exempt_client_id, [self.other_product_id])
+        self.create_invoice(self.client_id, [self.product_id], query_string={'dryrun': 'true'})
+        self.test_client.post(f'{self.prefix}/batch', json={
+            "invoices": [self.invoice_data(self.exempt_client_id, [self.product_id])]
+        })
+
+    def get_reports(self):
+        return [self.test_client.get(f'/api/reports/{path}', query_string=query_string).get_json() for path, query_string in (
+            ('clients', {}),
+            ('clients', {'group_by': 'client'}),
+            ('products', {'group_by': 'product'}),
+            ('vat', {'from_date': self.today, 'to_date': self.today})
+        )]
+
+    def test_client_report(self):
+        rows = self.test_client.get('/api/reports/clients', query_string={'client_id': self.client_id}).get_json()
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['day'], self.today)
+        self.assertEqual(rows[0]['invoice_count'], 2)
+        # Lines of 60 + 20 + 60 SAR with a 20% markup, 10% discount and 15% VAT
+        self.assertAlmostEqual(rows[0]['invoice_gross_amount'], 168.0)
+        self.assertAlmostEqual(rows[0]['total_discount_amount'], 16.8)
+        self.assertAlmostEqual(rows[0]['total_tax_amount'], 22.68)
+        self.assertAlmostEqual(rows[0]['invoice_net_amount'], 173.88)
+
+    def test_vat_report(self):
+        report = self.test_client.get('/api/reports/vat', query_string={
+            'from_date': self.today, 'to_date': self.today
+        }).get_json()
+        self.assertEqual(report['invoice_count'], 4)
+        self.assertAlmostEqual(report['standard_rated_amount'], 151.2)
+        self.assertAlmostEqual(report['zero_rated_amount'], 86.4)
+        self.assertAlmostEqual(report['total_tax_amount'], 22.68)
+        report = self.test_client.get('/api/reports/vat', query_string={
+            'from_date': '2000-01-01', 'to_date': '2000-03-31'
+        }).get_json()
+        self.assertEqual(report['invoice_count'], 0)
+        self.assertEqual(report['total_tax_amount'], 0)
+
+    def test_vat_report_classifies_lines_by_rate(self):
+        before = self.get_reports()[3]
+        # A credit line has negative VAT, the VAT of a 0.01 SAR line rounds to 0; both are standard rated
+        small_product_id = self.create_product(product_price=0.01)
+        data = self.invoice_data(self.client_id, [self.product_id, small_product_id])
+        data['invoice_items'][0]['product_quantity'] = -1
+        self.assertEqual(self.test_client.post(self.prefix, json=data).status_code, 201)
+        report = self.get_reports()[3]
+        # -30 SAR + 20% markup - 10% discount, and 0.02 SAR + 0.00 markup - 0.00 discount
+        self.assertAlmostEqual(report['standard_rated_amount'] - before['standard_rated_amount'], -32.4 + 0.02)
+        self.assertAlmostEqual(report['zero_rated_amount'], before['zero_rated_amount'])
+        reports = self.get_reports()
+        with self.app.app_context():
+            rebuild_summaries()
+        self.assertEqual(self.get_reports(), reports)
+
+    def test_product_report(self):
+        rows = self.test_client.get('/api/reports/products', query_string={'product_id': self.product_id}).get_json()
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['line_count'], 3)
+        self.assertEqual(rows[0]['product_quantity'], 6)
+
+    def test_rebuild_matches_incremental_summaries(self):
+        reports = self.get_reports()
+        with self.app.app_context():
+            rebuild_summaries()
+        self.assertEqual(self.get_reports(), reports)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import re
+
+from flask import request
+from sqlalchemy import event, table as sql_table, text
+
+from application import db
+
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+SEARCH_TOKEN = re.compile(r'\w+')
+MIN_RANKED_PREFIX = 3
+
+# External content FTS5 tables: the text lives only in the source table, the index is kept in step by
+# triggers so every insert and update path (PUT, batch, bulk inserts) is covered. Weights rank a match
+# on the name above one on the TIN or the city.
+SEARCH_INDEXES = {
+    'clients': (('client_name', 'client_tin', 'client_city'), (10.0, 5.0, 1.0)),
+    'products': (('product_name', 'product_description'), (10.0, 1.0)),
+    'client_versions': (('client_name', 'client_tin', 'client_city'), (10.0, 5.0, 1.0))
+}
+# Tables searched through another table's index: invoices match on the client version they reference
+SEARCH_JOINS = {
+    'invoices': ('client_versions', 'client_version_id')
+}
+
+
+def search_index_statements(table, columns, weights):
+    column_list = ', '.join(columns)
+    new_values = ', '.join(f'new.{column}' for column in columns)
+    old_values = ', '.join(f'old.{column}' for column in columns)
+    delete_old = f"INSERT INTO {table}_fts ({table}_fts, rowid, {column_list}) VALUES ('delete', old.rowid, {old_values});"
+    insert_new = f'INSERT INTO {table}_fts (rowid, {column_list}) VALUES (new.rowid, {new_values});'
+    return [
+        f'''CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5({column_list}, content='{table}',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3')''',
+        f"INSERT INTO {table}_fts ({table}_fts, rank) VALUES ('rank', 'bm25({', '.join(map(str, weights))})')",
+        f'CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} BEGIN {insert_new} END',
+        f'CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} BEGIN {delete_old} END',
+        f'CREATE TRIGGER IF NOT EXISTS {table}_fts_update AFTER UPDATE ON {table} BEGIN {delete_old} {insert_new} END'
+    ]
+
+
+SEARCH_INDEX = [statement for table, (columns, weights) in SEARCH_INDEXES.items()
+                for statement in search_index_statements(table, columns, weights)]
+
+
+def create_search_index(target, connection, **kwargs):
+    for statement in SEARCH_INDEX:
+        connection.execute(statement)
+
+
+def match_query(tokens):
+    # Every word of the query has to match the start of a word in the indexed text
+    return ' '.join(f'"{token}"*' for token in tokens)
+
+
+def search(model, options=()):
+    # Returns the ranked page of `model` rows for the request's q, limit and offset, plus the next offset
+    tokens = SEARCH_TOKEN.findall(request.args.get('q', ''))
+    if not tokens:
+        raise ValueError('Search query must contain at least one letter or digit')
+    limit = min(request.args.get('limit', DEFAULT_SEARCH_LIMIT, type=int), MAX_SEARCH_LIMIT)
+    offset = request.args.get('offset', 0, type=int)
+    # SQLite reads a negative LIMIT as no limit at all
+    if limit < 1 or offset < 0:
+        raise ValueError('Search limit must be at least 1 and offset at least 0')
+    table = model.__tablename__
+    index, join_column = SEARCH_JOINS.get(table, (table, 'rowid'))
+    # Ranking reads every match, which a one or two letter prefix has too many of on a large catalog.
+    # Those pages come in index order instead, which stops at the first page of matches.
+    order_by = f"{index}_fts.{'rank' if max(len(token) for token in tokens) >= MIN_RANKED_PREFIX else 'rowid'}"
+    if table in SEARCH_JOINS:
+        # Rows sharing an index entry tie on it, their own rowid keeps the pages stable
+        order_by += f', {table}.rowid'
+    # The index joins as a bare table, so the query still selects everything the model maps
+    query = model.query.options(*options).join(sql_table(f'{index}_fts'), text(f'{table}.{join_column} = {index}_fts.rowid'))
+    query = query.filter(text(f'{index}_fts MATCH :match')).order_by(text(order_by)).params(match=match_query(tokens))
+    # One row more than the page tells whether there is a next page
+    rows = query.limit(limit + 1).offset(offset).all()
+    next_offset = offset + limit if len(rows) > limit else None
+    return rows[:limit], next_offset
+
+
+event.listen(db.Model.metadata, 'after_create', create_search_index)
@@ -0,0 +1,60 @@
+import sqlite3
+
+from sqlalchemy.pool import QueuePool
+
+DEFAULT_BUSY_TIMEOUT = 5000
+DEFAULT_POOL_SIZE = 5
+
+SQLITE_PROFILES = {
+    # Rollback journal, a fresh connection per checkout
+    'default': {
+        'pragmas': {
+            'foreign_keys': 'ON'
+        }
+    },
+    # WAL lets readers run next to the single writer, synchronous=NORMAL only fsyncs at checkpoints
+    # and pooled connections keep their page cache and memory map between requests
+    'production': {
+        'pragmas': {
+            'foreign_keys': 'ON',
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'temp_store': 'MEMORY',
+            'cache_size': -64000,
+            'mmap_size': 268435456
+        },
+        'pooled': True
+    }
+}
+
+
+def init_storage(app):
+    profile = SQLITE_PROFILES[app.config.get('SQLITE_PROFILE', 'default')]
+    busy_timeout = app.config.get('SQLITE_BUSY_TIMEOUT', DEFAULT_BUSY_TIMEOUT)
+    pragmas = dict(profile['pragmas'], busy_timeout=busy_timeout)
+
+    engine_options = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+    connect_args = engine_options.setdefault('connect_args', {})
+    connect_args['timeout'] = busy_timeout / 1000
+    # The pragmas travel with this app's engine, another app in the process may use another profile
+    connect_args['factory'] = sqlite_connection_class(pragmas)
+    if profile.get('pooled'):
+        # One pool per gunicorn worker, sized for its threads; a pooled connection is only used by
+        # one thread at a time, so sqlite3's same-thread check can be lifted
+        pool_size = app.config.get('SQLITE_POOL_SIZE', DEFAULT_POOL_SIZE)
+        engine_options.update(poolclass=QueuePool, pool_size=pool_size, max_overflow=pool_size, pool_timeout=30)
+        connect_args['check_same_thread'] = False
+
+
+def sqlite_connection_class(pragmas):
+    class PragmaConnection(sqlite3.Connection):
+        # sqlite3.connect builds every connection of the engine with this class
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            cursor = self.cursor()
+            for name, value in pragmas.items():
+                cursor.execute(f'PRAGMA {name}={value}')
+            cursor.close()
+
+    return PragmaConnection
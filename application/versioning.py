@@ -0,0 +1,85 @@
+import hashlib
+import json
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, String, select
+from sqlalchemy.orm import column_property
+
+from application import db, SQLITE_MAX_VARIABLE_NUMBER
+from application.cache import cache
+
+
+class CatalogVersion:
+    """
+    Immutable copy of the fields an invoice takes from a catalog row when it is issued, so invoices keep
+    them after the row changes. Each distinct content is stored once and addressed by its hash: invoices
+    reference it by version_id, and a new version only appears when one of the copied fields changes.
+    """
+    version_id = Column(Integer, primary_key=True)
+    content_hash = Column(String, nullable=False, unique=True)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    # The catalog row's id and the fields copied onto invoices, set by each version model
+    owner_field = None
+    copied_fields = ()
+
+    @classmethod
+    def snapshot(cls, values):
+        # The versioned fields of values, with the column's type so 15 and 15.0 or 1 and True hash the same
+        fields = (cls.owner_field,) + cls.copied_fields
+        return {field: cls.__table__.columns[field].type.python_type(values[field]) for field in fields}
+
+
+def content_hash(snapshot):
+    return hashlib.sha256(json.dumps(snapshot, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+def get_version_ids(model, rows, create=True):
+    """
+    Returns the version_id of the catalog content in each of rows, dicts holding the model's versioned
+    fields. Versions that do not exist yet are inserted, or with create=False (dry runs) get None.
+    Versions never change, so the ids of existing ones are cached by content hash and an invoice for
+    unchanged catalog rows costs no query at all.
+    """
+    fields = (model.owner_field,) + model.copied_fields
+    snapshots = {}
+    hashes_by_values = {}
+    hashes = []
+    for row in rows:
+        # A batch repeats the same few catalog rows, each distinct one is hashed once
+        values = tuple(row[field] for field in fields)
+        key = hashes_by_values.get(values)
+        if key is None:
+            snapshot = model.snapshot(row)
+            key = hashes_by_values[values] = content_hash(snapshot)
+            snapshots[key] = snapshot
+        hashes.append(key)
+    version_ids = cache.get_many(model.__tablename__, list(snapshots), lambda keys: _find_version_ids(model, keys))
+    missing = [key for key in snapshots if key not in version_ids]
+    if missing and create:
+        # A concurrent request may insert the same content first, its row is then the version. The new ids
+        # are cached once a later lookup finds them committed.
+        created_at = datetime.utcnow()
+        db.session.execute(model.__table__.insert().prefix_with('OR IGNORE'),
+                           [dict(snapshots[key], content_hash=key, created_at=created_at) for key in missing])
+        version_ids.update(_find_version_ids(model, missing))
+    return [version_ids.get(key) for key in hashes]
+
+
+def _find_version_ids(model, hashes):
+    version_ids = {}
+    for offset in range(0, len(hashes), SQLITE_MAX_VARIABLE_NUMBER):
+        chunk = hashes[offset:offset + SQLITE_MAX_VARIABLE_NUMBER]
+        version_ids.update(db.session.query(model.content_hash, model.version_id).filter(model.content_hash.in_(chunk)))
+    return version_ids
+
+
+def copied_column(model, version_id, field):
+    """
+    Maps a copied field onto the invoice as a read-only column looked up in the version it references, so
+    loading invoices builds no version objects. A value given to a new invoice is kept after the flush,
+    the INSERT only writes the version id.
+    """
+    versions = model.__table__
+    return column_property(select([versions.c[field]]).where(versions.c.version_id == version_id).as_scalar(),
+                           expire_on_flush=False)
@@ -0,0 +1,5 @@
+# uvicorn asgi:app, the alternative to gunicorn wsgi:app
+from app import create_app
+from application.asgi import AsgiApp
+
+app = AsgiApp(create_app())
@@ -0,0 +1,132 @@
+"""
+Compares concurrent-request throughput of gunicorn wsgi:app and uvicorn asgi:app.
+
+Seeds a temporary database, starts each server on it with the production SQLite
+profile and drives it with --concurrency client threads over keep-alive HTTP
+connections for --seconds per scenario:
+
+    read      GET /api/invoices/<id>
+    mixed     the reads plus one POST /api/invoices in --write-every requests,
+              so requests queue behind SQLite's write lock
+    download  GET /api/invoices/<id>/download of invoices never rendered
+              before; only run when wkhtmltopdf is installed
+
+    python -m benchmarks.asgi_vs_wsgi --workers 2 --concurrency 8 32 --seconds 10
+"""
+import argparse
+import http.client
+import json
+import os
+import shutil
+import threading
+import time
+
+from application import db
+from application.invoices.models import Invoice
+from application.invoices.rendering import get_cached_pdf_path, get_render_job_id
+from application.invoices.templating import INVOICE_TEMPLATE
+from benchmarks.common import HOST, invoice_payload, percentile, seed_client, seed_products, start_server, \
+    temporary_database
+
+
+def run_load(port, concurrency, seconds, next_request):
+    results = []
+    lock = threading.Lock()
+    deadline = time.time() + seconds
+
+    def loop(index):
+        connection = http.client.HTTPConnection(HOST, port, timeout=120)
+        count = 0
+        while time.time() < deadline:
+            request = next_request(index, count)
+            if request is None:
+                break
+            method, path, body = request
+            started = time.perf_counter()
+            try:
+                connection.request(method, path, body=body, headers={'Content-Type': 'application/json'} if body else {})
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                status = 0
+            with lock:
+                results.append((status, time.perf_counter() - started))
+            count += 1
+        connection.close()
+
+    threads = [threading.Thread(target=loop, args=(i,)) for i in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--servers', nargs='+', choices=('wsgi', 'asgi'), default=['wsgi', 'asgi'])
+    parser.add_argument('--workers', type=int, default=2, help='Server processes.')
+    parser.add_argument('--threads', type=int, default=32, help='Threads per ASGI worker.')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[8, 32])
+    parser.add_argument('--seconds', type=int, default=10)
+    parser.add_argument('--invoices', type=int, default=200)
+    parser.add_argument('--lines', type=int, default=20)
+    parser.add_argument('--write-every', type=int, default=10)
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    scenarios = ['read', 'mixed'] + (['download'] if shutil.which('wkhtmltopdf') else [])
+    with temporary_database() as test_client:
+        app = test_client.application
+        db_path = app.config['SQLALCHEMY_DATABASE_URI'][len('sqlite:///'):]
+        client_id = seed_client(test_client)
+        product_ids = seed_products(test_client, args.lines)
+        payload = invoice_payload(client_id, product_ids, args.lines)
+        body = json.dumps(payload)
+        for _ in range(args.invoices):
+            test_client.post('/api/invoices', json=payload)
+        with app.app_context():
+            invoice_ids = [invoice_id for invoice_id, in db.session.query(Invoice.invoice_id)]
+
+        print(f'{"server":>6} {"scenario":>9} {"clients":>7} {"req/s":>8} {"p50 ms":>8} {"p99 ms":>8} {"errors":>6}')
+        for kind in args.servers:
+            process = start_server(kind, args.port, db_path, args.workers, args.threads)
+            try:
+                for scenario in scenarios:
+                    for concurrency in args.concurrency:
+                        unrendered = list(invoice_ids)
+
+                        def next_request(index, count):
+                            if scenario == 'download':
+                                try:
+                                    return 'GET', f'/api/invoices/{unrendered.pop()}/download', None
+                                except IndexError:
+                                    return None
+                            if scenario == 'mixed' and (count + index) % args.write_every == 0:
+                                return 'POST', '/api/invoices', body
+                            return 'GET', f'/api/invoices/{invoice_ids[(index * 7919 + count) % len(invoice_ids)]}', None
+
+                        results, elapsed = run_load(args.port, concurrency, args.seconds, next_request)
+                        timings = sorted(timing for _, timing in results)
+                        errors = sum(1 for status, _ in results if status >= 400 or status == 0)
+                        print(f'{kind:>6} {scenario:>9} {concurrency:>7} {len(results) / elapsed:>8.1f} '
+                              f'{percentile(timings, 0.5) * 1e3:>8.1f} {percentile(timings, 0.99) * 1e3:>8.1f} {errors:>6}')
+                        if scenario == 'download':
+                            with app.app_context():
+                                for invoice_id in invoice_ids:
+                                    filepath = get_cached_pdf_path(get_render_job_id(invoice_id, INVOICE_TEMPLATE))
+                                    if os.path.exists(filepath):
+                                        os.unlink(filepath)
+            finally:
+                process.terminate()
+                process.wait()
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(db_path + suffix):
+                os.unlink(db_path + suffix)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Measures POST /api/{clients,products}/import throughput and peak memory.
+
+Writes --rows synthetic rows to a temporary CSV or NDJSON file, streams it to
+the import endpoint and reports rows per second. With --trace-memory it also
+reports the peak Python heap (tracemalloc, which slows the run down several
+times) while the upload is read, validated and inserted. Run it with two sizes
+to check that memory does not grow with the file.
+
+    python -m benchmarks.catalog_import --kind products --rows 100000
+    python -m benchmarks.catalog_import --kind clients --rows 100000 --format ndjson
+"""
+import argparse
+import csv
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.common import temporary_database
+
+COLUMNS = {
+    'clients': ('client_name', 'client_address', 'client_city', 'client_tin', 'is_client_taxable'),
+    'products': ('product_name', 'product_description', 'product_price', 'product_vat_percent')
+}
+
+
+def make_row(kind, i):
+    if kind == 'clients':
+        return (f'Client {i}', f'Street {i}', 'Riyadh', f'3{i:014d}', i % 2 == 0)
+    return (f'Product {i}', f'Synthetic product number {i}', 10 + i % 1000 / 10, 15)
+
+
+def write_file(kind, import_format, row_count):
+    fd, path = tempfile.mkstemp(suffix=f'.{import_format}')
+    with os.fdopen(fd, 'w', newline='') as output:
+        if import_format == 'csv':
+            writer = csv.writer(output)
+            writer.writerow(COLUMNS[kind])
+            writer.writerows(make_row(kind, i) for i in range(row_count))
+        else:
+            for i in range(row_count):
+                output.write(json.dumps(dict(zip(COLUMNS[kind], make_row(kind, i)))) + '\n')
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--kind', choices=sorted(COLUMNS), default='products')
+    parser.add_argument('--format', choices=('csv', 'ndjson'), default='csv')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--trace-memory', action='store_true')
+    args = parser.parse_args()
+
+    path = write_file(args.kind, args.format, args.rows)
+    try:
+        with temporary_database() as test_client, open(path, 'rb') as upload:
+            if args.trace_memory:
+                tracemalloc.start()
+            started = time.perf_counter()
+            response = test_client.post(f'/api/{args.kind}/import', input_stream=upload,
+                                        query_string={'format': args.format},
+                                        headers={'Content-Length': str(os.path.getsize(path))})
+            done = None
+            for line in response.response:
+                done = json.loads(line)
+            elapsed = time.perf_counter() - started
+        print(f'file {os.path.getsize(path) / 1e6:.1f} MB, {done}')
+        print(f'{args.rows} {args.kind} in {elapsed:.2f} s ({args.rows / elapsed:,.0f} rows/s)')
+        if args.trace_memory:
+            print(f'peak heap {tracemalloc.get_traced_memory()[1] / 1e6:.1f} MB')
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
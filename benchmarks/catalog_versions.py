@@ -0,0 +1,196 @@
+"""
+Storage and insert cost of keeping catalog details as shared versions instead
+of copying them onto every invoice and invoice item.
+
+Seeds --invoices invoices of --lines items for --clients clients and
+--products products in --revisions rounds, raising every product price
+between rounds so each product gets that many versions. The same invoices are
+then written in the layout before migration 6, with the details copied per
+row, and both databases are vacuumed and measured per table with dbstat.
+
+The old layout copy is then migrated to time migration 6 and the VACUUM that
+hands the dropped columns' space back. Last, --single invoices are created one
+request at a time and --batch in one batch request.
+
+    python -m benchmarks.catalog_versions --invoices 20000 --lines 10
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+
+from app import basedir
+from application import db
+from application.cache import cache
+from application.migrations import migrate
+from benchmarks.common import MAX_BATCH_SIZE, invoice_payload, seed_dataset, temporary_database
+
+# Fills the layout of migration 5 from the versioned one, the catalog tables have the same columns in both
+DENORMALIZE = [
+    'INSERT INTO clients SELECT * FROM versioned.clients',
+    'INSERT INTO products SELECT * FROM versioned.products',
+    '''
+    INSERT INTO invoices (invoice_id, invoice_number, invoice_series, invoice_year, sequence_number, client_id, created_at,
+        invoice_gross_amount, total_discount_amount, total_tax_amount, invoice_net_amount,
+        client_name, client_tin, client_address, client_city, is_client_taxable)
+    SELECT invoice_id, invoice_number, invoice_series, invoice_year, sequence_number, invoices.client_id, invoices.created_at,
+        invoice_gross_amount, total_discount_amount, total_tax_amount, invoice_net_amount,
+        client_name, client_tin, client_address, client_city, is_client_taxable
+    FROM versioned.invoices JOIN versioned.client_versions ON client_versions.version_id = client_version_id
+    ''',
+    '''
+    INSERT INTO invoice_items (invoice_item_id, product_id, invoice_id, product_quantity, total_price, markup_amount,
+        gross_amount, discount_amount, amount_after_discount, vat_amount, net_amount, product_name, product_price,
+        product_price_currency, product_discount_percent, product_markup_percent, product_vat_percent)
+    SELECT invoice_item_id, invoice_items.product_id, invoice_id, product_quantity, total_price, markup_amount,
+        gross_amount, discount_amount, amount_after_discount, vat_amount, net_amount, product_name, product_price,
+        product_price_currency, product_discount_percent, product_markup_percent, product_vat_percent
+    FROM versioned.invoice_items JOIN versioned.product_versions ON product_versions.version_id = product_version_id
+    ''',
+    *[f"INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild')" for table in ('clients', 'products', 'invoices')]
+]
+REPORTED_TABLES = ('invoices', 'invoice_items', 'client_versions', 'product_versions')
+
+
+def seed(test_client, args):
+    ids = seed_dataset(test_client, args.clients, args.products, 0, args.lines)
+    round_size = -(-args.invoices // args.revisions)
+    for revision in range(args.revisions):
+        if revision:
+            with test_client.application.app_context():
+                db.engine.execute('UPDATE products SET product_price = product_price + 1')
+            cache.clear()
+        count = min(round_size, args.invoices - revision * round_size)
+        payloads = [invoice_payload(ids['client'][i % args.clients],
+                                    [ids['product'][(i * args.lines + line) % args.products] for line in range(args.lines)],
+                                    args.lines) for i in range(count)]
+        for offset in range(0, count, MAX_BATCH_SIZE):
+            response = test_client.post('/api/invoices/batch', json={'invoices': payloads[offset:offset + MAX_BATCH_SIZE]})
+            assert response.status_code == 201, response.get_data(as_text=True)[:500]
+    return ids
+
+
+def build_old_layout(versioned_path, old_path):
+    # The tracked database predates the versions, migrated to 5 and emptied it has the old layout
+    shutil.copyfile(os.path.join(basedir, 'invoice_system.db'), old_path)
+    engine = create_engine('sqlite:///' + old_path)
+    migrate(engine, target_version=5)
+    engine.dispose()
+    connection = sqlite3.connect(old_path, isolation_level=None)
+    for table in ('invoice_items', 'invoices', 'clients', 'products', 'invoice_sequences'):
+        connection.execute(f'DELETE FROM {table}')
+    connection.execute('ATTACH DATABASE ? AS versioned', (versioned_path,))
+    connection.execute('BEGIN')
+    for statement in DENORMALIZE:
+        connection.execute(statement)
+    connection.execute('COMMIT')
+    connection.execute('DETACH DATABASE versioned')
+    connection.execute('VACUUM')
+    connection.close()
+
+
+def table_sizes(db_path):
+    # Bytes per table, counting its indexes and for FTS5 tables the shadow tables of the search index
+    connection = sqlite3.connect(db_path)
+    sizes = {}
+    rows = connection.execute('''
+        SELECT coalesce(sqlite_master.tbl_name, dbstat.name), sum(pgsize) FROM dbstat
+        LEFT JOIN sqlite_master ON sqlite_master.name = dbstat.name GROUP BY 1
+    ''')
+    for name, size in rows:
+        table = name.split('_fts')[0] + ' search index' if '_fts' in name else name
+        sizes[table] = sizes.get(table, 0) + size
+    connection.close()
+    return sizes, os.path.getsize(db_path)
+
+
+def vacuum(db_path):
+    connection = sqlite3.connect(db_path, isolation_level=None)
+    connection.execute('VACUUM')
+    connection.close()
+
+
+def print_sizes(layouts, line_count):
+    print(f'{"bytes":>28} ' + ' '.join(f'{name:>14}' for name in layouts))
+    tables = [table for table in REPORTED_TABLES + ('invoices search index', 'client_versions search index')
+              if any(table in sizes for sizes, _ in layouts.values())]
+    for table in tables:
+        print(f'{table:>28} ' + ' '.join(f'{sizes.get(table, 0):>14,}' for sizes, _ in layouts.values()))
+    print(f'{"database file":>28} ' + ' '.join(f'{file_size:>14,}' for _, file_size in layouts.values()))
+    print(f'{"per invoice line":>28} ' + ' '.join(f'{file_size / line_count:>14.1f}' for _, file_size in layouts.values()))
+
+
+def measure_inserts(test_client, ids, args):
+    payloads = [invoice_payload(ids['client'][i % args.clients],
+                                [ids['product'][(i * args.lines + line) % args.products] for line in range(args.lines)],
+                                args.lines) for i in range(max(args.single, args.batch))]
+    started = time.perf_counter()
+    for payload in payloads[:args.single]:
+        assert test_client.post('/api/invoices', json=payload).status_code == 201
+    single = time.perf_counter() - started
+    started = time.perf_counter()
+    for offset in range(0, args.batch, MAX_BATCH_SIZE):
+        response = test_client.post('/api/invoices/batch', json={'invoices': payloads[offset:min(offset + MAX_BATCH_SIZE, args.batch)]})
+        assert response.status_code == 201
+    batch = time.perf_counter() - started
+    print(f'\n{"inserts":>28} {"invoices/s":>14} {"lines/s":>14}')
+    print(f'{"single requests":>28} {args.single / single:>14.1f} {args.single * args.lines / single:>14.0f}')
+    print(f'{"batch":>28} {args.batch / batch:>14.1f} {args.batch * args.lines / batch:>14.0f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--invoices', type=int, default=20000)
+    parser.add_argument('--lines', type=int, default=10, help='Items per invoice.')
+    parser.add_argument('--revisions', type=int, default=4, help='Price changes of every product, plus one.')
+    parser.add_argument('--single', type=int, default=500, help='Invoices created one request at a time.')
+    parser.add_argument('--batch', type=int, default=5000, help='Invoices created in batch requests.')
+    args = parser.parse_args()
+
+    with temporary_database({'SQLITE_PROFILE': 'production'}) as test_client:
+        db_path = test_client.application.config['SQLALCHEMY_DATABASE_URI'][len('sqlite:///'):]
+        started = time.perf_counter()
+        ids = seed(test_client, args)
+        print(f'seeded {args.invoices} invoices of {args.lines} items in {args.revisions} price revisions '
+              f'in {time.perf_counter() - started:.1f} s\n')
+
+        work_dir = tempfile.mkdtemp()
+        try:
+            versioned_path = os.path.join(work_dir, 'versioned.db')
+            connection = sqlite3.connect(db_path)
+            connection.execute('VACUUM INTO ?', (versioned_path,))
+            connection.close()
+            old_path = os.path.join(work_dir, 'old.db')
+            build_old_layout(versioned_path, old_path)
+
+            migrated_path = os.path.join(work_dir, 'migrated.db')
+            shutil.copyfile(old_path, migrated_path)
+            engine = create_engine('sqlite:///' + migrated_path)
+            started = time.perf_counter()
+            migrate(engine)
+            migrated = time.perf_counter() - started
+            engine.dispose()
+            started = time.perf_counter()
+            vacuum(migrated_path)
+            vacuumed = time.perf_counter() - started
+
+            print_sizes({'copied': table_sizes(old_path), 'versioned': table_sizes(versioned_path),
+                         'migrated': table_sizes(migrated_path)}, args.invoices * args.lines)
+            print(f'\nmigration 6 took {migrated:.2f} s and the VACUUM after it {vacuumed:.2f} s')
+        finally:
+            shutil.rmtree(work_dir)
+
+        measure_inserts(test_client, ids, args)
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(db_path + suffix):
+                os.unlink(db_path + suffix)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import http.client
+import os
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+from uuid import uuid4
+
+from app import create_app
+from application import db
+from application.clients.models import Client
+from application.invoices.models import Invoice
+from application.products.models import Product
+
+HOST = '127.0.0.1'
+MAX_BATCH_SIZE = 1000
+
+
+@contextmanager
+def temporary_database(config=None):
+    # Yields a test client of an app on a new database, test_client.application is the app
+    db_fd, db_path = tempfile.mkstemp(suffix='.db')
+    os.close(db_fd)
+    app = create_app(dict(config or {}, SQLALCHEMY_DATABASE_URI='sqlite:///' + db_path))
+    try:
+        with app.app_context():
+            db.create_all()
+        yield app.test_client()
+    finally:
+        os.unlink(db_path)
+
+
+def seed_client(test_client, client_tin='399999999999993'):
+    return test_client.post('/api/clients', json={
+        'client_name': 'Benchmark Client',
+        'client_address': 'King Fahd Road',
+        'client_city': 'Riyadh',
+        'client_tin': client_tin,
+        'is_client_taxable': True
+    }).get_json()['added_client']['client_id']
+
+
+def seed_products(test_client, product_count):
+    return [test_client.post('/api/products', json={
+        'product_name': f'Product {i}',
+        'product_price': 10.0 + i,
+        'product_price_currency': 'SAR',
+        'product_discount_percent': 0.0,
+        'product_markup_percent': 20.0,
+        'product_vat_percent': 15.0
+    }).get_json()['added_product']['product_id'] for i in range(product_count)]
+
+
+def invoice_payload(client_id, product_ids, line_count):
+    return {
+        'client_id': client_id,
+        'invoice_items': [{
+            'product_id': product_ids[i % len(product_ids)],
+            'product_quantity': 3,
+            'product_discount_percent': 5.0,
+            'product_markup_percent': 20.0
+        } for i in range(line_count)]
+    }
+
+
+def seed_dataset(test_client, client_count, product_count, invoice_count, line_count):
+    # Clients and products are bulk inserted, invoices go through the batch endpoint so they are numbered,
+    # priced and summarised like real ones. Returns the seeded ids by kind.
+    app = test_client.application
+    client_ids = [uuid4().hex for _ in range(client_count)]
+    product_ids = [uuid4().hex for _ in range(product_count)]
+    with app.app_context():
+        db.session.bulk_insert_mappings(Client, [{
+            'client_id': client_id, 'client_name': f'Client {i}', 'client_address': 'King Fahd Road',
+            'client_city': 'Riyadh', 'client_tin': f'3{i:013d}3', 'is_client_taxable': i % 2 == 0
+        } for i, client_id in enumerate(client_ids)])
+        db.session.bulk_insert_mappings(Product, [{
+            'product_id': product_id, 'product_name': f'Product {i}', 'product_description': f'Description {i}',
+            'product_price_currency': 'SAR', 'product_price': 10.0 + i / 100, 'product_discount_percent': 0.0,
+            'product_markup_percent': 20.0, 'product_vat_percent': 15.0
+        } for i, product_id in enumerate(product_ids)])
+        db.session.commit()
+    payloads = [invoice_payload(client_ids[i % client_count],
+                                [product_ids[(i * line_count + line) % product_count] for line in range(line_count)],
+                                line_count) for i in range(invoice_count)]
+    for offset in range(0, invoice_count, MAX_BATCH_SIZE):
+        response = test_client.post('/api/invoices/batch', json={'invoices': payloads[offset:offset + MAX_BATCH_SIZE]})
+        assert response.status_code == 201, response.get_data(as_text=True)[:500]
+    with app.app_context():
+        invoice_ids = [invoice_id for invoice_id, in db.session.query(Invoice.invoice_id)]
+    return {'client': client_ids, 'product': product_ids, 'invoice': invoice_ids}
+
+
+def server_command(kind, port, workers):
+    if kind == 'wsgi':
+        # The Procfile setup: sync workers, one request per worker at a time
+        return ['gunicorn', 'wsgi:app', '--workers', str(workers), '--bind', f'{HOST}:{port}',
+                '--timeout', '120', '--log-level', 'warning']
+    return ['uvicorn', 'asgi:app', '--workers', str(workers), '--host', HOST, '--port', str(port),
+            '--log-level', 'warning', '--no-access-log']
+
+
+def start_server(kind, port, db_path, workers, threads=32):
+    # Serves db_path with gunicorn wsgi:app or uvicorn asgi:app and the production SQLite profile,
+    # returns the process once it answers
+    env = dict(os.environ, SQLITE_PATH=db_path, SQLITE_PROFILE='production',
+               ASGI_THREADS=str(threads), PDF_RENDER_WORKERS=str(workers))
+    process = subprocess.Popen(server_command(kind, port, workers), env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            connection = http.client.HTTPConnection(HOST, port, timeout=5)
+            connection.request('GET', '/api/products')
+            if connection.getresponse().status == 200:
+                connection.close()
+                return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f'{kind} server did not start')
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
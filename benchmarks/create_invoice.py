@@ -0,0 +1,49 @@
+"""
+Measures how POST /api/invoices latency grows with the number of invoice lines.
+
+Run from the repository root:
+
+    python -m benchmarks.create_invoice --lines 1 10 100 250 500 --repeat 20
+"""
+import argparse
+import statistics
+import time
+
+from sqlalchemy import event
+
+from application import db
+from benchmarks.common import invoice_payload, percentile, seed_client, seed_products, temporary_database
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lines', type=int, nargs='+', default=[1, 10, 50, 100, 250, 500])
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    statement_count = [0]
+    with temporary_database() as test_client:
+        with test_client.application.app_context():
+            event.listen(db.engine, 'before_cursor_execute',
+                         lambda *_: statement_count.__setitem__(0, statement_count[0] + 1))
+        client_id = seed_client(test_client)
+        product_ids = seed_products(test_client, max(args.lines))
+
+        print(f'{"lines":>6} {"median ms":>10} {"p95 ms":>10} {"us/line":>10} {"statements":>11}')
+        for line_count in args.lines:
+            payload = invoice_payload(client_id, product_ids, line_count)
+            timings = []
+            for _ in range(args.repeat):
+                statement_count[0] = 0
+                started = time.perf_counter()
+                response = test_client.post('/api/invoices', json=payload)
+                timings.append(time.perf_counter() - started)
+                assert response.status_code == 201, response.get_json()
+            timings.sort()
+            median = statistics.median(timings)
+            print(f'{line_count:>6} {median * 1e3:>10.2f} {percentile(timings, 0.95) * 1e3:>10.2f} '
+                  f'{median * 1e6 / line_count:>10.1f} {statement_count[0]:>11}')
+
+
+if __name__ == '__main__':
+    main()
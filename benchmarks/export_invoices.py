@@ -0,0 +1,56 @@
+"""
+Measures bulk export throughput (invoices/sec) of GET /api/invoices/export.
+
+Every run starts from an empty PDF cache for the seeded invoices, so the numbers
+include wkhtmltopdf rendering on the process pool. Requires wkhtmltopdf.
+
+    python -m benchmarks.export_invoices --invoices 200 --workers 4 --format zip
+"""
+import argparse
+import io
+import json
+import time
+import zipfile
+
+from application.invoices.rendering import DEFAULT_RENDER_WORKERS
+from benchmarks.common import invoice_payload, seed_client, seed_products, temporary_database
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--invoices', type=int, default=100)
+    parser.add_argument('--lines', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=DEFAULT_RENDER_WORKERS)
+    parser.add_argument('--format', choices=('zip', 'pdf'), default='zip')
+    args = parser.parse_args()
+
+    with temporary_database({'PDF_RENDER_WORKERS': args.workers}) as test_client:
+        client_id = seed_client(test_client)
+        product_ids = seed_products(test_client, args.lines)
+        payload = invoice_payload(client_id, product_ids, args.lines)
+        for _ in range(args.invoices):
+            assert test_client.post('/api/invoices', json=payload).status_code == 201
+
+        started = time.perf_counter()
+        first_byte_at = None
+        size = 0
+        data = io.BytesIO()
+        response = test_client.get('/api/invoices/export', query_string={'client_id': client_id, 'format': args.format},
+                                   buffered=False)
+        for chunk in response.response:
+            if first_byte_at is None and chunk:
+                first_byte_at = time.perf_counter()
+            size += len(chunk)
+            data.write(chunk)
+        elapsed = time.perf_counter() - started
+
+        print(f'format={args.format} workers={args.workers} invoices={args.invoices} lines={args.lines}')
+        print(f'time to first byte: {(first_byte_at - started) * 1e3:.1f} ms')
+        print(f'total: {elapsed:.2f} s, {size / 1e6:.1f} MB, {args.invoices / elapsed:.2f} invoices/sec')
+        if args.format == 'zip':
+            with zipfile.ZipFile(data) as archive:
+                print('server report:', json.loads(archive.read('export_report.json')))
+
+
+if __name__ == '__main__':
+    main()
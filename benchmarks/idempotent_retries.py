@@ -0,0 +1,113 @@
+"""
+Load test for POST /api/invoices with Idempotency-Key retries.
+
+Worker processes send invoices whose Idempotency-Key is drawn from a small pool
+of --keys keys, so most requests are duplicates of each other, some of them in
+flight at the same time. Each worker counts the INSERT, UPDATE and DELETE
+statements run while serving original requests and replays. The report shows
+that the database ends up with one invoice per key and that replays write
+nothing, apart from the single rolled back claim of a duplicate that arrived
+while the original was still in flight.
+
+    python -m benchmarks.idempotent_retries --workers 4 --threads 2 --requests 200 --keys 100
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import tempfile
+import threading
+import time
+
+from benchmarks.common import percentile
+from benchmarks.sqlite_concurrency import load_app, seed
+
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE')
+
+
+def run_worker(db_path, client_id, product_ids, threads, request_count, key_count, lines, seed_value):
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from benchmarks.common import invoice_payload
+    app = load_app('production', db_path)
+    local = threading.local()
+
+    def count_writes(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(WRITE_STATEMENTS):
+            local.writes += 1
+
+    event.listen(Engine, 'before_cursor_execute', count_writes)
+    results = []
+    lock = threading.Lock()
+
+    def loop(thread_index):
+        rng = random.Random(seed_value * 100 + thread_index)
+        test_client = app.test_client()
+        payload = invoice_payload(client_id, product_ids, lines)
+        for _ in range(request_count):
+            local.writes = 0
+            started = time.perf_counter()
+            response = test_client.post('/api/invoices', json=payload,
+                                        headers={'Idempotency-Key': f'key-{rng.randrange(key_count)}'})
+            elapsed = time.perf_counter() - started
+            kind = 'replay' if response.headers.get('Idempotent-Replayed') else 'original'
+            with lock:
+                results.append((kind, response.status_code, local.writes, elapsed))
+
+    workers = [threading.Thread(target=loop, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return results
+
+
+def count_rows(db_path):
+    from application.idempotency import IdempotencyKey
+    from application.invoices.models import Invoice
+    app = load_app('production', db_path)
+    with app.app_context():
+        return Invoice.query.count(), IdempotencyKey.query.count()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=2)
+    parser.add_argument('--requests', type=int, default=200, help='Requests per thread.')
+    parser.add_argument('--keys', type=int, default=100)
+    parser.add_argument('--lines', type=int, default=20)
+    args = parser.parse_args()
+
+    db_fd, db_path = tempfile.mkstemp(suffix='.db')
+    os.close(db_fd)
+    context = multiprocessing.get_context('spawn')
+    try:
+        with context.Pool(1) as pool:
+            client_id, product_ids = pool.apply(seed, ('production', db_path, args.lines))
+        with context.Pool(args.workers) as pool:
+            started = time.perf_counter()
+            results = [result for worker_results in pool.starmap(run_worker, [
+                (db_path, client_id, product_ids, args.threads, args.requests, args.keys, args.lines, i)
+                for i in range(args.workers)
+            ]) for result in worker_results]
+            elapsed = time.perf_counter() - started
+        with context.Pool(1) as pool:
+            invoice_count, key_count = pool.apply(count_rows, (db_path,))
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db_path + suffix):
+                os.unlink(db_path + suffix)
+
+    print(f'{len(results)} requests in {elapsed:.1f} s, statuses {sorted({status for _, status, _, _ in results})}')
+    print(f'{"kind":>10} {"requests":>9} {"writes":>7} {"p50 ms":>8} {"p95 ms":>8}')
+    for kind in ('original', 'replay'):
+        rows = [row for row in results if row[0] == kind]
+        timings = sorted(row[3] for row in rows)
+        print(f'{kind:>10} {len(rows):>9} {sum(row[2] for row in rows):>7} '
+              f'{percentile(timings, 0.5) * 1e3 if timings else 0:>8.2f} {percentile(timings, 0.95) * 1e3 if timings else 0:>8.2f}')
+    print(f'{invoice_count} invoices and {key_count} stored keys for {args.keys} keys')
+
+
+if __name__ == '__main__':
+    main()
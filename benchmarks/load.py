@@ -0,0 +1,249 @@
+"""
+Load and regression benchmark for the invoice API.
+
+Seeds a temporary database with --clients clients, --products products and
+--invoices invoices of --lines items each, then drives one endpoint at a time
+with --concurrency workers for --seconds and reports throughput and p50, p95
+and p99 latency per endpoint. Every worker sends --warmup untimed requests
+first. Invoices are created last, so the read endpoints of two runs see the
+same data.
+
+    --target client   Flask test client threads inside this process
+    --target wsgi     gunicorn wsgi:app with --server-workers processes
+    --target asgi     uvicorn asgi:app with --server-workers processes
+
+--output saves the results and the run's settings as JSON. --baseline compares
+the run with such a file: an endpoint whose p95 latency grew or whose
+throughput fell by more than --tolerance is a regression, and the exit status
+is then 1. Compare runs with the same settings on the same machine.
+
+    python -m benchmarks.load --invoices 5000 --lines 10 --output baseline.json
+    python -m benchmarks.load --invoices 5000 --lines 10 --baseline baseline.json
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from datetime import date, datetime
+
+from app import basedir
+from benchmarks.common import HOST, invoice_payload, percentile, seed_dataset, start_server, temporary_database
+
+# Settings that must match for two runs to be comparable
+COMPARABLE_SETTINGS = ('clients', 'products', 'invoices', 'lines', 'target', 'concurrency', 'server_workers')
+
+YEAR_START = date.today().replace(month=1, day=1)
+
+# Each endpoint picks its next request from the seeded ids
+ENDPOINTS = {
+    'list_invoices': lambda rng, ids, lines: ('GET', '/api/invoices?limit=100', None),
+    'get_invoice': lambda rng, ids, lines: ('GET', f'/api/invoices/{rng.choice(ids["invoice"])}', None),
+    'search_invoices': lambda rng, ids, lines: ('GET', '/api/invoices/search?q=client', None),
+    'list_clients': lambda rng, ids, lines: ('GET', '/api/clients', None),
+    'get_client': lambda rng, ids, lines: ('GET', f'/api/clients/{rng.choice(ids["client"])}', None),
+    'list_products': lambda rng, ids, lines: ('GET', '/api/products', None),
+    'get_product': lambda rng, ids, lines: ('GET', f'/api/products/{rng.choice(ids["product"])}', None),
+    'search_products': lambda rng, ids, lines: ('GET', '/api/products/search?q=prod', None),
+    'client_report': lambda rng, ids, lines: ('GET', f'/api/reports/clients?client_id={rng.choice(ids["client"])}', None),
+    'vat_report': lambda rng, ids, lines: ('GET', f'/api/reports/vat?from_date={YEAR_START}&to_date={date.today()}', None),
+    'create_invoice': lambda rng, ids, lines: ('POST', '/api/invoices', invoice_payload(
+        rng.choice(ids['client']), rng.sample(ids['product'], min(lines, len(ids['product']))), lines))
+}
+
+
+class TestClientSession:
+
+    def __init__(self, app):
+        self.test_client = app.test_client()
+
+    def send(self, method, path, body):
+        return self.test_client.open(path, method=method, json=body).status_code
+
+    def close(self):
+        pass
+
+
+class HttpSession:
+    # One keep-alive connection per worker, like a client with a connection pool
+
+    def __init__(self, port):
+        self.port = port
+        self.connection = http.client.HTTPConnection(HOST, port, timeout=120)
+
+    def send(self, method, path, body):
+        try:
+            self.connection.request(method, path, body=json.dumps(body) if body is not None else None,
+                                    headers={'Content-Type': 'application/json'} if body is not None else {})
+            response = self.connection.getresponse()
+            response.read()
+            return response.status
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            return 0
+
+    def close(self):
+        self.connection.close()
+
+
+def run_endpoint(make_session, next_request, ids, args):
+    results = []
+    lock = threading.Lock()
+    ready = threading.Barrier(args.concurrency + 1)
+    timings = {}
+
+    def loop(index):
+        rng = random.Random(args.seed * 1000 + index)
+        session = make_session()
+        try:
+            for _ in range(args.warmup):
+                session.send(*next_request(rng, ids, args.lines))
+            ready.wait()
+            worker_results = []
+            while time.perf_counter() < timings['deadline']:
+                request = next_request(rng, ids, args.lines)
+                started = time.perf_counter()
+                status = session.send(*request)
+                worker_results.append((status, time.perf_counter() - started))
+            with lock:
+                results.extend(worker_results)
+        finally:
+            session.close()
+
+    workers = [threading.Thread(target=loop, args=(i,)) for i in range(args.concurrency)]
+    for worker in workers:
+        worker.start()
+    timings['deadline'] = float('inf')
+    ready.wait()
+    started = time.perf_counter()
+    timings['deadline'] = started + args.seconds
+    for worker in workers:
+        worker.join()
+    return summarize(results, time.perf_counter() - started)
+
+
+def summarize(results, elapsed):
+    latencies = sorted(latency for _, latency in results)
+    return {
+        'requests': len(results),
+        'errors': sum(1 for status, _ in results if status == 0 or status >= 400),
+        'throughput': len(results) / elapsed,
+        'mean_ms': sum(latencies) / len(latencies) * 1e3,
+        'p50_ms': percentile(latencies, 0.5) * 1e3,
+        'p95_ms': percentile(latencies, 0.95) * 1e3,
+        'p99_ms': percentile(latencies, 0.99) * 1e3,
+        'max_ms': latencies[-1] * 1e3
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=basedir,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    # Returns the names of the endpoints that regressed against the baseline
+    settings, baseline_settings = results['settings'], baseline['settings']
+    mismatched = [name for name in COMPARABLE_SETTINGS if settings.get(name) != baseline_settings.get(name)]
+    if mismatched:
+        print(f'warning: baseline was run with different {", ".join(mismatched)}')
+    print(f'\nagainst baseline {baseline.get("commit") or "?"} of {baseline["created_at"]}, tolerance {tolerance:.0%}')
+    print(f'{"endpoint":>16} {"p95 ms":>18} {"change":>8} {"req/s":>18} {"change":>8}')
+    regressions = []
+    for name, result in results['endpoints'].items():
+        base = baseline['endpoints'].get(name)
+        if base is None:
+            print(f'{name:>16} {"not in baseline":>18}')
+            continue
+        p95_change = result['p95_ms'] / base['p95_ms'] - 1
+        throughput_change = result['throughput'] / base['throughput'] - 1
+        regressed = p95_change > tolerance or throughput_change < -tolerance
+        if regressed:
+            regressions.append(name)
+        print(f'{name:>16} {base["p95_ms"]:>8.2f} -> {result["p95_ms"]:>6.2f} {p95_change:>+8.0%} '
+              f'{base["throughput"]:>8.0f} -> {result["throughput"]:>6.0f} {throughput_change:>+8.0%}'
+              f'{"  REGRESSION" if regressed else ""}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--invoices', type=int, default=5000)
+    parser.add_argument('--lines', type=int, default=10, help='Items per invoice.')
+    parser.add_argument('--endpoints', nargs='+', choices=list(ENDPOINTS), default=list(ENDPOINTS))
+    parser.add_argument('--target', choices=('client', 'wsgi', 'asgi'), default='client')
+    parser.add_argument('--server-workers', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--warmup', type=int, default=10, help='Untimed requests per worker and endpoint.')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--port', type=int, default=8767)
+    parser.add_argument('--output', help='Write the results to this JSON file.')
+    parser.add_argument('--baseline', help='Compare with the results in this JSON file.')
+    parser.add_argument('--tolerance', type=float, default=0.15)
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    with temporary_database({'SQLITE_PROFILE': 'production'}) as test_client:
+        app = test_client.application
+        db_path = app.config['SQLALCHEMY_DATABASE_URI'][len('sqlite:///'):]
+        started = time.perf_counter()
+        ids = seed_dataset(test_client, args.clients, args.products, args.invoices, args.lines)
+        print(f'seeded {args.clients} clients, {args.products} products and {args.invoices} invoices of '
+              f'{args.lines} items in {time.perf_counter() - started:.1f} s')
+
+        process = None
+        if args.target == 'client':
+            make_session = lambda: TestClientSession(app)
+        else:
+            process = start_server(args.target, args.port, db_path, args.server_workers)
+            make_session = lambda: HttpSession(args.port)
+
+        results = {
+            'created_at': datetime.utcnow().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'machine': f'{platform.system()} {platform.machine()}, {os.cpu_count()} cpus',
+            'settings': {name: value for name, value in vars(args).items() if name not in ('output', 'baseline')},
+            'endpoints': {}
+        }
+        print(f'{"endpoint":>16} {"requests":>9} {"errors":>7} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+        try:
+            # create_invoice adds invoices, so it runs after the endpoints that read them
+            for name in sorted(args.endpoints, key=lambda name: name == 'create_invoice'):
+                result = results['endpoints'][name] = run_endpoint(make_session, ENDPOINTS[name], ids, args)
+                print(f'{name:>16} {result["requests"]:>9} {result["errors"]:>7} {result["throughput"]:>8.1f} '
+                      f'{result["p50_ms"]:>8.2f} {result["p95_ms"]:>8.2f} {result["p99_ms"]:>8.2f}')
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait()
+            for suffix in ('-wal', '-shm'):
+                if os.path.exists(db_path + suffix):
+                    os.unlink(db_path + suffix)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    if baseline is not None and compare(results, baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
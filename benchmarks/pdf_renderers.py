@@ -0,0 +1,81 @@
+"""
+Compares the PDF backends on the same invoice: wkhtmltopdf through pdfkit against
+in-process WeasyPrint.
+
+Each backend runs in a fresh process and renders the invoice --renders times in a
+row, like a render pool worker. The first render is reported on its own because it
+pays for imports and font loading. Memory is the peak RSS of the rendering process
+plus, for wkhtmltopdf, the peak RSS of its largest child process.
+
+    python -m benchmarks.pdf_renderers --renders 20 --lines 10
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+from application.invoices.rendering import PDF_RENDERERS
+
+
+def render_invoice_html(lines):
+    from application.invoices.models import Invoice
+    from application.invoices.templating import render_invoice_html
+    from benchmarks.common import invoice_payload, seed_client, seed_products, temporary_database
+    with temporary_database() as test_client:
+        client_id = seed_client(test_client)
+        payload = invoice_payload(client_id, seed_products(test_client, lines), lines)
+        invoice_id = test_client.post('/api/invoices', json=payload).get_json()['invoice_details']['invoice_id']
+        with test_client.application.app_context():
+            return render_invoice_html(Invoice.query.filter_by(invoice_id=invoice_id).one())
+
+
+def run_backend(renderer_name, html, renders):
+    from application.invoices.rendering import render_pdf
+    from benchmarks.common import percentile
+    timings = []
+    with tempfile.TemporaryDirectory() as pdf_dir:
+        filepath = os.path.join(pdf_dir, 'invoice.pdf')
+        for _ in range(renders):
+            started = time.perf_counter()
+            render_pdf(html, filepath, renderer_name)
+            timings.append(time.perf_counter() - started)
+        size = os.path.getsize(filepath)
+    warm = sorted(timings[1:]) or timings
+    return {
+        'first_ms': timings[0] * 1e3,
+        'p50_ms': percentile(warm, 0.5) * 1e3,
+        'p95_ms': percentile(warm, 0.95) * 1e3,
+        'self_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'children_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        'pdf_kb': size / 1024
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', nargs='+', choices=sorted(PDF_RENDERERS), default=sorted(PDF_RENDERERS))
+    parser.add_argument('--renders', type=int, default=20)
+    parser.add_argument('--lines', type=int, default=10)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1) as pool:
+        html = pool.apply(render_invoice_html, (args.lines,))
+
+    print(f'{"backend":>12} {"first ms":>9} {"p50 ms":>8} {"p95 ms":>8} {"rss MB":>8} {"child MB":>9} {"pdf KB":>7}')
+    for renderer_name in args.backends:
+        # A new process per backend, so neither sees the other's imports or peak memory
+        with context.Pool(1) as pool:
+            try:
+                result = pool.apply(run_backend, (renderer_name, html, args.renders))
+            except Exception as e:
+                print(f'{renderer_name:>12} failed: {e!r}')
+                continue
+        print(f'{renderer_name:>12} {result["first_ms"]:>9.1f} {result["p50_ms"]:>8.1f} {result["p95_ms"]:>8.1f} '
+              f'{result["self_rss_mb"]:>8.1f} {result["children_rss_mb"]:>9.1f} {result["pdf_kb"]:>7.1f}')
+
+
+if __name__ == '__main__':
+    main()
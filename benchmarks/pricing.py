@@ -0,0 +1,56 @@
+"""
+Throughput of the vectorized pricing engine against the per-line decimal reference.
+
+    python -m benchmarks.pricing --lines 1000000 5000000 --lines-per-invoice 250
+"""
+import argparse
+import time
+
+import numpy as np
+
+from application.invoices.pricing import price_line_reference, price_lines, sum_per_invoice
+
+
+def random_lines(line_count, seed=0):
+    rng = np.random.default_rng(seed)
+    return (
+        rng.integers(1, 10 ** 7, line_count) / 100,
+        rng.integers(1, 10 ** 5, line_count) / 1000,
+        rng.integers(0, 5000, line_count) / 100,
+        rng.integers(0, 10000, line_count) / 100,
+        rng.choice([0.0, 5.0, 15.0], line_count),
+        rng.random(line_count) < 0.8
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lines', type=int, nargs='+', default=[100000, 1000000, 5000000])
+    parser.add_argument('--lines-per-invoice', type=int, default=250)
+    parser.add_argument('--reference-sample', type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f'{"lines":>9} {"vectorized s":>13} {"lines/s":>12} {"reference lines/s":>18} {"speedup":>8}')
+    for line_count in args.lines:
+        lines = random_lines(line_count)
+        line_counts = np.full(line_count // args.lines_per_invoice, args.lines_per_invoice)
+        line_counts[-1] += line_count - line_counts.sum()
+
+        started = time.perf_counter()
+        line_amounts = price_lines(*lines)
+        sum_per_invoice(line_amounts, line_counts)
+        vectorized = time.perf_counter() - started
+
+        sample = min(args.reference_sample, line_count)
+        started = time.perf_counter()
+        for i in range(sample):
+            expected = price_line_reference(*(values[i] for values in lines))
+            assert expected['net_amount'] == line_amounts['net_amount'][i]
+        reference_rate = sample / (time.perf_counter() - started)
+
+        rate = line_count / vectorized
+        print(f'{line_count:>9} {vectorized:>13.3f} {rate:>12.0f} {reference_rate:>18.0f} {rate / reference_rate:>7.0f}x')
+
+
+if __name__ == '__main__':
+    main()
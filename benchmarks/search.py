@@ -0,0 +1,91 @@
+"""
+Measures GET /api/products/search latency on a large catalog.
+
+Seeds --products synthetic products (names and descriptions drawn from a fixed
+vocabulary, so common prefixes match many rows) with the FTS triggers in place,
+then times short prefixes, whole words and multi word queries.
+
+    python -m benchmarks.search --products 1000000 --repeat 50
+"""
+import argparse
+import os
+import random
+import time
+from uuid import uuid4
+
+from application import db
+from benchmarks.common import percentile, temporary_database
+
+SYLLABLES = ['al', 'ba', 'dar', 'fa', 'ha', 'ja', 'ka', 'lu', 'ma', 'na', 'qa', 'ra', 'sa', 'ta', 'wa', 'za']
+INSERT_PRODUCT = '''
+INSERT INTO products (product_id, product_name, product_description, product_price_currency, product_price,
+    product_discount_percent, product_markup_percent, product_vat_percent, created_at, last_updated_at)
+VALUES (?, ?, ?, 'SAR', ?, 0, 20, 15, datetime('now'), datetime('now'))
+'''
+
+
+def make_vocabulary(rng, size):
+    return list({''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))) for _ in range(size * 2)})[:size]
+
+
+def seed(app, product_count, vocabulary, rng, chunk_size=10000):
+    with app.app_context():
+        connection = db.engine.raw_connection()
+        try:
+            for offset in range(0, product_count, chunk_size):
+                connection.executemany(INSERT_PRODUCT, [(
+                    uuid4().hex,
+                    ' '.join(rng.choices(vocabulary, k=3)),
+                    ' '.join(rng.choices(vocabulary, k=12)),
+                    rng.randint(100, 100000) / 100
+                ) for _ in range(min(chunk_size, product_count - offset))])
+                connection.commit()
+        finally:
+            connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--products', type=int, default=1000000)
+    parser.add_argument('--vocabulary', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args()
+
+    rng = random.Random(7)
+    vocabulary = make_vocabulary(rng, args.vocabulary)
+    with temporary_database() as test_client:
+        app = test_client.application
+        started = time.perf_counter()
+        seed(app, args.products, vocabulary, rng)
+        db_path = app.config['SQLALCHEMY_DATABASE_URI'][len('sqlite:///'):]
+        print(f'seeded {args.products} products with the search index in {time.perf_counter() - started:.1f} s, '
+              f'database {os.path.getsize(db_path) / 1e6:.0f} MB')
+
+        word = vocabulary[0]
+        queries = [
+            ('2 letter prefix', word[:2]),
+            ('3 letter prefix', word[:3]),
+            ('whole word', word),
+            ('two words', f'{word} {vocabulary[1][:3]}'),
+            ('no match', 'xyzzy'),
+            ('deep page', word[:3])
+        ]
+        print(f'{"query":>16} {"q":>16} {"p50 ms":>8} {"p95 ms":>8} {"rows":>5}')
+        for name, q in queries:
+            params = {'q': q, 'limit': args.limit}
+            if name == 'deep page':
+                params['offset'] = 50 * args.limit
+            timings = []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                response = test_client.get('/api/products/search', query_string=params)
+                timings.append(time.perf_counter() - started)
+                assert response.status_code == 200, response.get_data(as_text=True)
+            timings.sort()
+            print(f'{name:>16} {q:>16} {percentile(timings, 0.5) * 1e3:>8.2f} {percentile(timings, 0.95) * 1e3:>8.2f} '
+                  f'{len(response.get_json()):>5}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Measures the GET list and detail endpoints and the serialization path behind them.
+
+For each endpoint it reports request latency through the test client, then times
+the same rows through marshmallow + flask.jsonify and through the generated
+serializers + fast_jsonify, and checks the two produce identical bytes.
+
+    python -m benchmarks.serialization --clients 1000 --products 1000 --invoices 1000 --lines 10
+"""
+import argparse
+import time
+
+import flask
+
+from sqlalchemy.orm import selectinload
+
+from application.cache import cache
+from application.clients.models import Client
+from application.clients.schemas import client_schema, clients_schema, dump_client, dump_clients
+from application.invoices.models import Invoice
+from application.invoices.schemas import dump_invoice, dump_invoices, invoice_schema, invoices_schema
+from application.products.models import Product
+from application.products.schemas import dump_product, dump_products, product_schema, products_schema
+from application.serialization import fast_jsonify, orjson
+from benchmarks.common import percentile, seed_dataset, temporary_database
+
+
+def seed(test_client, client_count, product_count, invoice_count, line_count):
+    ids = seed_dataset(test_client, client_count, product_count, invoice_count, line_count)
+    return {kind: seeded_ids[0] for kind, seeded_ids in ids.items()}
+
+
+def time_request(test_client, url, repeat):
+    timings = []
+    for _ in range(repeat):
+        # Client and product lists are cached as dicts, clear it so every request serializes rows
+        cache.clear()
+        started = time.perf_counter()
+        response = test_client.get(url)
+        timings.append(time.perf_counter() - started)
+        assert response.status_code == 200, response.get_data(as_text=True)
+    return sorted(timings)
+
+
+def time_serialization(rows, schema_dump, generated_dump, repeat):
+    baseline, fast = [], []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        expected = flask.jsonify(schema_dump(rows)).get_data()
+        baseline.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        actual = fast_jsonify(generated_dump(rows)).get_data()
+        fast.append(time.perf_counter() - started)
+        assert actual == expected
+    return sorted(baseline), sorted(fast)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--invoices', type=int, default=1000)
+    parser.add_argument('--lines', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with temporary_database() as test_client:
+        ids = seed(test_client, args.clients, args.products, args.invoices, args.lines)
+        print(f'json backend: {"orjson " + orjson.__version__ if orjson else "stdlib"}')
+        print(f'{"endpoint":>24} {"p50 ms":>8} {"p95 ms":>8} {"marshmallow ms":>15} {"generated ms":>13} {"speedup":>8}')
+        endpoints = [
+            ('/api/clients', lambda: Client.query.all(), clients_schema.dump, dump_clients),
+            ('/api/clients/<id>', lambda: Client.query.get(ids['client']), client_schema.dump, dump_client),
+            ('/api/products', lambda: Product.query.all(), products_schema.dump, dump_products),
+            ('/api/products/<id>', lambda: Product.query.get(ids['product']), product_schema.dump, dump_product),
+            (f'/api/invoices?limit={args.invoices}',
+             lambda: Invoice.query.options(selectinload(Invoice.invoice_items)).limit(args.invoices).all(),
+             invoices_schema.dump, dump_invoices),
+            ('/api/invoices/<id>', lambda: Invoice.query.options(selectinload(Invoice.invoice_items))
+             .filter_by(invoice_id=ids['invoice']).one(), invoice_schema.dump, dump_invoice)
+        ]
+        for url, load_rows, schema_dump, generated_dump in endpoints:
+            name = url.split('?')[0]
+            url = url.replace('<id>', ids[name.split('/')[2][:-1]])
+            timings = time_request(test_client, url, args.repeat)
+            with test_client.application.test_request_context():
+                baseline, fast = time_serialization(load_rows(), schema_dump, generated_dump, args.repeat)
+            print(f'{name:>24} {percentile(timings, 0.5) * 1e3:>8.2f} {percentile(timings, 0.95) * 1e3:>8.2f} '
+                  f'{percentile(baseline, 0.5) * 1e3:>15.2f} {percentile(fast, 0.5) * 1e3:>13.2f} '
+                  f'{percentile(baseline, 0.5) / percentile(fast, 0.5):>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Concurrent read/write load test for the SQLite storage profiles.
+
+Writer processes POST invoices while reader processes page through GET /api/invoices,
+like sync gunicorn workers sharing one database file. Every profile gets a fresh
+database; the report shows throughput and how many requests failed with
+"database is locked".
+
+    python -m benchmarks.sqlite_concurrency --writers 4 --readers 4 --threads 2 --seconds 10
+"""
+import argparse
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+
+from application.storage import SQLITE_PROFILES
+
+
+def load_app(profile, db_path):
+    from app import create_app
+    return create_app({'SQLITE_PROFILE': profile, 'CATALOG_CACHE_BACKEND': 'null',
+                       'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + db_path})
+
+
+def seed(profile, db_path, product_count):
+    from application import db
+    from benchmarks.common import seed_client, seed_products
+    app = load_app(profile, db_path)
+    with app.app_context():
+        db.create_all()
+    test_client = app.test_client()
+    return seed_client(test_client), seed_products(test_client, product_count)
+
+
+def run_worker(role, profile, db_path, client_id, product_ids, threads, lines, started_at, deadline):
+    from benchmarks.common import invoice_payload
+    app = load_app(profile, db_path)
+    counts = {'requests': 0, 'errors': 0, 'locked': 0}
+    lock = threading.Lock()
+
+    def loop():
+        test_client = app.test_client()
+        payload = invoice_payload(client_id, product_ids, lines)
+        time.sleep(max(0.0, started_at - time.time()))
+        while time.time() < deadline:
+            if role == 'writer':
+                response = test_client.post('/api/invoices', json=payload)
+            else:
+                response = test_client.get('/api/invoices', query_string={'limit': 10})
+            with lock:
+                counts['requests'] += 1
+                if response.status_code >= 400:
+                    counts['errors'] += 1
+                    if 'locked' in response.get_data(as_text=True):
+                        counts['locked'] += 1
+
+    workers = [threading.Thread(target=loop) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return role, counts
+
+
+def run_profile(profile, args):
+    db_fd, db_path = tempfile.mkstemp(suffix='.db')
+    os.close(db_fd)
+    context = multiprocessing.get_context('spawn')
+    try:
+        with context.Pool(1) as pool:
+            client_id, product_ids = pool.apply(seed, (profile, db_path, args.lines))
+        roles = ['writer'] * args.writers + ['reader'] * args.readers
+        with context.Pool(len(roles)) as pool:
+            # Leave the workers a few seconds to start before the clock runs
+            started_at = time.time() + 3
+            results = pool.starmap(run_worker, [
+                (role, profile, db_path, client_id, product_ids, args.threads, args.lines, started_at, started_at + args.seconds)
+                for role in roles
+            ])
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db_path + suffix):
+                os.unlink(db_path + suffix)
+
+    for role in ('writer', 'reader'):
+        totals = {'requests': 0, 'errors': 0, 'locked': 0}
+        for result_role, counts in results:
+            if result_role == role:
+                for name in totals:
+                    totals[name] += counts[name]
+        print(f'{profile:>10} {role:>7} {totals["requests"] / args.seconds:>10.1f} '
+              f'{totals["errors"]:>7} {totals["locked"]:>7}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--profiles', nargs='+', choices=sorted(SQLITE_PROFILES), default=['default', 'production'])
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=2)
+    parser.add_argument('--lines', type=int, default=20)
+    parser.add_argument('--seconds', type=int, default=10)
+    args = parser.parse_args()
+
+    print(f'{"profile":>10} {"role":>7} {"req/s":>10} {"errors":>7} {"locked":>7}')
+    for profile in args.profiles:
+        run_profile(profile, args)
+
+
+if __name__ == '__main__':
+    main()
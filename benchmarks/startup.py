@@ -0,0 +1,141 @@
+"""
+Startup cost of the app: cold import, create_app and first requests, and the
+memory of gunicorn workers with and without --preload.
+
+cold     Runs --runs fresh interpreters on a seeded database. Each one times
+         `import app`, create_app() and the first and second call of a few
+         endpoints, and lists which of the heavy optional modules got loaded.
+workers  Starts `gunicorn wsgi:app --workers N` with and without --preload,
+         warms every worker with requests and reads /proc/<pid>/smaps_rollup.
+         Private is memory only that worker uses; with --preload the code and
+         objects loaded by the master stay shared copy-on-write pages.
+
+    python -m benchmarks.startup --runs 10 --workers 4
+"""
+import argparse
+import http.client
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from app import basedir
+from benchmarks.common import invoice_payload, seed_client, seed_products, temporary_database
+
+HOST = '127.0.0.1'
+HEAVY_MODULES = ('numpy', 'pdfkit', 'PyPDF2', 'weasyprint', 'jinja2', 'orjson')
+
+# Runs in a fresh interpreter, argv[1] is the database URI and argv[2] the requests as JSON
+MEASURE_CHILD = '''
+import json, sys, time
+started = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+app = create_app({'SQLALCHEMY_DATABASE_URI': sys.argv[1]})
+created = time.perf_counter()
+timings = {'import': imported - started, 'create_app': created - imported}
+test_client = app.test_client()
+for name, method, path, body in json.loads(sys.argv[2]):
+    for call in ('first', 'second'):
+        request_started = time.perf_counter()
+        status = test_client.open(path, method=method, json=body).status_code
+        assert status < 400, (path, status)
+        timings[f'{name} {call}'] = time.perf_counter() - request_started
+print(json.dumps({'timings': timings, 'modules': sorted(set(sys.argv[3].split(',')) & set(sys.modules))}))
+'''
+
+
+def measure_cold(db_uri, requests, runs):
+    results = [json.loads(subprocess.check_output(
+        [sys.executable, '-W', 'ignore', '-c', MEASURE_CHILD, db_uri, json.dumps(requests), ','.join(HEAVY_MODULES)],
+        cwd=basedir)) for _ in range(runs)]
+    print(f'{"cold start":>24} {"median ms":>10} {"max ms":>8}')
+    for name in results[0]['timings']:
+        timings = [result['timings'][name] * 1e3 for result in results]
+        print(f'{name:>24} {statistics.median(timings):>10.1f} {max(timings):>8.1f}')
+    print(f'heavy modules loaded: {", ".join(results[0]["modules"])}')
+
+
+def child_pids(pid):
+    with open(f'/proc/{pid}/task/{pid}/children') as children:
+        return [int(child) for child in children.read().split()]
+
+
+def memory_kb(pid):
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as smaps:
+        for line in smaps:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1])
+    return fields['Pss'], fields['Private_Clean'] + fields['Private_Dirty']
+
+
+def measure_workers(db_uri, requests, workers, port, preload):
+    env = dict(os.environ, SQLITE_PATH=db_uri[len('sqlite:///'):], SQLITE_PROFILE='production')
+    command = ['gunicorn', 'wsgi:app', '--workers', str(workers), '--bind', f'{HOST}:{port}', '--log-level', 'warning']
+    started = time.perf_counter()
+    process = subprocess.Popen(command + (['--preload'] if preload else []), cwd=basedir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        ready = None
+        while ready is None and time.perf_counter() - started < 30:
+            try:
+                connection = http.client.HTTPConnection(HOST, port, timeout=5)
+                connection.request('GET', '/api/products')
+                if connection.getresponse().status == 200:
+                    ready = time.perf_counter() - started
+                connection.close()
+            except OSError:
+                time.sleep(0.05)
+        # Fresh connections are spread over the workers, so every one of them serves some of each request
+        for _ in range(workers * 20):
+            for _, method, path, body in requests:
+                connection = http.client.HTTPConnection(HOST, port, timeout=30)
+                connection.request(method, path, body=json.dumps(body) if body else None,
+                                   headers={'Content-Type': 'application/json'})
+                connection.getresponse().read()
+                connection.close()
+        master_pss, _ = memory_kb(process.pid)
+        worker_memory = [memory_kb(pid) for pid in child_pids(process.pid)]
+    finally:
+        process.terminate()
+        process.wait()
+    total_pss = master_pss + sum(pss for pss, _ in worker_memory)
+    print(f'{"preload" if preload else "no preload":>10} {ready * 1e3:>9.0f} '
+          f'{statistics.mean(private for _, private in worker_memory) / 1024:>15.1f} '
+          f'{statistics.mean(pss for pss, _ in worker_memory) / 1024:>11.1f} {total_pss / 1024:>14.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--lines', type=int, default=10)
+    parser.add_argument('--port', type=int, default=8766)
+    args = parser.parse_args()
+
+    with temporary_database() as test_client:
+        db_uri = test_client.application.config['SQLALCHEMY_DATABASE_URI']
+        client_id = seed_client(test_client)
+        payload = invoice_payload(client_id, seed_products(test_client, args.lines), args.lines)
+        invoice_id = test_client.post('/api/invoices', json=payload).get_json()['invoice_details']['invoice_id']
+        requests = [
+            ('GET products', 'GET', '/api/products', None),
+            ('GET invoice', 'GET', f'/api/invoices/{invoice_id}', None),
+            ('POST invoice', 'POST', '/api/invoices', payload)
+        ]
+        measure_cold(db_uri, requests, args.runs)
+        print(f'\n{"workers":>10} {"ready ms":>9} {"private MB/wkr":>15} {"PSS MB/wkr":>11} {"total PSS MB":>14}')
+        for preload in (False, True):
+            measure_workers(db_uri, requests, args.workers, args.port, preload)
+        db_path = db_uri[len('sqlite:///'):]
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(db_path + suffix):
+                os.unlink(db_path + suffix)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,42 @@
+import asyncio
+import json
 import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
 
-from app import app, basedir
+import flask
+from flask import Flask
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+
+from app import basedir, create_app
 from application import db
+from application.asgi import AsgiApp
+from application.cache import CatalogCache, MemoryCacheStore, cache
+from application.clients.models import Client
+from application.clients.schemas import clients_schema, dump_clients
+from application.invoices import rendering
+from application.invoices.models import Invoice
+from application.invoices.schemas import dump_invoices, invoices_schema
+from application.metrics import metrics
+from application.migrations import MIGRATIONS, get_schema_version, migrate
+from application.products.models import Product
+from application.products.schemas import dump_products, products_schema
+from application.serialization import fast_jsonify
+from application.storage import init_storage
 
 
 class AppTest(unittest.TestCase):
 
     def setUp(self):
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'invoice_tests.db')
-        db.init_app(app)
-        with app.app_context():
+        self.app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(basedir, 'invoice_tests.db')})
+        with self.app.app_context():
             db.create_all()
-        self.test_client = app.test_client(self)
+        cache.clear()
+        self.test_client = self.app.test_client(self)
 
     def tearDown(self):
         os.unlink(os.path.join(basedir, 'invoice_tests.db'))
@@ -24,5 +48,340 @@ class AppTest(unittest.TestCase):
         self.assertEqual(status_code, 404)
 
 
+class CatalogCacheTest(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        store = MemoryCacheStore(max_size=2, ttl=60)
+        store.set('a', 1)
+        store.set('b', 2)
+        self.assertEqual(store.get('a'), 1)
+        store.set('c', 3)
+        self.assertIsNone(store.get('b'))
+        self.assertEqual(store.get('a'), 1)
+        self.assertEqual(store.get('c'), 3)
+        self.assertEqual(store.stats()['evictions'], 1)
+        self.assertEqual(store.stats()['hits'], 3)
+        self.assertEqual(store.stats()['misses'], 1)
+
+    def test_ttl_expiry(self):
+        store = MemoryCacheStore(max_size=2, ttl=-1)
+        store.set('a', 1)
+        self.assertIsNone(store.get('a'))
+        self.assertEqual(store.stats()['size'], 0)
+
+    def test_read_through(self):
+        catalog_cache = CatalogCache(MemoryCacheStore())
+        loads = []
+        load_missing = lambda ids: loads.append(ids) or {item_id: item_id.upper() for item_id in ids if item_id != 'x'}
+        self.assertEqual(catalog_cache.get_many('product', ['a', 'b', 'x'], load_missing), {'a': 'A', 'b': 'B'})
+        self.assertEqual(catalog_cache.get_many('product', ['a', 'c', 'x'], load_missing), {'a': 'A', 'c': 'C'})
+        self.assertEqual(loads, [['a', 'b', 'x'], ['c', 'x']])
+        catalog_cache.delete('product', 'a')
+        self.assertEqual(catalog_cache.get('product', 'a', lambda: 'A2'), 'A2')
+
+    def test_value_loaded_before_a_delete_is_not_cached(self):
+        catalog_cache = CatalogCache(MemoryCacheStore())
+
+        def load_and_lose_race(*item_ids):
+            # A PUT commits and invalidates the keys after this reader loaded the old rows
+            catalog_cache.delete('product', *item_ids)
+            return {item_id: 'old' for item_id in item_ids}
+
+        self.assertEqual(catalog_cache.get('product', 'a', lambda: load_and_lose_race('a')['a']), 'old')
+        self.assertEqual(catalog_cache.get('product', 'a', lambda: 'new'), 'new')
+        self.assertEqual(catalog_cache.get_many('product', ['b'], lambda ids: load_and_lose_race(*ids)), {'b': 'old'})
+        self.assertEqual(catalog_cache.get_many('product', ['a', 'b'], lambda ids: {item_id: 'new' for item_id in ids}),
+                         {'a': 'new', 'b': 'new'})
+
+
+class FactoryTest(unittest.TestCase):
+
+    def test_config_overrides_environment(self):
+        first = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///first.db', 'INVOICE_SERIES': 'EXP'})
+        second = create_app()
+        self.assertEqual(first.config['SQLALCHEMY_DATABASE_URI'], 'sqlite:///first.db')
+        self.assertEqual(first.config['INVOICE_SERIES'], 'EXP')
+        self.assertEqual(second.config['INVOICE_SERIES'], os.environ.get('INVOICE_SERIES', 'INV'))
+        self.assertIn('db_create', second.cli.commands)
+
+    def test_startup_skips_pdf_machinery(self):
+        # A fresh worker process builds the app without importing the PDF libraries or connecting
+        output = subprocess.check_output([sys.executable, '-c', (
+            'import sys, wsgi; '
+            'print(sorted({"pdfkit", "PyPDF2", "flask_marshmallow"} & set(sys.modules)), '
+            'wsgi.app.extensions["sqlalchemy"].connectors)'
+        )], cwd=basedir, text=True)
+        self.assertEqual(output.strip(), '[] {}')
+
+
+class StorageTest(unittest.TestCase):
+
+    def test_production_profile(self):
+        profile_app = Flask(__name__)
+        profile_app.config['SQLITE_PROFILE'] = 'production'
+        db_path = os.path.join(basedir, 'invoice_storage_tests.db')
+        try:
+            init_storage(profile_app)
+            options = profile_app.config['SQLALCHEMY_ENGINE_OPTIONS']
+            self.assertIs(options['poolclass'], QueuePool)
+            engine = create_engine('sqlite:///' + db_path, **options)
+            with engine.connect() as connection:
+                self.assertEqual(connection.execute('PRAGMA journal_mode').scalar(), 'wal')
+                self.assertEqual(connection.execute('PRAGMA synchronous').scalar(), 1)
+                self.assertEqual(connection.execute('PRAGMA busy_timeout').scalar(), 5000)
+            engine.dispose()
+        finally:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(db_path + suffix):
+                    os.unlink(db_path + suffix)
+
+    def test_profiles_are_kept_per_app(self):
+        db_path = os.path.join(basedir, 'invoice_storage_tests.db')
+        production_app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + db_path, 'SQLITE_PROFILE': 'production'})
+        default_app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'SQLITE_BUSY_TIMEOUT': 1000})
+        try:
+            with production_app.app_context():
+                self.assertEqual(db.engine.execute('PRAGMA busy_timeout').scalar(), 5000)
+                self.assertEqual(db.engine.execute('PRAGMA synchronous').scalar(), 1)
+                db.engine.dispose()
+            with default_app.app_context():
+                self.assertEqual(db.engine.execute('PRAGMA busy_timeout').scalar(), 1000)
+                self.assertEqual(db.engine.execute('PRAGMA synchronous').scalar(), 2)
+                self.assertEqual(db.engine.execute('PRAGMA foreign_keys').scalar(), 1)
+        finally:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(db_path + suffix):
+                    os.unlink(db_path + suffix)
+
+
+class MigrationsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db_path = os.path.join(basedir, 'invoice_migration_tests.db')
+        shutil.copyfile(os.path.join(basedir, 'invoice_system.db'), self.db_path)
+        self.engine = create_engine('sqlite:///' + self.db_path)
+
+    def tearDown(self):
+        self.engine.dispose()
+        os.unlink(self.db_path)
+
+    def index_names(self):
+        return {row[0] for row in self.engine.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+
+    def test_migrate_existing_database(self):
+        self.assertEqual(get_schema_version(self.engine), 0)
+        applied = migrate(self.engine)
+        self.assertEqual([migration.version for migration in applied], [migration.version for migration in MIGRATIONS])
+        self.assertEqual(get_schema_version(self.engine), MIGRATIONS[-1].version)
+        self.assertTrue({'ix_invoices_client_id_created_at', 'ix_invoice_items_invoice_id'} <= self.index_names())
+        self.assertEqual(self.engine.execute('SELECT sum(invoice_count) FROM daily_client_summaries').scalar(),
+                         self.engine.execute('SELECT count(*) FROM invoices').scalar())
+        self.assertEqual(migrate(self.engine), [])
+
+    def test_migration_stores_catalog_versions(self):
+        migrate(self.engine, target_version=5)
+        invoices = {row[0]: (row[1], row[2], row[3], row[4], row[5].lower() in ('1', 'true')) for row in self.engine.execute(
+            'SELECT invoice_id, client_name, client_tin, client_address, client_city, is_client_taxable FROM invoices')}
+        items = {row[0]: tuple(row[1:]) for row in self.engine.execute(
+            'SELECT invoice_item_id, product_id, product_name, product_price, product_price_currency, product_vat_percent '
+            'FROM invoice_items')}
+        migrate(self.engine)
+        # Every distinct copy of the catalog fields is stored once
+        clients = {row[0]: row[1] for row in self.engine.execute('SELECT invoice_id, client_id FROM invoices')}
+        self.assertEqual(self.engine.execute('SELECT count(*) FROM client_versions').scalar(),
+                         len({(clients[invoice_id],) + details for invoice_id, details in invoices.items()}))
+        self.assertEqual(self.engine.execute('SELECT count(*) FROM product_versions').scalar(), len(set(items.values())))
+
+        test_client = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + self.db_path}).test_client()
+        fields = ('client_name', 'client_tin', 'client_address', 'client_city', 'is_client_taxable')
+        item_fields = ('product_id', 'product_name', 'product_price', 'product_price_currency', 'product_vat_percent')
+        for invoice_id, details in invoices.items():
+            invoice = test_client.get(f'/api/invoices/{invoice_id}').get_json()
+            self.assertEqual(tuple(invoice[field] for field in fields), details)
+            for item in invoice['invoice_items']:
+                self.assertEqual(tuple(item[field] for field in item_fields), items[item['invoice_item_id']])
+        invoice_id, details = next(iter(invoices.items()))
+        response = test_client.get('/api/invoices/search', query_string={'q': details[0], 'limit': 100})
+        self.assertIn(invoice_id, [invoice['invoice_id'] for invoice in response.get_json()])
+
+    def test_search_on_migrated_schema(self):
+        migrate(self.engine)
+        # Columns added by migrations come last, so the table's column order is not the model's
+        columns = [row[1] for row in self.engine.execute('PRAGMA table_info(invoices)')]
+        self.assertNotEqual(columns, [column.name for column in Invoice.__table__.columns])
+        test_client = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + self.db_path}).test_client()
+        invoice = test_client.get('/api/invoices', query_string={'limit': 1}).get_json()[0]
+        response = test_client.get('/api/invoices/search', query_string={'q': invoice['client_name'], 'limit': 100})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(invoice, response.get_json())
+
+    def test_migrated_schema_matches_models(self):
+        migrate(self.engine)
+        expected = {index.name for table in db.metadata.tables.values() for index in table.indexes}
+        self.assertTrue(expected <= self.index_names())
+
+
+class SerializationTest(AppTest):
+
+    def test_serializers_match_schemas(self):
+        client_id = self.test_client.post('/api/clients', json={
+            'client_name': 'مؤسسة الرياض', 'client_address': 'King Fahd Road', 'client_city': 'Riyadh',
+            'client_tin': '300000000000003', 'is_client_taxable': True
+        }).get_json()['added_client']['client_id']
+        product_id = self.test_client.post('/api/products', json={
+            'product_name': 'Designing', 'product_description': None, 'product_price': 30.0,
+            'product_vat_percent': 15.0
+        }).get_json()['added_product']['product_id']
+        self.test_client.post('/api/invoices', json={
+            'client_id': client_id,
+            'invoice_items': [{'product_id': product_id, 'product_quantity': 2, 'product_discount_percent': 10.0,
+                               'product_markup_percent': 20.0}]
+        })
+        with self.app.app_context():
+            for model, schema, dump in ((Client, clients_schema, dump_clients), (Product, products_schema, dump_products),
+                                        (Invoice, invoices_schema, dump_invoices)):
+                rows = model.query.all()
+                self.assertEqual(len(rows), 1)
+                self.assertEqual(dump(rows), schema.dump(rows))
+
+    def test_fast_jsonify_matches_jsonify(self):
+        samples = [
+            [{'client_name': 'مؤسسة الرياض 😀', 'product_description': None, 'is_client_taxable': True}],
+            {'tiny': 1e-05, 'huge': 1e16, 'price': 74.52, 'quantity': 2},
+            {'control': 'tab\tdel\x7f', 'errors': ('Product not found!',)}
+        ]
+        with self.app.test_request_context():
+            for data in samples:
+                self.assertEqual(fast_jsonify(data).get_data(), flask.jsonify(data).get_data())
+            self.assertEqual(fast_jsonify(status='SUCCESS').get_data(), flask.jsonify(status='SUCCESS').get_data())
+
+
+class MetricsTest(AppTest):
+
+    def test_metrics_endpoint(self):
+        self.test_client.get('/api/clients')
+        self.test_client.get('/api/clients/SOME_RANDOM_ID')
+        response = self.test_client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertIn('# TYPE http_request_duration_seconds histogram', lines)
+        labels = 'blueprint="clients_api",endpoint="clients_api.get_client_details",method="GET",status="404"'
+        self.assertTrue(any(line.startswith(f'http_request_duration_seconds_count{{{labels}}} ') for line in lines))
+        self.assertTrue(any(line.startswith('sql_statements_per_request_bucket{blueprint="clients_api",'
+                                            'endpoint="clients_api.get_clients",le="1"} ') for line in lines))
+
+    def test_sql_statements_are_counted_per_request(self):
+        before = metrics.sql_statements.series.get(('clients_api', 'clients_api.get_client_details'), {'sum': 0})['sum']
+        self.test_client.get('/api/clients/SOME_RANDOM_ID')
+        after = metrics.sql_statements.series[('clients_api', 'clients_api.get_client_details')]['sum']
+        self.assertEqual(after - before, 1)
+
+    def test_streamed_responses_are_observed_when_closed(self):
+        labels = ('invoices_api', 'invoices_api.get_invoices')
+        before = metrics.sql_statements.series.get(labels, {'sum': 0})['sum']
+        response = self.test_client.get('/api/invoices', query_string={'stream': 'true'})
+        self.assertEqual(response.get_data(), b'')
+        self.assertEqual(metrics.sql_statements.series.get(labels, {'sum': 0})['sum'], before)
+        response.close()
+        # The page query ran while the body was generated
+        self.assertEqual(metrics.sql_statements.series[labels]['sum'] - before, 1)
+
+    def test_failed_statements_leave_no_start_on_the_connection(self):
+        with self.app.app_context(), db.engine.connect() as connection:
+            with self.assertRaises(Exception):
+                connection.execute('SELECT * FROM no_such_table')
+            self.assertEqual(connection.info['query_started_at'], [])
+
+    def test_slow_requests_are_profiled(self):
+        profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, profile_dir)
+        settings = metrics.profile_threshold, metrics.profile_dir
+        metrics.profile_threshold, metrics.profile_dir = 1e-9, profile_dir
+        try:
+            self.test_client.get('/api/products')
+        finally:
+            metrics.profile_threshold, metrics.profile_dir = settings
+        profiles = os.listdir(profile_dir)
+        self.assertEqual(len(profiles), 1)
+        self.assertIn('products_api.get_products', profiles[0])
+
+
+class AsgiTest(AppTest):
+
+    def setUp(self):
+        super().setUp()
+        self.asgi_app = AsgiApp(self.app)
+        self.addCleanup(self.asgi_app.executor.shutdown)
+
+    def call(self, method, path, query_string=b'', headers=(), body_chunks=(b'',)):
+        scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query_string, 'root_path': '',
+                 'headers': [(name.encode(), value.encode()) for name, value in headers], 'http_version': '1.1'}
+        chunks = list(body_chunks)
+        messages = []
+
+        async def receive():
+            body = chunks.pop(0)
+            return {'type': 'http.request', 'body': body, 'more_body': bool(chunks)}
+
+        async def send(message):
+            messages.append(message)
+
+        asyncio.run(self.asgi_app(scope, receive, send))
+        self.assertFalse(messages[-1].get('more_body', False))
+        return messages[0]['status'], dict(messages[0]['headers']), b''.join(m.get('body', b'') for m in messages[1:])
+
+    def test_serves_the_flask_app(self):
+        status, headers, body = self.call('POST', '/api/clients', headers=[('Content-Type', 'application/json')],
+                                          body_chunks=[b'{"client_name": "Acme", "client_address": "Street", ',
+                                                       b'"client_city": "Riyadh", "client_tin": "3001", "is_client_taxable": true}'])
+        self.assertEqual(status, 201)
+        client_id = json.loads(body)['added_client']['client_id']
+        status, headers, body = self.call('GET', f'/api/clients/{client_id}')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body), self.test_client.get(f'/api/clients/{client_id}').get_json())
+        status, _, _ = self.call('GET', f'/api/clients/{client_id}', headers=[('If-None-Match', headers[b'etag'].decode())])
+        self.assertEqual(status, 304)
+
+    def test_streams_uploads_and_responses(self):
+        rows = [json.dumps({'product_name': f'Service {i}', 'product_price': i}).encode() + b'\n' for i in range(5)]
+        status, headers, body = self.call('POST', '/api/products/import', headers=[('Content-Type', 'application/x-ndjson')],
+                                          body_chunks=[b''.join(rows[:2]), rows[2][:10], rows[2][10:] + b''.join(rows[3:])])
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b'content-type'], b'application/x-ndjson')
+        self.assertEqual(json.loads(body.splitlines()[-1])['imported'], 5)
+
+    def test_wkhtmltopdf_renders_are_bounded(self):
+        self.app.config['PDF_RENDER_WORKERS'] = 2
+        asgi_app = AsgiApp(self.app)
+        self.addCleanup(asgi_app.executor.shutdown)
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        # Stands in for wkhtmltopdf and logs how many renders were running when it started
+        fake_wkhtmltopdf = os.path.join(work_dir, 'wkhtmltopdf')
+        with open(fake_wkhtmltopdf, 'w') as script:
+            script.write(f'#!/bin/sh\ntouch {work_dir}/running.$$\nls {work_dir} | grep -c running >> {work_dir}/log\n'
+                         f'cat > /dev/null\nsleep 0.2\nrm {work_dir}/running.$$\necho %PDF > "$3"\n')
+        os.chmod(fake_wkhtmltopdf, 0o755)
+        wkhtmltopdf_path, rendering.wkhtmltopdf_path = rendering.wkhtmltopdf_path, fake_wkhtmltopdf
+        self.addCleanup(setattr, rendering, 'wkhtmltopdf_path', wkhtmltopdf_path)
+
+        async def render_all():
+            asgi_app.loop = asyncio.get_running_loop()
+            futures = [asgi_app.start_render('<html></html>', os.path.join(work_dir, f'{i}.pdf'), 'wkhtmltopdf')
+                       for i in range(6)]
+            await asyncio.gather(*map(asyncio.wrap_future, futures))
+
+        asyncio.run(render_all())
+        with open(os.path.join(work_dir, 'log')) as log:
+            running = [int(line) for line in log]
+        self.assertEqual(len(running), 6)
+        self.assertLessEqual(max(running), 2)
+
+    def test_download_of_unknown_invoice(self):
+        status, _, body = self.call('GET', '/api/invoices/SOME_RANDOM_ID/download')
+        self.assertEqual(status, 404)
+        self.assertEqual(json.loads(body)['error_code'], 'INVOICE_NOT_FOUND')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,2 +1,8 @@
+import gc
 
-from app import app
+from app import create_app
+
+app = create_app()
+# With gunicorn --preload this runs once in the master; frozen objects are left out of garbage collection,
+# so forked workers don't write to, and copy, the memory pages they share with the master
+gc.freeze()